@@ -27,103 +27,112 @@ import functions
 # -------------------------------------------------------------------
 if __name__ == "__main__":
 
-    # Time to sleep between two requests
-    from time import sleep
-    sleeping_time = 2;
-
-    # Split files into parameter-based files?
-    split_files = True
-
     # ----------------------------
     # Parsing input args
     # ----------------------------
     parser = argparse.ArgumentParser(description="Download some HRRR data")
-    parser.add_argument("--config","-c", type = str, default = "config.conf",
-               help = "Name of the config file to be read. Default is 'config.conf'.")
+    parser.add_argument("--config","-c", type = str, nargs = "+", default = ["config.conf"],
+               help = "Name of the config file to be read. Default is 'config.conf'. " + \
+                      "Batch mode if several config files are given: listings, index files " + \
+                      "and messages needed by several configs are only downloaded once.")
+    parser.add_argument("--watch","-w", action = "store_true",
+               help = "Watch mode: keep polling the server and download new files as " + \
+                      "soon as they are published (see [watch] in the config file).")
+    parser.add_argument("--backfill","-b", type = str, nargs = 2, metavar = ("START", "END"),
+               help = "Backfill mode: download all files of the dates START to END (YYYYMMDD) " + \
+                      "using a work queue shared by several processes/machines (see [backfill] " + \
+                      "in the config file).")
+    parser.add_argument("--shard","-s", type = str, default = "0/1",
+               help = "Backfill mode: shard of this process K/N (K = 0, ..., N - 1). " + \
+                      "Default is 0/1.")
     args = vars(parser.parse_args())
 
     # ----------------------------
     # Important step: Read the config file.
     # ----------------------------
-    config = functions.read_config(args["config"])
-    print(config)
-    # No parameters?
-    if len(config.params) == 0:
-        raise Exception("No parameters to download! Check config file.")
+    configs = [functions.read_config(x) for x in args["config"]]
+    for config in configs:
+        print(config)
+        # No parameters?
+        if len(config.params) == 0:
+            raise Exception("No parameters to download! Check config file.")
+    config = configs[0]
+    if len(configs) > 1 and (args["watch"] or args["backfill"] is not None):
+        raise Exception("several config files only supported in the default mode.")
+
+
+    # All requests to the server share the same
+    # limits (see [download] section).
+    hosts     = functions.host_limiter(config)
+
+    # Performance metrics (see [metrics] section)
+    metrics   = functions.download_metrics(config) if config.metrics_enabled else None
+
+    # All requests through one curl multi event loop (see [curl] section)
+    engine    = functions.transfer_engine(config) if config.curl_multi else None
+
+    # ----------------------------
+    # Watch mode: runs until interrupted
+    # ----------------------------
+    if args["watch"]:
+        stats = functions.watch_gribfiles(config, hosts, metrics = metrics, engine = engine)
+        print(stats)
+        print(hosts)
+        if engine is not None: engine.close()
+        if metrics is not None: metrics.close()
+        sys.exit(0)
 
+    # ----------------------------
+    # Backfill mode: shared work queue
+    # ----------------------------
+    if args["backfill"] is not None:
+        shard, shards = [int(x) for x in args["shard"].split("/")]
+        stats = functions.backfill_gribfiles(config, *args["backfill"], shard, shards,
+                                             hosts, metrics, engine)
+        print(stats)
+        print(hosts)
+        if engine is not None: engine.close()
+        if metrics is not None: metrics.close()
+        sys.exit(0)
+
+    # ----------------------------
+    # Batch mode: several configs, shared requests
+    # ----------------------------
+    if len(configs) > 1:
+        for x in configs:
+            os.makedirs(x.gribdir, exist_ok = True)
+        for file,stats in zip(args["config"], functions.batch_gribfiles(configs, hosts, metrics, engine)):
+            print("Config {:s}".format(file))
+            print(stats)
+        print(hosts)
+        if engine is not None:
+            print(engine)
+            engine.close()
+        if metrics is not None: metrics.close()
+        sys.exit(0)
 
     # ----------------------------
     # Load available files
     # ----------------------------
-    gribfiles = functions.get_gribfiles_on_server(config)
+    gribfiles = functions.get_gribfiles_on_server(config, hosts, metrics, engine)
     if len(gribfiles.get("files")) == 0:
         raise Exception("No files found on server - stop execution.")
 
     # ----------------------------
     # Create output directory
     # ----------------------------
-    if not os.path.isdir(config.gribdir):
-        try:
-            os.makedirs(config.gribdir)
-        except:
-            raise Exception("Cannot create directory {:s}!".format(config.gribdir))
-
-
-    # Looping over the different members first
-    # Looping over forecast lead times
-    for file in gribfiles.get("files"):
-
-        # Check if we have the file on our local disc. If so, 
-        # we do not have to process it again.
-        if os.path.isfile(file.get("local")):
-            print("File exists on disc, skip ...")
-            continue
-
-        # Read index file (once per forecast step as the file changes
-        # with forecast step).
-        idx = functions.parse_index_file(file.get("idx"))
-        if idx is None:
-            print("Not able to download/parse the index file. Possible reason:")
-            print("problems with internet/server or the forecast is not available.")
-            print("Continue and skip this one ...")
-            continue
-
-        # Read/parse index file (if possible) and identify the
-        # required sections (byte-sections) for curl download.
-        required = functions.get_required_bytes(idx, config.params)
-
-        # If no messages found: continue
-        if required is None or len(required) == 0:
-            print("Could not find any required fields, skip ...")
-            continue
-
-        # Downloading the data
-        functions.download_range(config, file.get("url"), file.get("local"), required)
-
-        # Else post-processing the data
-        print("Sleeping {:d} seconds ...".format(sleeping_time))
-        sleep(sleeping_time)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    try:
+        os.makedirs(config.gribdir, exist_ok = True)
+    except:
+        raise Exception("Cannot create directory {:s}!".format(config.gribdir))
+
+
+    # Downloading the files using a pool of workers (see [download]
+    # section in the config file).
+    stats = functions.download_gribfiles(config, gribfiles.get("files"), hosts, metrics, engine)
+    print(stats)
+    print(hosts)
+    if engine is not None:
+        print(engine)
+        engine.close()
+    if metrics is not None: metrics.close()
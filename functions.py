@@ -17,28 +17,57 @@
 # -------------------------------------------------------------------
 class get_gribfiles_on_server:
 
-    def __init__(self, config):
+    def __init__(self, config, hosts = None, metrics = None, engine = None, dates = None,
+                 pattern = None):
+        """get_gribfiles_on_server(config, hosts = None, metrics = None, engine = None, dates = None, pattern = None)
 
-        self.config = config
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        hosts : None or host_limiter object
+            if set, used to limit the requests to the server (see
+            host_limiter); else a new one is created.
+        metrics : None or download_metrics object
+            if set, the listing requests are recorded.
+        engine : None or transfer_engine object
+            if set, the listings are requested through the transfer engine.
+        dates : None or list
+            if set, only the date directories of these dates (str,
+            YYYYMMDD) are processed ('config.latestdates' is ignored).
+        pattern : None or compiled regular expression
+            names of the files to be listed; default is
+            gribfile_pattern(config).
+        """
+
+        self.config  = config
+        self.hosts   = host_limiter(config) if hosts is None else hosts
+        self.metrics = metrics
+        self.engine  = engine
+        self.pattern = gribfile_pattern(config) if pattern is None else pattern
 
         # Download folders on server
-        from urllib.request import urlopen
         try:
-            data = urlopen(self.config.url).read()
+            links = self._links(self.config.url)
         except Exception as e:
             raise Exception(e)
 
-        # Find all folders
-        from bs4 import BeautifulSoup
-        root = BeautifulSoup(data, "html.parser")
-
-        from re import match
+        # Find all folders; sorted by date, only keep the newest N
+        # dates if requested
+        dirs = get_date_dirs(links)
+        if dates is not None:
+            dirs = [x for x in dirs if x[-8:] in dates]
+        elif self.config.latestdates > 0:
+            dirs = dirs[-self.config.latestdates:]
+        self.dirs = dirs
+
+        # Fetching/parsing the listings of the directories concurrently;
+        # map returns the results in the order of the directories.
+        from concurrent.futures import ThreadPoolExecutor
         self.files = []
-        for node in root.find_all("a"):
-            tmp_dir = match(r"^(hrrr.[0-9]{8})\/?$", node.text)
-            if tmp_dir:
-                tmp_dir     = tmp_dir.group(1).replace("/$", "")
-                self.files += self._get_files(tmp_dir)
+        with ThreadPoolExecutor(max_workers = self.config.download_hostconnections) as pool:
+            for res in pool.map(self._get_files, dirs):
+                self.files += res
 
     # Standard representation of this object
     def __repr__(self):
@@ -70,24 +99,28 @@ class get_gribfiles_on_server:
         will be returned or an empty list if no matching files can be found.
         """
 
-        from re import match
-        from bs4 import BeautifulSoup
-        from urllib.request import urlopen
-
-        url = "{:s}/{:s}/{:s}/".format(self.config.url, dir, self.config.domain)
-        data = urlopen(url)
-
-        result = []
-        root = BeautifulSoup(data, "html.parser")
-        for node in root.find_all("a"):
-            if match(r"^hrrr\..*\.grib2$", node.text):
-                tmp = gribfile(self.config, dir, node.text)
-                if tmp.get("step") in self.config.steps and \
-                   tmp.get("runhour") in self.config.runhours and \
-                   tmp.get("type") in self.config._types:
-                       result.append(tmp)
+        # Only the names of the requested files are extracted
+        # from the listing (streaming parser).
+        url   = "{:s}/{:s}/{:s}/".format(self.config.url, dir, self.config.domain)
+        names = self._links(url, self.pattern)
 
-        return result
+        return [gribfile(self.config, dir, name) for name in names]
+
+    def _links(self, url, pattern = None):
+        # Returns the links of the listing (see get_listing_links)
+        from time import perf_counter
+        from urllib.error import HTTPError
+        t0 = perf_counter()
+        try:
+            res, links = request_url(url, self.hosts, self.config.curl_timeout, self.engine,
+                                     lambda res: get_listing_links(res, pattern))
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.listing(url, e.code if isinstance(e, HTTPError) else 0, perf_counter() - t0)
+            raise
+        if self.metrics is not None:
+            self.metrics.listing(url, 200, perf_counter() - t0, len(links))
+        return links
 
     def get(self, what):
         """get(what)
@@ -108,6 +141,140 @@ class get_gribfiles_on_server:
             raise Error("whoops, \"{:s}\" attribute not found.".format(what))
         return x 
 
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class listing_parser(object):
+
+    def __init__(self, pattern = None):
+        """listing_parser(pattern = None)
+
+        Streaming parser for directory listings (html). Extracts the
+        targets of the links (href attributes, file/directory names
+        without path) from chunks of the listing (see 'feed'); the
+        listing does not have to be kept in memory.
+
+        Parameters
+        ----------
+        pattern : None or compiled regular expression
+            if set, only links matching the pattern are kept.
+        """
+        from re import compile, IGNORECASE
+        self.links    = []
+        self._pattern = pattern
+        self._buf     = ""
+        # Link targets (href attribute of <a> tags)
+        self._href    = compile(r"<a\s[^>]*?href\s*=\s*[\"']?([^\"'\s>]+)", IGNORECASE)
+
+    def feed(self, data):
+        """feed(data)
+
+        Parameters
+        ----------
+        data : bytes or str
+            next chunk of the listing.
+        """
+        if isinstance(data, bytes): data = data.decode("iso-8859-1")
+        data = self._buf + data
+        # Keep an incomplete tag at the end for the next chunk
+        i = data.rfind("<")
+        if i >= 0 and data.find(">", i) < 0:
+            data, self._buf = data[:i], data[i:]
+        else:
+            self._buf = ""
+        self._parse(data)
+
+    def close(self):
+        """close()
+
+        Returns
+        -------
+        List of the links (see get_listing_links).
+        """
+        self._parse(self._buf)
+        self._buf = ""
+        return self.links
+
+    def _parse(self, data):
+        for href in self._href.findall(data):
+            # Name of the file/directory; keep trailing "/" (directories)
+            name = href.rstrip("/").rsplit("/", 1)[-1] + ("/" if href.endswith("/") else "")
+            if self._pattern is None or self._pattern.match(name):
+                self.links.append(name)
+
+
+def get_listing_links(data, pattern = None, chunksize = 65536):
+    """get_listing_links(data, pattern = None, chunksize = 65536)
+
+    Parameters
+    ----------
+    data : bytes, str, or file-like object
+        directory listing (html) as sent by the server. If file-like (e.g.,
+        the response of urlopen), the listing is read and parsed in chunks.
+    pattern : None or compiled regular expression
+        if set, only links matching the pattern are returned (e.g.,
+        see gribfile_pattern).
+    chunksize : int
+        number of bytes read at once (file-like objects).
+
+    Returns
+    -------
+    List with the names (targets without path) of the links in the listing.
+    """
+    parser = listing_parser(pattern)
+    if hasattr(data, "read"):
+        while True:
+            chunk = data.read(chunksize)
+            if not chunk: break
+            parser.feed(chunk)
+    else:
+        parser.feed(data)
+    return parser.close()
+
+
+def get_date_dirs(links):
+    """get_date_dirs(links)
+
+    Parameters
+    ----------
+    links : list
+        links of the listing of the main URL (see get_listing_links).
+
+    Returns
+    -------
+    Sorted list of the date directories (hrrr.YYYYMMDD) in the listing.
+    """
+    from re import match
+    dirs = []
+    for name in links:
+        tmp_dir = match(r"^(hrrr.[0-9]{8})\/?$", name)
+        if tmp_dir:
+            dirs.append(tmp_dir.group(1))
+    return sorted(set(dirs))
+
+
+def gribfile_pattern(config, idx = False):
+    """gribfile_pattern(config, idx = False)
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    idx : bool
+        if True, the index files (<grib file>.idx) match as well.
+
+    Returns
+    -------
+    Compiled regular expression matching the names of the grib files
+    of the types, runhours, and forecast steps requested in the config
+    (see gribfile.wanted). Used to filter the listings.
+    """
+    from re import compile, escape
+    def numbers(x): return "0*(?:{:s})".format("|".join(["{:d}".format(int(k)) for k in x]))
+    return compile(r"^hrrr\.t{:s}z\.(?:{:s})f{:s}\.grib2{:s}$".format(numbers(config.runhours),
+                   "|".join([escape(x) for x in config._types]), numbers(config.steps),
+                   "(?:\\.idx)?" if idx else ""))
+
+
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
@@ -138,10 +305,66 @@ class gribfile:
         self.type    = tmp.group(2)
         self.step    = int(tmp.group(3))
 
+        # Model initialization (date and runhour)
+        import datetime as dt
+        self.date    = dt.datetime.strptime(dir[-8:], "%Y%m%d") + dt.timedelta(hours = self.runhour)
+
         # Append local file name
         import os
         self.local   = os.path.join(config.gribdir, dir, config.domain, file)
 
+    def wanted(self, config):
+        """wanted(config)
+
+        Returns
+        -------
+        True if the forecast step, runhour, and type of the
+        file are requested in the config, else False.
+        """
+        return self.step in config.steps and self.runhour in config.runhours and \
+               self.type in config._types
+
+    def on_disc(self, config, params = None):
+        """on_disc(config, params = None)
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        params : None or list
+            names of the parameters whose parameter-based files are
+            expected (e.g., the ones found in the index file, see
+            download_ledger); default are all parameters of the config.
+
+        Returns
+        -------
+        True if the local file(s) (see [download] combined and split
+        in the config) exist, else False.
+        """
+        import os
+        if config.download_combined and not os.path.isfile(self.local): return False
+        if config.download_split:
+            params = config.params if params is None else params
+            return all([os.path.isfile(x) for x in self.param_files(params).values()])
+        return True
+
+    def param_files(self, params):
+        """param_files(params)
+
+        Parameters
+        ----------
+        params : list
+            names of the parameters (config keys).
+
+        Returns
+        -------
+        Dictionary with the names of the local parameter-based files
+        (see get_param_file_name) for the parameters in 'params'.
+        """
+        from os.path import dirname
+        return dict([(x, get_param_file_name(dirname(self.local), self.date, self.step, x,
+                                             self.type)["local"]) for x in params])
+
     def __str__(self):
         return self.__repr__()
 
@@ -174,8 +397,8 @@ class gribfile:
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def get_param_file_name(filedir, date, step, param):
-    """get_param_file_name(filedir, date, step, param)
+def get_param_file_name(filedir, date, step, param, filetype = None):
+    """get_param_file_name(filedir, date, step, param, filetype = None)
 
     Generates the parameter-based file name.
 
@@ -189,6 +412,9 @@ def get_param_file_name(filedir, date, step, param):
         forecast step (in hours)
     param : str
         shortname of the parameter
+    filetype : None or str
+        type of the grib file (e.g., "wrfsfc"), added to the file name
+        if set.
 
     Returns
     -------
@@ -205,26 +431,130 @@ def get_param_file_name(filedir, date, step, param):
         raise ValueError("step has to be an integer")
     if not isinstance(param, str):
         raise ValueError("param has to be a string")
+    if not filetype is None:
+        param = "{:s}_{:s}".format(filetype, param)
 
     # Local file names
-    tmp = date.strftime("GFS_%Y%m%d_%H00")
+    tmp = date.strftime("HRRR_%Y%m%d_%H00")
     return {"local"  : os.path.join(filedir, "{:s}_f{:03d}_{:s}.grb2".format(tmp, step, param)),
             "subset" : os.path.join(filedir, "{:s}_f{:03d}_{:s}_subset.grb2".format(tmp, step, param))}
 
 
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class index_table(object):
+
+    def __init__(self, records):
+        """index_table(records)
+
+        Column-wise storage of the entries of a grib index file.
+        Byte positions, forecast step and duration are stored as
+        numpy arrays, parameter/level/step names as (interned) strings.
+        Indexing/iterating returns index_entry objects (views).
+
+        Parameters
+        ----------
+        records : list
+            list of tuples (byte_start, date, param, level, step); one
+            per line in the index file. All elements are strings (as
+            extracted from the index file), byte_start can also be
+            an integer.
+
+        Details
+        -------
+        Forecast step and duration are only evaluated once for each
+        unique step string (see _decode_step).
+        """
+
+        from sys import intern
+        from re import sub
+        from numpy import array, empty, int64, int32
+
+        # Transpose (column-wise)
+        n    = len(records)
+        cols = list(zip(*records)) if n > 0 else [()] * 5
+
+        self.start     = array(list(map(int, cols[0])), dtype = int64)
+        # End byte: -2 = unknown, -1 = end of file
+        self.end       = empty(n, dtype = int64)
+        self.end[:]    = -2
+        self.date      = list(map(intern, cols[1]))
+        self.var       = list(map(intern, cols[2]))
+        self.stepstr   = list(map(intern, cols[4]))
+        # Replace brackets for level (once per unique level)
+        levels = dict([(x, intern(sub(r"(\(|\)|\[|\]|\{|\})", "", x))) for x in set(cols[3])])
+        self.lev       = list(map(levels.__getitem__, cols[3]))
+        self.keys      = list(map(intern, map(":".join, zip(self.var, self.lev, self.stepstr))))
+
+        # Step and duration (once per unique step string)
+        steps = dict([(x, self._decode_step(x)) for x in set(self.stepstr)])
+        steps = list(map(steps.__getitem__, self.stepstr))
+        self.steps     = array([x[0] for x in steps], dtype = int32)
+        self.durations = array([x[1] for x in steps], dtype = int32)
+
+    @staticmethod
+    def _decode_step(x):
+        """_decode_step(x)
+
+        Returns
+        -------
+        Tuple (step, duration) for the step string 'x' of an index file
+        entry. step is -1 if unknown, duration is -1 for instant/current
+        values and -2 for unsupported units.
+        """
+        from re import match
+        # Searching for the pattern "10-11" or similar (range).
+        tmp = match(r"^(\d+)-(\d+)\s(\w+).*$", x)
+        if tmp:
+            duration = int(tmp.group(2)) - int(tmp.group(1)) if tmp.group(3) == "hour" else -2
+            return int(tmp.group(2)), duration
+        # Instant/current value?
+        tmp = match(r"^(\d+)\s(\w+).*$", x)
+        if tmp and tmp.group(2) == "hour":
+            return int(tmp.group(1)), -1
+        # Analysis
+        if x == "anl":
+            return 0, -1
+        return -1, -1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [index_entry(self, k) for k in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("index_table index out of range")
+        return index_entry(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield index_entry(self, i)
+
+    def __repr__(self):
+        return "\n".join([str(x) for x in self])
+
+
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
 class index_entry(object):
 
-    def __init__(self, args):
-        """index_entry(args)
+    __slots__ = ["_table", "_row"]
 
-        A small helper class to handle index entries.
+    def __init__(self, args, row = 0):
+        """index_entry(args, row = 0)
+
+        A small helper class to handle index entries; a view on one row
+        of an index_table.
         
         Parameters
         ----------
-        args : dict
-            dict with the extracted entries from the index file (row-by-row).
+        args : index_table or dict
+            index_table object, or a dict with the extracted entries
+            from the index file (row-by-row).
+        row : int
+            row in the index_table. Ignored if 'args' is a dict.
 
         Details
         -------
@@ -232,9 +562,13 @@ class index_entry(object):
         line in the index file are extracted and put into a dictionary.
         This dictionary is the input for this function and requires to at least
         include the 'required' elements ["byte", "date", "param", "level", "step"].
+        In this case a index_table with one single row is created.
         """
 
-        from re import sub
+        if isinstance(args, index_table):
+            self._table = args
+            self._row   = row
+            return
 
         if not type(args) == dict:
             raise ValueError("Input 'args' must be a dictionary")
@@ -242,43 +576,39 @@ class index_entry(object):
         if not all(key in args for key in required):
             raise ValueError("Not all required elements in 'args'.")
 
-        self._byte_start = int(args["byte_start"])
-        self._byte_end   = False
-        self._var        = str(args["param"])
-        self._step       = str(args["step"])
-        # Replace brackets for level
-        self._lev        = str(args["level"])
-        self._lev        = sub("(\(|\)|\[|\]|\{|\})", "", self._lev)
-
+        self._table = index_table([[str(args[key]) for key in required]])
+        self._row   = 0
 
     def add_end_byte(self, x):
         """add_end_byte(x)
 
         Appends the ending byte.
         """
-        self._byte_end = x
+        self._table.end[self._row] = -1 if x is None else x
 
     def end_byte(self):
         """end_byte()
 
-        Returns end byte.
+        Returns end byte (None if end of file, False if unknown).
         """
-        try:
-            x = getattr(self, "_byte_end")
-        except:
-            raise Error("whoops, _byte_end attribute not found.")
-        return x 
+        x = int(self._table.end[self._row])
+        return None if x == -1 else False if x == -2 else x
 
     def start_byte(self):
         """start_byte()
 
         Returns start byte.
         """
-        try:
-            x = getattr(self, "_byte_start")
-        except:
-            raise Error("whoops, _byte_start attribute not found.")
-        return x 
+        return int(self._table.start[self._row])
+
+    def date(self):
+        """date()
+
+        Returns
+        -------
+        Model initialization as in the index file ("YYYYMMDDHH").
+        """
+        return self._table.date[self._row]
 
     def key(self):
         """key()
@@ -289,14 +619,7 @@ class index_entry(object):
         as shown in the index file. Used to identify messages (in combination
         with the expressions in the config file).
         """
-        try:
-            var  = getattr(self, "_var")
-            lev  = getattr(self, "_lev")
-            step = getattr(self, "_step")
-        except Exception as e:
-            raise Exception(e)
-
-        return "{:s}:{:s}:{:s}".format(var, lev, step)
+        return self._table.keys[self._row]
 
     def duration(self):
         """duration()
@@ -311,20 +634,11 @@ class index_entry(object):
         (forecasted value/message is the current value) None will be
         returned.
         """
-        from re import match
-        # Searching for the pattern "10-11" or similar. If found,
-        # the duration will be calculated. Else 'None' will be returned
-        # (instant/current value).
-        tmp = match("^(\d+)-(\d+)\s(\w+).*$", self._step)
-        if not tmp: return None
-        tmp = dict(zip(["from", "to", "unit"], tmp.groups()))
-        
-        if tmp["unit"] == "hour":
-            duration = int(tmp["to"]) - int(tmp["from"])
-        else:
-            raise Exception("Don't know how to handle 'duration' for unit '{:s}'".format(tmp["unit"]))
-
-        return duration
+        x = int(self._table.durations[self._row])
+        if x == -2:
+            raise Exception("Don't know how to handle 'duration' for '{:s}'".format(
+                            self._table.stepstr[self._row]))
+        return None if x == -1 else x
 
     def step(self):
         """step()
@@ -333,18 +647,10 @@ class index_entry(object):
         -------
         Message forecast step.
         """
-        from re import match
-        # Range? Take second
-        tmp = match("^\d+-(\d+)\s\w+.*$", self._step)
-        if tmp:
-            return int(tmp.group(1))
-        # Instant/current value?
-        tmp = match("^(\d+)\s(\w+).*$", self._step)
-        if tmp and tmp.group(2) == "hour":
-            return int(tmp.group(1))
-
-        # Else break
-        raise Exception("Don't know how to deal with '{:s}'.".format(self._step))
+        x = int(self._table.steps[self._row])
+        if x < 0:
+            raise Exception("Don't know how to deal with '{:s}'.".format(self._table.stepstr[self._row]))
+        return x
 
     def range(self):
         """range()
@@ -353,30 +659,200 @@ class index_entry(object):
         -------
         Returns the byte range for curl.
         """
-        try:
-            start = getattr(self, "_byte_start")
-            end   = getattr(self, "_byte_end")
-        except Exception as e:
-            raise Exception(e)
+        end = self.end_byte()
         end = "" if end is None else "{:d}".format(end)
-
-        return "{:d}-{:s}".format(start, end)
+        return "{:d}-{:s}".format(self.start_byte(), end)
 
     def __repr__(self):
-        if isinstance(self._byte_end, bool):
+        end = self.end_byte()
+        if isinstance(end, bool):
             end = "UNKNOWN"
-        elif self._byte_end is None:
+        elif end is None:
             end = "end of file"
         else:
-            end = "{:d}".format(self._byte_end)
-        return "IDX ENTRY: {:10d}-{:>10s}, '{:s}' (+{:d}h; {:s})".format(self._byte_start,
+            end = "{:d}".format(end)
+        return "IDX ENTRY: {:10d}-{:>10s}, '{:s}' (+{:d}h; {:s})".format(self.start_byte(),
                 end, self.key(), self.step(),
                 "current value" if self.duration() is None else str(self.duration()))
 
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class idx_cache(object):
+
+    def __init__(self, config, engine = None):
+        """idx_cache(config, engine = None)
+
+        Local on-disc cache for grib index files. The index files are
+        stored in 'config.cache_dir' (one file per URL) along with the
+        ETag/Last-Modified header information sent by the server. Once
+        older than 'config.cache_fresh' seconds a cached index file is
+        revalidated using a conditional request (If-None-Match,
+        If-Modified-Since) and only downloaded again if modified.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        engine : None or transfer_engine object
+            if set, the index files are requested through the transfer engine.
+        """
+        import os
+        self.config = config
+        self.engine = engine
+        self.dir    = config.cache_dir
+        os.makedirs(self.dir, exist_ok = True)
+        self.evict()
+
+    def _files(self, url):
+        import os
+        from hashlib import sha1
+        key = sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.dir, key + ".idx"), os.path.join(self.dir, key + ".json")
+
+    def _write(self, file, data):
+        # Atomic write (write to .tmp, rename)
+        import os
+        from threading import get_ident
+        tmp = "{:s}.{:d}.tmp".format(file, get_ident())
+        with open(tmp, "wb") as fid: fid.write(data)
+        os.replace(tmp, file)
+
+    def fetch(self, url, limiter = None):
+        """fetch(url, limiter = None)
+
+        Parameters
+        ----------
+        url : str
+            url of the index file.
+        limiter : None, rate_limiter, or host_limiter object
+            if set, used to limit the requests to the server (host_limiter:
+            fails over to the mirrors, see request_url).
+
+        Returns
+        -------
+        Name of the (up-to-date) local copy of the index file or None if
+        the file cannot be downloaded and is not in the cache.
+        """
+        import os
+        import json
+        from time import time
+        from urllib.request import Request
+        from urllib.error import HTTPError
+
+        datafile, metafile = self._files(url)
+        meta = None
+        if os.path.isfile(datafile) and os.path.isfile(metafile):
+            try:
+                with open(metafile, "r") as fid: meta = json.load(fid)
+            except:
+                meta = None
+
+        # Fresh enough, no need to revalidate
+        if meta and (time() - meta["checked"]) < self.config.cache_fresh:
+            os.utime(datafile)
+            return datafile
+
+        req = Request(url)
+        if meta and meta.get("etag"):
+            req.add_header("If-None-Match", meta["etag"])
+        if meta and meta.get("last_modified"):
+            req.add_header("If-Modified-Since", meta["last_modified"])
+
+        if limiter is None: limiter = rate_limiter()
+        try:
+            res, data = self._request(req, limiter)
+            meta = {"url": url, "etag": res.headers.get("ETag"),
+                    "last_modified": res.headers.get("Last-Modified")}
+            self._write(datafile, data)
+        except HTTPError as e:
+            if not (e.code == 304 and meta):
+                print("[!] Problems reading index file\n    {:s}\n    ... return None".format(url))
+                return None
+        except Exception as e:
+            # Server not reachable: use cached copy if available
+            if not meta:
+                print("[!] Problems reading index file\n    {:s}\n    ... return None".format(url))
+                return None
+            print("[!] Problems revalidating index file, using cached copy\n    {:s}".format(url))
+            return datafile
+
+        meta["checked"] = time()
+        self._write(metafile, json.dumps(meta).encode("utf-8"))
+        return datafile
+
+    def info(self, url):
+        """info(url)
+
+        Returns
+        -------
+        Dictionary with the ETag ("etag") and Last-Modified ("last_modified")
+        header of the cached copy of 'url' as sent by the server. Empty
+        if not in the cache.
+        """
+        import json
+        datafile, metafile = self._files(url)
+        try:
+            with open(metafile, "r") as fid: return json.load(fid)
+        except:
+            return {}
+
+    def _request(self, req, limiter):
+        # Failed requests are retried up to 'config.curl_retries' times if
+        # worth a retry as for the data (see download_error): server errors
+        # (5xx), 408, 429, and no (complete) response (URLError, connection
+        # reset, timeout). The limiter pauses the requests if the server
+        # sends Retry-After.
+        from time import sleep
+        from http.client import HTTPException
+        from urllib.error import HTTPError
+        for attempt in range(self.config.curl_retries + 1):
+            try:
+                return request_url(req, limiter, self.config.curl_timeout, self.engine)
+            except HTTPError as e:
+                if not (e.code >= 500 or e.code in [408, 429]) or \
+                   attempt >= self.config.curl_retries: raise
+                if e.headers.get("Retry-After") is not None: continue
+            except (OSError, HTTPException):
+                if attempt >= self.config.curl_retries: raise
+            sleep(min(self.config.curl_maxsleeptime, self.config.curl_sleeptime * 2**attempt))
+
+    def evict(self):
+        """evict()
+
+        Removes cached index files not used for more than
+        'config.cache_maxage' days and, if the cache is still larger
+        than 'config.cache_maxsize' megabytes, the least recently used ones.
+        """
+        import os
+        from glob import glob
+        from time import time
+
+        files = []
+        for datafile in glob(os.path.join(self.dir, "*.idx")):
+            try:
+                info = os.stat(datafile)
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, info.st_size, datafile))
+        files.sort()
+
+        total  = sum([x[1] for x in files])
+        oldest = time() - self.config.cache_maxage * 86400
+        for mtime, size, datafile in files:
+            if mtime >= oldest and total <= self.config.cache_maxsize * 1e6: break
+            for file in [datafile, datafile[:-4] + ".json"]:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def parse_index_file(idxfile, remote = True):
-    """parse_index_file(idxfile, remote = True)
+def parse_index_file(idxfile, remote = True, cache = None, limiter = None):
+    """parse_index_file(idxfile, remote = True, cache = None, limiter = None)
  
     Downloading and parsing the grib index file.
     Can be used to read local and remote (http/https) index files.
@@ -388,220 +864,549 @@ def parse_index_file(idxfile, remote = True):
     remote : bool
         if remote = True urllib2 is used to read the file from the
         web, else expected to be a local file.
+    cache : None or idx_cache object
+        if set (and remote = True) the index file is fetched through
+        the local cache and the cached copy is parsed.
+    limiter : None, rate_limiter, or host_limiter object
+        if set (and remote = True), used to limit the requests to the server
+        (host_limiter: fails over to the mirrors, see request_url).
 
     Returns
     -------
-    Returns a list of index entries (entries of class index_entry).
+    Returns an index_table object (see parse_index_data) which
+    behaves like a list of index entries (entries of class index_entry).
     """
 
     if remote:
-
-        from urllib.request import urlopen
-        try:
-            data = urlopen(idxfile).read()
-        except Exception as e:
-            print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
-            return None
-
-        data = data.decode("utf-8")
+        data = fetch_index_data(idxfile, cache, limiter)
+        if data is None: return None
 
     else:
         from os.path import isfile
         if not isfile(idxfile):
             raise Exception("file {:s} does ont exist on disc".format(idxfile))
         with open(idxfile, "r") as fid:
-            data = "".join(fid.readlines())
+            data = fid.read()
 
     if len(data) == 0:  return None
-    else:               data = data.split("\n")
-       
-
-    # List to store the required index message information
-    idx_entries = []
-
-    # Parsing data (extracting message starting byte,
-    # variable name, and variable level)
-    from re import compile, findall
-    #                    byte      date    param      level       step
-    comp = compile("^\d+:(\d+):d=(\d{10}):([^:.?]+):([^:\\..?]*):(.*?):$")
-    comp_keys = ["byte_start", "date", "param", "level", "step"]
-    byte = 1 # initial byte
-    for line in data:
-        if len(line) == 0: continue
-        mtch = findall(comp, line.replace(".", "-"))
-        if not mtch:
-            raise Exception("whoops, pattern mismatch \"{:s}\"".format(line))
-        # Else crate the index_entry (object of class index_entry which takes up
-        # the information from the index file)
-        idx_entries.append(index_entry(dict(zip(comp_keys, mtch[0]))))
-
-    # Now we know where the message start (bytes), but we do not
-    # know where they end. Append this information.
-    for k in range(0, len(idx_entries)):
-        if (k + 1) == len(idx_entries):
-            idx_entries[k].add_end_byte(None)
-        else:
-            idx_entries[k].add_end_byte(idx_entries[k+1].start_byte() - 1)
-
-    # Go trough the entries to find the messages we request for.
-    #for rec in idx_entries: print(rec)
-    return idx_entries
+    return parse_index_data(data)
 
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def create_index_file(grbfile):
-    """parse_index_file(grbfile):
- 
-    Well, this is not very efficient. If I cannot find the index file
-    on the server (happens every now and then) I am simply downloading
-    the grib2 file if existing, create my own index file, and use
-    this index file. However, at this point I already have a local
-    copy of the grib2 file and I could use this rather than downloading
-    via curl once again. But ... TODO.
+def fetch_index_data(idxfile, cache = None, limiter = None, engine = None):
+    """fetch_index_data(idxfile, cache = None, limiter = None, engine = None)
+
+    Downloading a grib index file (see parse_index_file).
 
     Parameters
     ----------
-    grbfile : str
-        url of the remote grib2 file.
+    idxfile : str
+        url to the index file
+    cache : None or idx_cache object
+        if set the index file is fetched through the local cache.
+    limiter : None, rate_limiter, or host_limiter object
+        if set, used to limit the requests to the server (host_limiter:
+        fails over to the mirrors, see request_url).
+    engine : None or transfer_engine object
+        if set (and no cache is used), the index file is requested
+        through the transfer engine.
 
     Returns
     -------
-    Either None if the grib2 file does not exist (in this case we
-    cannot create an index file locally) or what parse_index_file returns.
+    Returns the content of the index file (str) or None if the
+    file cannot be downloaded.
     """
 
-    # Requires wgrib2: check if existing
-    import distutils.spawn
-    check = distutils.spawn.find_executable("wgrib2")
-    if not check: 
-        print("[!] Creating index file on your own does not work (wgrib2 missing), skip.")
-        return None
-
-    # Import library
-    try:
-        from urllib import urlretrieve # Python 2
-    except ImportError:
-        from urllib.request import urlretrieve # Python 3
+    if cache is not None:
+        idxfile = cache.fetch(idxfile, limiter)
+        if idxfile is None: return None
+        with open(idxfile, "r") as fid:
+            return fid.read()
 
-    import tempfile
-    tmp1 = tempfile.NamedTemporaryFile(prefix = "GFS_grib_")
-    tmp2 = tempfile.NamedTemporaryFile(prefix = "GFS_idx_")
     try:
-        urlretrieve(grbfile, tmp1.name)
-    except:
+        data = request_url(idxfile, limiter, engine = engine)[1]
+    except Exception as e:
+        print("[!] Problems reading index file\n    {:s}\n    ... return None".format(idxfile))
         return None
-    
-    import subprocess as sub
-    import os
-    #print(tmp1.name)
-    #print(grbfile)
-    os.system("wgrib2 {:s}".format(tmp1.name))
-    p = sub.Popen(["wgrib2", tmp1.name],
-                  stdout = sub.PIPE, stderr = sub.PIPE)
-    out, err = p.communicate()
-
-    if not p.returncode == 0:
-        print("[!] Not able to create proper index file in create_index_file, return None")
-        return None
-
-    with open(tmp2.name, "w") as fid: fid.write(out)
-
-    idx = parse_index_file(tmp2.name, remote = False)
-    tmp1.close()
-    tmp2.close()
-      
-    # Return list
-    return idx
 
+    return data.decode("utf-8")
 
 
 # -------------------------------------------------------------------
 # -------------------------------------------------------------------
-def get_required_bytes(idx, params, stopifnot = False):
-    """get_required_bytes(idx, params, stopifnot = False)
+def parse_index_data(data):
+    """parse_index_data(data)
 
-    Searching for the entries in idx corresponding to the parameter
-    definition in params (has to match the grib2 inventory param names, e.g.,
-    "TMP:2 m surface"). Returns a list of bytes which have to be downloaded
-    with curl later on.
+    Parsing the content of a grib index file. Used by parse_index_file.
 
-    Parameter
-    ---------
-    idx : list
-        list of index_entry objects. The list returned by parse_index_file.
-    params : dict
-        parameter configuration from the config file.
-    stopifnot : bool
-        stop if one (or several) parameters cannot be found in the index
-        file. If set to false these messages will simply be ignored.
+    Parameters
+    ----------
+    data : str
+        content of the index file (decoded).
 
     Returns
     -------
-    Returns a list of bytes (for curl).
+    Returns an index_table object (a sequence of index_entry objects).
+
+    Details
+    -------
+    One single (multiline) regular expression is applied to the whole
+    content of the index file; the result is stored column-wise (see
+    index_table). Raises an exception if one of the (non-empty) lines
+    does not match the expected pattern.
     """
 
-    from re import match
-    from numpy import int64
+    # Parsing data (extracting message starting byte,
+    # variable name, and variable level)
+    from re import compile, MULTILINE
+    #                    byte      date    param        level         step
+    comp = compile(r"^\d+:(\d+):d=(\d{10}):([^:.?\n]+):([^:.?\n]*):(.*?):$", MULTILINE)
 
-    # Crate a list of the string if only one string is given.
-    if not isinstance(params, dict):
-        raise ValueError("params has to be a dictionary")
-
-    # Go trough the entries to find the messages we request for.
-    res     = []
-    found   = []
-    missing = []
-    for x in idx:
-        count = 0
-        for param,ppattern in params.items():
-            if match(ppattern, x.key()): count = count + 1
-        if count == 1:
-            res.append(x.range())
-            found.append(x.key())
-        elif count > 0:
-            raise Exception("Expression \"{:s}\" matches multiple entries in the index file!".format(
-                            x.key()))
-        else: # count == 0
-            missing.append(param)
-
-    # Go trough the entries to find the messages we request for.
-    res     = []
-    found   = []
-    missing = []
-    for param,ppattern in params.items():
-        count = 0
-        msg_found = None
-        for x in idx:
-            if match(ppattern, x.key()):
-                count = count + 1
-                msg_found = x # Leep this message
-        if count == 1:
-            res.append(msg_found.range())
-            found.append(msg_found.key())
-        elif count > 0:
-            raise Exception("Expression \"{:s}\"".format(param) + \
-                            " matches multiple entries in the index file!")
-        else: # count == 0
-            missing.append(param)
-
-    # Missing messages?
-    if len(missing) > 0:
-        print("[!] Could not find: {:s}".format(", ".join(missing)))
-        if stopifnot: raise Exception("Some parameters not found in index file! Check config.")
+    data    = data.replace(".", "-").strip()
+    records = comp.findall(data)
 
-    # Return ranges to be downloaded
-    return res
+    # Each line has to match. If the number of matches differs from the
+    # number of lines, search for the first non-empty line not matching.
+    if len(records) != data.count("\n") + 1 and len(data) > 0:
+        for line in data.split("\n"):
+            if len(line.strip()) > 0 and not comp.match(line):
+                raise Exception("whoops, pattern mismatch \"{:s}\"".format(line))
 
+    # Now we know where the message start (bytes), but we do not
+    # know where they end. Append this information (-1: end of file).
+    idx = index_table(records)
+    if len(idx) > 0:
+        idx.end[:-1] = idx.start[1:] - 1
+        idx.end[-1]  = -1
 
-# -------------------------------------------------------------------
-# -------------------------------------------------------------------
-class read_config():
+    return idx
 
-    def __init__(self, file):
-        """read_config(file)
 
-        Reading the required configuration from the config file.
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def create_index_file(grbfile, remote = True, timeout = 10, limiter = None, engine = None):
+    """create_index_file(grbfile, remote = True, timeout = 10, limiter = None, engine = None)
+ 
+    If I cannot find the index file on the server (happens every now
+    and then) the index is created from the grib2 file itself. Only
+    the first bytes of each message are read (range requests; see
+    grib2.scan_messages and range_reader), the grib2 file is not
+    downloaded.
+
+    Parameters
+    ----------
+    grbfile : str
+        url of the remote grib2 file (or name of a local file if
+        remote = False).
+    remote : bool
+        if remote = False, 'grbfile' is expected to be a local file.
+    timeout : int
+        timeout in seconds (remote only).
+    limiter : None, rate_limiter, or host_limiter object
+        see request_url (remote only).
+    engine : None or transfer_engine object
+        see request_url (remote only).
+
+    Returns
+    -------
+    Either None if the grib2 file cannot be read (in this case we
+    cannot create an index file) or an index_table as returned by
+    parse_index_file.
+    """
+
+    import grib2
+
+    try:
+        if remote:
+            read = range_reader(grbfile, limiter, timeout, engine)
+        else:
+            read = grib2.file_reader(grbfile)
+        data, end = grib2.inventory(read)
+    except Exception as e:
+        print("[!] Not able to create index for {:s}, return None".format(grbfile))
+        print(e)
+        return None
+
+    # Using the same parser as for index files from the server. In
+    # contrast to these, we know the last byte of the last message.
+    idx = parse_index_data(data)
+    if len(idx) == 0: return None
+    idx.end[-1] = end
+
+    # Return list
+    return idx
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def range_reader(url, limiter = None, timeout = None, engine = None):
+    """range_reader(url, limiter = None, timeout = None, engine = None)
+
+    Parameters
+    ----------
+    url : str
+        URL of a remote grib2 file.
+    limiter : None, rate_limiter, or host_limiter object
+        see request_url.
+    timeout : None or int
+        timeout in seconds.
+    engine : None or transfer_engine object
+        see request_url.
+
+    Returns
+    -------
+    Function read(offset, size) (see grib2.scan_messages) returning (up to)
+    'size' bytes starting at byte 'offset' of the remote file (range
+    request). Returns an empty bytes object if 'offset' is beyond the end
+    of file. Raises an exception if the server does not support range
+    requests (status 200; the body is not read).
+    """
+    from urllib.request import Request
+    from urllib.error import HTTPError
+    def body(res):
+        if res.status == 200:
+            res.close()
+            return None
+        return res.read()
+    def read(offset, size):
+        req = Request(url, headers = {"Range": "bytes={:d}-{:d}".format(offset, offset + size - 1)})
+        try:
+            data = request_url(req, limiter, timeout, engine, body)[1]
+        except HTTPError as e:
+            if e.code == 416: return b""
+            raise
+        if data is None:
+            raise Exception("server does not support range requests for {:s}".format(url))
+        return data
+    return read
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def read_local_index(local):
+    """read_local_index(local)
+
+    Inventory of a local grib2 file. Uses the index file written along
+    with the local file ("<local>.idx", see write_local_index) if available,
+    else the index is created from the file itself (see create_index_file).
+
+    Parameters
+    ----------
+    local : str
+        name of the local grib2 file.
+
+    Returns
+    -------
+    None if the file cannot be read, else an index_table; the
+    byte ranges refer to the local file.
+    """
+    import os
+    sidecar = "{:s}.idx".format(local)
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(local):
+        idx = parse_index_file(sidecar, remote = False)
+        if idx is not None and len(idx) > 0:
+            idx.end[-1] = os.path.getsize(local) - 1
+        return idx
+    return create_index_file(local, remote = False)
+
+
+def read_grib_fields(local, params = None, dtype = "float32"):
+    """read_grib_fields(local, params = None, dtype = "float32")
+
+    Decodes messages of a local grib2 file into numpy arrays (see
+    grib2.decode_message). The file is memory-mapped and the messages
+    are located using the local index (see read_local_index), only
+    the messages requested are read from disc.
+
+    Parameters
+    ----------
+    local : str
+        name of the local grib2 file.
+    params : None, dict, or param_matcher
+        parameter configuration (see get_required_bytes). If None, all
+        messages are decoded.
+    dtype : str
+        data type of the values.
+
+    Returns
+    -------
+    Generator yielding a tuple (name, index_entry, values) for each message;
+    'name' is the local name of the parameter (key of the index entry if
+    params is None).
+    """
+    import grib2
+    idx = read_local_index(local)
+    if idx is None:
+        raise Exception("cannot read index of \"{:s}\"".format(local))
+    if params is None:
+        fields = [(x.key(), x) for x in idx]
+    else:
+        if not isinstance(params, param_matcher): params = param_matcher(params)
+        fields = params.select(idx)
+    with grib2.grib2_file(local) as fid:
+        for name,entry in fields:
+            end = entry.end_byte()
+            length = None if end is None or end is False else end - entry.start_byte() + 1
+            yield name, entry, fid.decode(entry.start_byte(), length, dtype)
+
+
+def gribfile_fields(file, params, split = None):
+    """gribfile_fields(file, params, split = None)
+
+    Decodes the messages of the local grib2 file(s) of a gribfile (see
+    read_grib_fields), e.g., to add them to an array_store.
+
+    Parameters
+    ----------
+    file : gribfile object
+        the file (combined local file, see split).
+    params : dict
+        parameters to be decoded (see get_required_bytes).
+    split : None or dict
+        if set, the messages are read from the parameter-based files
+        (param: local file) instead.
+
+    Returns
+    -------
+    Generator yielding a tuple (name, values, grid) for each message;
+    'grid' is the grid definition (see grib2.message_grid).
+    """
+    import grib2
+    # Tuples (local file, parameters or None, name)
+    if split is None:
+        sources = [(file.get("local"), params, None)]
+    else:
+        sources = [(split[x], None, x) for x in params if x in split]
+    for local,select,param in sources:
+        with grib2.grib2_file(local) as fid:
+            for name,entry,values in read_grib_fields(local, select):
+                yield name if param is None else param, values, fid.grid(entry.start_byte())
+                # Parameter-based file: one message
+                if param is not None: break
+
+
+def write_local_index(local, entries):
+    """write_local_index(local, entries)
+
+    Writes the index file "<local>.idx" for a local grib2 file.
+
+    Parameters
+    ----------
+    local : str
+        name of the local grib2 file.
+    entries : list
+        index_entry objects of all messages in the local file (in the
+        order as stored in the local file). The byte positions in the
+        index file are computed from the size of the messages.
+    """
+    import os
+    lines  = []
+    offset = 0
+    for k,entry in enumerate(entries):
+        lines.append("{:d}:{:d}:d={:s}:{:s}:".format(k + 1, offset, entry.date(), entry.key()))
+        if entry.end_byte() is None: break # Last message
+        offset += entry.end_byte() - entry.start_byte() + 1
+    tmp = "{:s}.idx.tmp".format(local)
+    with open(tmp, "w") as fid: fid.write("\n".join(lines) + "\n")
+    os.replace(tmp, "{:s}.idx".format(local))
+
+
+def append_gribfile(local, extra, checksum = None):
+    """append_gribfile(local, extra, checksum = None)
+
+    Appends the messages of the grib2 file 'extra' to the grib2 file
+    'local' (atomic; the data are copied into a temporary file which
+    replaces 'local' once complete). 'extra' is removed.
+
+    Parameters
+    ----------
+    local : str
+        name of the local grib2 file.
+    extra : str
+        name of the file containing the messages to be appended.
+    checksum : None or str
+        if set, the checksums of 'extra' ("<extra>.<checksum>", see
+        range_sink.write_checksums) are appended to "<local>.<checksum>".
+    """
+    import os
+    from shutil import copyfile, copyfileobj
+    offset = os.path.getsize(local)
+    tmp    = "{:s}.append.tmp".format(local)
+    copyfile(local, tmp)
+    with open(tmp, "ab") as fid, open(extra, "rb") as src:
+        copyfileobj(src, fid)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp, local)
+    os.remove(extra)
+
+    # Checksums: shift the offsets
+    extra = "{:s}.{:s}".format(extra, str(checksum))
+    if checksum is not None and os.path.isfile(extra):
+        with open(extra, "r") as fid:
+            lines = [x.split("  ") for x in fid.read().strip().split("\n")]
+        with open("{:s}.{:s}".format(local, checksum), "a") as fid:
+            for x in lines:
+                fid.write("  ".join([x[0], str(int(x[1]) + offset)] + x[2:]) + "\n")
+        os.remove(extra)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class param_matcher(object):
+
+    def __init__(self, params):
+        """param_matcher(params)
+
+        Matches the keys of index file entries against the parameter
+        definition (regular expressions) from the config file. Created
+        once and reused for all index files.
+
+        Parameters
+        ----------
+        params : dict
+            parameter configuration from the config file.
+
+        Details
+        -------
+        All expressions are combined into one single expression
+        (alternation of named groups) used to identify the entries not
+        matching any expression with one single call. Only the entries
+        matching the combined expression are tested against each
+        expression to detect ambiguous definitions. The result is stored
+        for each key (index files of different dates, runs, or files of the
+        same type contain the same keys).
+        """
+
+        from re import compile, search, error
+
+        if not isinstance(params, dict):
+            raise ValueError("params has to be a dictionary")
+
+        self.params    = params
+        self._names    = list(params.keys())
+        self._patterns = [compile(params[x]) for x in self._names]
+        self._cache    = {}
+
+        # Combined expression; not possible if the expressions use
+        # back-references or named groups.
+        self._combined = None
+        if not any([search(r"\\[1-9]|\(\?P", params[x]) for x in self._names]):
+            try:
+                self._combined = compile("|".join(["(?P<p{:d}>{:s})".format(i, params[x])
+                                                   for i,x in enumerate(self._names)]))
+            except error:
+                self._combined = None
+
+    def classify(self, key):
+        """classify(key)
+
+        Parameters
+        ----------
+        key : str
+            key of an index entry (see index_entry.key()).
+
+        Returns
+        -------
+        Tuple with the indices of the parameters matching the key (empty
+        if no parameter matches).
+        """
+        res = self._cache.get(key)
+        if res is None:
+            if self._combined is not None and not self._combined.match(key):
+                res = ()
+            else:
+                res = tuple([i for i,x in enumerate(self._patterns) if x.match(key)])
+            self._cache[key] = res
+        return res
+
+    def select(self, idx, stopifnot = False):
+        """select(idx, stopifnot = False)
+
+        Parameters
+        ----------
+        idx : index_table or list
+            index_table object or list of index_entry objects.
+        stopifnot : bool
+            stop if one (or several) parameters cannot be found in the index
+            file. If set to false these messages will simply be ignored.
+
+        Returns
+        -------
+        List of tuples (param, index_entry) in the order of the parameters.
+        Raises an exception if one entry matches several parameters or
+        one parameter matches several entries.
+        """
+
+        keys = idx.keys if isinstance(idx, index_table) else [x.key() for x in idx]
+
+        hits = {}
+        for row,key in enumerate(keys):
+            res = self.classify(key)
+            if len(res) == 0:
+                continue
+            elif len(res) > 1:
+                raise Exception("Expression \"{:s}\" matches multiple entries in the index file!".format(key))
+            elif res[0] in hits:
+                raise Exception("Expression \"{:s}\"".format(self._names[res[0]]) + \
+                                " matches multiple entries in the index file!")
+            hits[res[0]] = row
+
+        # Missing messages?
+        missing = [x for i,x in enumerate(self._names) if not i in hits]
+        if len(missing) > 0:
+            print("[!] Could not find: {:s}".format(", ".join(missing)))
+            if stopifnot: raise Exception("Some parameters not found in index file! Check config.")
+
+        return [(self._names[i], idx[hits[i]]) for i in sorted(hits)]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def get_required_bytes(idx, params, stopifnot = False, names = False):
+    """get_required_bytes(idx, params, stopifnot = False, names = False)
+
+    Searching for the entries in idx corresponding to the parameter
+    definition in params (has to match the grib2 inventory param names, e.g.,
+    "TMP:2 m surface"). Returns a list of bytes which have to be downloaded
+    with curl later on.
+
+    Parameter
+    ---------
+    idx : list
+        list of index_entry objects. The list returned by parse_index_file.
+    params : dict or param_matcher
+        parameter configuration from the config file, or a param_matcher
+        object (reused when processing several index files).
+    stopifnot : bool
+        stop if one (or several) parameters cannot be found in the index
+        file. If set to false these messages will simply be ignored.
+    names : bool
+        if True, tuples (param, bytes) are returned instead of bytes.
+
+    Returns
+    -------
+    Returns a list of bytes (for curl).
+    """
+
+    if not isinstance(params, param_matcher):
+        params = param_matcher(params)
+
+    # Return ranges to be downloaded
+    if names:
+        return [(param, x.range()) for param,x in params.select(idx, stopifnot)]
+    return [x.range() for param,x in params.select(idx, stopifnot)]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class read_config():
+
+    def __init__(self, file):
+        """read_config(file)
+
+        Reading the required configuration from the config file.
 
         Parameters
         ----------
@@ -645,7 +1450,34 @@ class read_config():
         res += "   Number of parameters:      {:d}\n".format(len(self.params))
         res += "   Forecast steps:            {:s}\n".format(", ".join([str(x) for x in self.steps]))
         res += "   Forecast runhours:         {:s}\n".format(", ".join([str(x) for x in self.runhours]))
+        res += "   Dates to process:          {:s}\n".format(
+               "all" if self.latestdates == 0 else "latest {:d}".format(self.latestdates))
         res += "   Where to store grib files: {:s}\n".format(self.gribdir)
+        if len(self.mirrors) > 1:
+            res += "   Mirrors:                   {:s}\n".format(", ".join(self.mirrors))
+            res += "   Ranges across mirrors:     {:s}{:s}\n".format(
+                   "spread" if self.mirror_spread else "failover only",
+                   "" if self.mirror_race <= 0 else ", race after {:g} seconds".format(self.mirror_race))
+        res += "   Download workers:          {:d} (max {:d} per host)\n".format(
+               self.download_workers, self.download_hostconnections)
+        res += "   Transfer engine:           {:s}\n".format("curl multi" +
+               (" (HTTP/2)" if self.curl_http2 else "") if self.curl_multi else "one curl handle per file")
+        res += "   Request rate per host:     {:s}\n".format("no limit" if self.download_rate <= 0 else
+               "{:g} per second (burst {:d})".format(self.download_rate, self.download_burst))
+        res += "   Output:                    {:s}\n".format(", ".join(
+               (["combined"] if self.download_combined else []) + (["split"] if self.download_split else [])))
+        res += "   Index file cache:          {:s}\n".format(
+               self.cache_dir if self.cache_enabled else "disabled")
+        res += "   Download ledger:           {:s}\n".format(
+               self.ledger_file if self.ledger_enabled else "disabled")
+        res += "   Metrics:                   {:s}\n".format(
+               ", ".join([x for x in [self.metrics_file, self.metrics_prometheus] if x])
+               if self.metrics_enabled else "disabled")
+        res += "   Array store:               {:s}\n".format(
+               "{:s} (blocks of {:d} runs, {:d}x{:d} tiles)".format(self.store_dir, self.store_runs,
+               self.store_tile, self.store_tile) if self.store_enabled else "disabled")
+        res += "   Station time series:       {:s}\n".format("disabled" if self.stations_file is None
+               else "{:s} ({:s}) -> {:s}".format(self.stations_file, self.stations_method, self.stations_dir))
         res += "\n   Types:\n{:s}".format("".join(["   - " + x + "\n" for x in self._types]))
         res += "\n   Parameters:\n"
         for p in self.params:
@@ -672,9 +1504,19 @@ class read_config():
         self._read_params(CNF)
         self._read_steps(CNF)
         self._read_runhours(CNF)
+        self._read_latestdates(CNF)
         self._read_gribdir(CNF)
         self._read_url(CNF)
         self._read_curl(CNF)
+        self._read_download(CNF)
+        self._read_cache(CNF)
+        self._read_ledger(CNF)
+        self._read_watch(CNF)
+        self._read_mirrors(CNF)
+        self._read_metrics(CNF)
+        self._read_store(CNF)
+        self._read_stations(CNF)
+        self._read_backfill(CNF)
         self._read_types(CNF)
 
         # If one of the required items is missing: stop
@@ -690,11 +1532,16 @@ class read_config():
             raise Exception(e)
 
     def _read_url(self, CNF):
-        # GFS archive server
+        # GFS archive server; comma separated list of mirrors (in
+        # the order of preference), 'url' is the first one.
         try:
-            self.url = CNF.get("main", "url")
+            self.mirrors = [x.strip().rstrip("/") for x in CNF.get("main", "url").split(",")]
         except Exception as e:
             raise Exception(e)
+        self.mirrors = [x for x in self.mirrors if len(x) > 0]
+        if len(self.mirrors) == 0:
+            raise Exception("misspecified option \"url\" in [main] config section.")
+        self.url = self.mirrors[0]
 
     def _read_gribdir(self, CNF):
         try:
@@ -759,124 +1606,3992 @@ class read_config():
         else:
             raise Exception("misspecified option \"runhours\" in [main] config section.")
  
+    def _read_latestdates(self, CNF):
+
+        # Default: all dates available on the server (0)
+        self.latestdates = 0
+        try:
+            self.latestdates = CNF.getint("main", "latestdates")
+        except:
+            return
+        if self.latestdates < 0:
+            raise Exception("misspecified option \"latestdates\" in [main] config section.")
+
     def _read_curl(self, CNF):
 
         # Defaults
         self.curl_timeout   = 10
         self.curl_retries   = 0
-        self.curl_sleeptime = 5
+        self.curl_sleeptime    = 5
+        self.curl_maxsleeptime = 60
+        self.curl_multi     = False
+        self.curl_http2     = True
         # Set custom values (if specified in the config file)
-        for key in ["timeout", "retries", "sleeptime"]:
+        for key in ["timeout", "retries", "sleeptime", "maxsleeptime"]:
             try:
                 setattr(self, "curl_{:s}".format(key), CNF.getint("curl", key))
             except:
                 continue
+        for key in ["multi", "http2"]:
+            try:
+                setattr(self, "curl_{:s}".format(key), CNF.getboolean("curl", key))
+            except:
+                continue
 
+    def _read_download(self, CNF):
+
+        # Defaults (one worker: serial download)
+        self.download_workers         = 1
+        self.download_hostconnections = 4
+        self.download_gap             = 0
+        self.download_multirange      = 1
+        self.download_parallel        = 1
+        self.download_split           = False
+        self.download_combined        = True
+        self.download_topup           = False
+        self.download_validate        = True
+        self.download_checksum        = None
+        self.download_rate            = 0.
+        self.download_burst           = 1
+        self.download_maxlatency      = 0.
+        # Set custom values (if specified in the config file)
+        for key in ["workers", "hostconnections", "gap", "multirange", "parallel", "burst"]:
+            try:
+                setattr(self, "download_{:s}".format(key), CNF.getint("download", key))
+            except:
+                continue
+        for key in ["rate", "maxlatency"]:
+            try:
+                setattr(self, "download_{:s}".format(key), CNF.getfloat("download", key))
+            except:
+                continue
+        if self.download_rate < 0 or self.download_burst < 1 or self.download_maxlatency < 0:
+            raise Exception("misspecified \"rate\", \"burst\", or \"maxlatency\" in [download] config section.")
+        if self.download_workers < 1 or self.download_hostconnections < 1:
+            raise Exception("\"workers\" and \"hostconnections\" in [download] have to be positive.")
+        for key in ["split", "combined", "topup", "validate"]:
+            try:
+                setattr(self, "download_{:s}".format(key), CNF.getboolean("download", key))
+            except:
+                continue
+        try:
+            self.download_checksum = CNF.get("download", "checksum").strip().lower()
+        except:
+            pass
+        if self.download_checksum in ["", "none", "false"]:
+            self.download_checksum = None
+        if self.download_checksum is not None:
+            from hashlib import algorithms_available
+            if not self.download_checksum in algorithms_available:
+                raise Exception("unknown \"checksum\" algorithm in [download] config section.")
+        if not self.download_split and not self.download_combined:
+            raise Exception("either \"split\" or \"combined\" in [download] has to be true.")
+        if self.download_gap < 0 or self.download_multirange < 1 or self.download_parallel < 1:
+            raise Exception("misspecified \"gap\", \"multirange\", or \"parallel\" in [download] config section.")
+
+    def _read_cache(self, CNF):
 
-    def _read_types(self, CNF):
-
-        self._types = []
-        for key in CNF.items("types"):
-            tmp = CNF.getboolean("types", key[0])
-            if tmp: self._types.append(key[0])
+        # Defaults
+        import os
+        self.cache_enabled = True
+        self.cache_dir     = os.path.join(getattr(self, "gribdir", ""), ".idxcache")
+        self.cache_fresh   = 600
+        self.cache_maxage  = 7
+        self.cache_maxsize = 50
+        # Set custom values (if specified in the config file)
+        try:
+            self.cache_enabled = CNF.getboolean("cache", "enabled")
+        except:
+            pass
+        try:
+            self.cache_dir = CNF.get("cache", "dir")
+        except:
+            pass
+        for key in ["fresh", "maxage", "maxsize"]:
+            try:
+                setattr(self, "cache_{:s}".format(key), CNF.getint("cache", key))
+            except:
+                continue
 
+    def _read_ledger(self, CNF):
 
-# -------------------------------------------------------------------
-# -------------------------------------------------------------------
-def download_range(config, grib, local, curlrange):
-    """download_range(config, grib, local, curlrange)
+        # Defaults
+        import os
+        self.ledger_enabled = True
+        self.ledger_file    = os.path.join(getattr(self, "gribdir", ""), ".ledger.sqlite")
+        # Set custom values (if specified in the config file)
+        try:
+            self.ledger_enabled = CNF.getboolean("ledger", "enabled")
+        except:
+            pass
+        try:
+            self.ledger_file = CNF.get("ledger", "file")
+        except:
+            pass
 
-    Actually downloading the data.
+    def _read_watch(self, CNF):
 
-    Parameters
-    ----------
-    config : read_config object
-        As returned by 'read_config()'
-    grib : str
-        URL of the grib file (source).
-    local : str
-        Name/path of the file on the local disc.
-    curlrange : list
-        Defines the byte ranges to be downloaded; as returned
-        by 'get_required_bytes()'
+        # Defaults
+        self.watch_interval = 60
+        self.watch_dirs     = 2
+        self.watch_logfile  = None
+        # Set custom values (if specified in the config file)
+        for key in ["interval", "dirs"]:
+            try:
+                setattr(self, "watch_{:s}".format(key), CNF.getint("watch", key))
+            except:
+                continue
+        try:
+            self.watch_logfile = CNF.get("watch", "logfile")
+        except:
+            pass
+        if self.watch_interval < 1 or self.watch_dirs < 1:
+            raise Exception("misspecified \"interval\" or \"dirs\" in [watch] config section.")
 
-    Return
-    ------
-    Returns boolean True on success, else False.
-    """
+    def _read_mirrors(self, CNF):
 
-    print("- Downloading data for {:s}".format(local))
-    from os import makedirs
-    from os.path import isdir, dirname
-    
-    if not isdir(dirname(local)):
+        # Defaults
+        self.mirror_spread   = False
+        self.mirror_race     = 0.
+        self.mirror_holddown = 30
+        # Set custom values (if specified in the config file)
         try:
-            makedirs(dirname(local))
-        except Exception as e:
-            raise Exception(e)
+            self.mirror_spread = CNF.getboolean("mirrors", "spread")
+        except:
+            pass
+        try:
+            self.mirror_race = CNF.getfloat("mirrors", "race")
+        except:
+            pass
+        try:
+            self.mirror_holddown = CNF.getint("mirrors", "holddown")
+        except:
+            pass
+        if self.mirror_race < 0 or self.mirror_holddown < 0:
+            raise Exception("misspecified \"race\" or \"holddown\" in [mirrors] config section.")
 
-    import pycurl
-    from datetime import datetime as dt
+    def _read_store(self, CNF):
 
-    # Openftp logfile if set
-    #if config.curl_logfile:
-    #    curllog = open(config.curl_logfile, "a")
-    #else:
-    #    curllog = None
-    curllog = open("_curl.log", "a")
+        # Defaults
+        import os
+        self.store_enabled = False
+        self.store_dir     = os.path.join(getattr(self, "gribdir", ""), "store")
+        self.store_runs    = 16
+        self.store_tile    = 32
+        self.store_level   = 1
+        # Set custom values (if specified in the config file)
+        try:
+            self.store_enabled = CNF.getboolean("store", "enabled")
+        except:
+            pass
+        try:
+            self.store_dir = CNF.get("store", "dir").strip()
+        except:
+            pass
+        for key in ["runs", "tile", "level"]:
+            try:
+                setattr(self, "store_{:s}".format(key), CNF.getint("store", key))
+            except:
+                continue
+        if self.store_runs < 1 or self.store_tile < 1 or not 0 <= self.store_level <= 9:
+            raise Exception("misspecified \"runs\", \"tile\", or \"level\" in [store] config section.")
 
-    # Start downloading the file
-    timer = dt.now()
-    c = pycurl.Curl()
-    c.setopt(pycurl.URL, grib)
+    def _read_stations(self, CNF):
+
+        # Defaults
+        import os
+        self.stations_file   = None
+        self.stations_method = "bilinear"
+        self.stations_dir    = os.path.join(getattr(self, "gribdir", ""), "stations")
+        # Set custom values (if specified in the config file)
+        for key in ["file", "method", "dir"]:
+            try:
+                setattr(self, "stations_{:s}".format(key), CNF.get("stations", key).strip())
+            except:
+                continue
+        if self.stations_file in ["", "none"]: self.stations_file = None
+        if not self.stations_method in ["bilinear", "nearest"]:
+            raise Exception("misspecified \"method\" in [stations] config section (bilinear or nearest).")
+
+    def _read_backfill(self, CNF):
+
+        # Defaults
+        import os
+        self.backfill_dir      = os.path.join(getattr(self, "gribdir", ""), ".backfill")
+        self.backfill_lease    = 60
+        self.backfill_attempts = 3
+        # Set custom values (if specified in the config file)
+        try:
+            self.backfill_dir = CNF.get("backfill", "dir").strip()
+        except:
+            pass
+        for key in ["lease", "attempts"]:
+            try:
+                setattr(self, "backfill_{:s}".format(key), CNF.getint("backfill", key))
+            except:
+                continue
+        if self.backfill_lease < 4 or self.backfill_attempts < 1:
+            raise Exception("misspecified \"lease\" or \"attempts\" in [backfill] config section.")
+
+    def _read_metrics(self, CNF):
+
+        # Defaults
+        import os
+        self.metrics_enabled    = False
+        self.metrics_file       = os.path.join(getattr(self, "gribdir", ""), ".metrics.jsonl")
+        self.metrics_prometheus = None
+        # Set custom values (if specified in the config file)
+        try:
+            self.metrics_enabled = CNF.getboolean("metrics", "enabled")
+        except:
+            pass
+        for key in ["file", "prometheus"]:
+            try:
+                setattr(self, "metrics_{:s}".format(key), CNF.get("metrics", key).strip())
+            except:
+                continue
+        if self.metrics_file in ["", "none"]: self.metrics_file = None
+        if self.metrics_prometheus in ["", "none"]: self.metrics_prometheus = None
+
+    def _read_types(self, CNF):
+
+        self._types = []
+        for key in CNF.items("types"):
+            tmp = CNF.getboolean("types", key[0])
+            if tmp: self._types.append(key[0])
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_segment(object):
+
+    __slots__ = ["start", "end", "offset", "name"]
+
+    def __init__(self, start, end, offset = 0, name = None):
+        """range_segment(start, end, offset = 0, name = None)
+
+        One byte range (one grib message) to be downloaded.
+
+        Parameters
+        ----------
+        start : int
+            first byte of the message in the remote file.
+        end : int or None
+            last byte of the message in the remote file. None if
+            open-ended (last message in the file).
+        offset : int
+            where the message starts in the local (output) file.
+        name : None or str
+            name of the parameter (config key).
+        """
+        self.start  = start
+        self.end    = end
+        self.offset = offset
+        self.name   = name
+
+    def size(self):
+        """size()
+
+        Returns
+        -------
+        Number of bytes of the segment or None if open-ended.
+        """
+        return None if self.end is None else self.end - self.start + 1
+
+    def __repr__(self):
+        end = "" if self.end is None else "{:d}".format(self.end)
+        return "{:d}-{:s}".format(self.start, end)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_plan(object):
+
+    def __init__(self, curlrange, gap = 0, multirange = 1, skip = None, parts = 1):
+        """range_plan(curlrange, gap = 0, multirange = 1, skip = None, parts = 1)
+
+        Plans the HTTP requests needed to download a set of byte ranges.
+        The ranges are sorted, (nearly) contiguous ranges are merged into
+        one span, and up to 'multirange' spans are combined into one
+        multi-range request ("Range: a-b,c-d,...").
+
+        Parameters
+        ----------
+        curlrange : list
+            list of byte ranges ("start-end"; end can be empty) as
+            returned by 'get_required_bytes()'. Can also be a list of
+            tuples (name, "start-end") (see get_required_bytes, names = True).
+        gap : int
+            two ranges are merged if there are not more than 'gap' bytes
+            between them. These bytes are downloaded but not stored
+            (over-fetched bytes).
+        multirange : int
+            maximum number of spans per request. If 1, one request per span
+            (single-range requests).
+        skip : None or set
+            indices of segments (see attribute 'segments') which have
+            already been downloaded. No requests are planned for these
+            segments; their position in the local file does not change.
+        parts : int
+            if larger than 1, spans are limited to 1/parts of the bytes to
+            be downloaded (split at message boundaries) such that the data
+            can be fetched by 'parts' parallel requests. Only if the size of
+            all messages is known (no open-ended range).
+        """
+
+        if not isinstance(gap, int) or gap < 0:
+            raise ValueError("gap has to be a non-negative integer")
+        if not isinstance(multirange, int) or multirange < 1:
+            raise ValueError("multirange has to be a positive integer")
+
+        # Convert "start-end" strings into segments, sorted by start byte.
+        # The local file contains the messages in the same order
+        # as the remote file.
+        self.segments = []
+        for rec in curlrange:
+            name, rec  = rec if isinstance(rec, tuple) else (None, rec)
+            start, end = rec.split("-")
+            self.segments.append(range_segment(int(start), None if len(end) == 0 else int(end),
+                                               name = name))
+        self.segments.sort(key = lambda x: x.start)
+        offset = 0
+        for seg in self.segments:
+            if offset is None:
+                raise ValueError("open-ended range has to be the last one")
+            seg.offset = offset
+            offset     = None if seg.end is None else offset + seg.size()
+
+        # Maximum size of a span (parallel requests)
+        todo  = [seg for k,seg in enumerate(self.segments) if skip is None or not k in skip]
+        limit = None
+        if parts > 1 and not any([x.end is None for x in todo]):
+            limit = -(-sum([x.size() for x in todo]) // parts)
+
+        # Merge segments into spans [start, end] (end None if open-ended)
+        self.spans     = []
+        self.overfetch = 0
+        for k,seg in enumerate(self.segments):
+            if skip is not None and k in skip: continue
+            if len(self.spans) > 0 and self.spans[-1][1] is not None and \
+               seg.start - self.spans[-1][1] - 1 <= gap and \
+               (limit is None or seg.end - self.spans[-1][0] + 1 <= limit):
+                self.overfetch    += max(0, seg.start - self.spans[-1][1] - 1)
+                self.spans[-1][1]  = None if seg.end is None else max(seg.end, self.spans[-1][1])
+            else:
+                self.spans.append([seg.start, seg.end])
+
+        # Combine up to 'multirange' spans per request
+        self.requests = [self.spans[i:i + multirange] for i in range(0, len(self.spans), multirange)]
+
+    def range_string(self, i):
+        """range_string(i)
+
+        Parameters
+        ----------
+        i : int
+            index of the request.
+
+        Returns
+        -------
+        Returns the byte range for curl for request 'i', e.g.,
+        "0-100" or "0-100,200-300".
+        """
+        return ",".join(["{:d}-{:s}".format(a, "" if b is None else "{:d}".format(b))
+                         for a,b in self.requests[i]])
+
+    def __len__(self):
+        return len(self.requests)
+
+    def request_segments(self, i):
+        """request_segments(i)
+
+        Parameters
+        ----------
+        i : int
+            index of the request.
+
+        Returns
+        -------
+        List with the indices of the segments within the spans of request 'i'.
+        """
+        return [k for k,seg in enumerate(self.segments) if any([a <= seg.start and
+                (b is None or seg.start <= b) for a,b in self.requests[i]])]
+
+    def key(self):
+        """key()
+
+        Returns
+        -------
+        List of [start, end, offset, name] of all segments; used to
+        identify the plan in the manifest (see range_sink).
+        """
+        return [[x.start, x.end, x.offset, x.name] for x in self.segments]
+
+    def __repr__(self):
+        return "Range plan: {:d} messages, {:d} spans, {:d} requests, {:d} bytes over-fetched".format(
+               len(self.segments), len(self.spans), len(self.requests), self.overfetch)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class message_validator(object):
+
+    __slots__ = ["size", "received", "_head", "_tail", "_hash", "_checksum", "_order"]
+
+    def __init__(self, size = None, checksum = None):
+        """message_validator(size = None, checksum = None)
+
+        Checks one grib2 message while it is downloaded (see range_sink),
+        the data are passed trough 'update' chunk by chunk. Only the first
+        16 bytes (section 0) and the last 4 bytes are kept.
+
+        Parameters
+        ----------
+        size : None or int
+            expected size of the message (byte range from the index file),
+            None if unknown (last message of the file).
+        checksum : None or str
+            name of a hash algorithm (see hashlib; e.g., "sha256") to
+            compute a checksum of the message.
+        """
+        self.size      = size
+        self._checksum = checksum
+        self.reset()
+
+    def reset(self):
+        from hashlib import new
+        self.received = 0
+        self._order   = True
+        self._head    = b""
+        self._tail    = b""
+        self._hash    = None if self._checksum is None else new(self._checksum)
+
+    def update(self, pos, data):
+        """update(pos, data)
+
+        Parameters
+        ----------
+        pos : int
+            position of 'data' within the message.
+        data : bytes
+            next chunk of the message.
+        """
+        if not pos == self.received: self._order = False
+        if len(self._head) < 16: self._head += data[:(16 - len(self._head))]
+        self._tail     = (self._tail + data[-4:])[-4:]
+        self.received += len(data)
+        if self._hash is not None: self._hash.update(data)
+
+    def check(self):
+        """check()
+
+        Returns
+        -------
+        None if the data received are one complete grib2 message ("GRIB",
+        edition 2, length as in section 0 and as expected, "7777" at the
+        end), else a string describing the problem.
+        """
+        if not self._order:
+            return "data not received in order"
+        if len(self._head) < 16 or not self._head[:4] == b"GRIB":
+            return "no grib message (\"GRIB\" missing)"
+        if not self._head[7] == 2:
+            return "grib edition {:d}, expected 2".format(self._head[7])
+        length = int.from_bytes(self._head[8:16], "big")
+        if self.size is not None and not length == self.size:
+            return "message length {:d} does not match index file ({:d} bytes)".format(length, self.size)
+        if not self.received == length:
+            return "received {:d} of {:d} bytes".format(self.received, length)
+        if not self._tail == b"7777":
+            return "end of message (\"7777\") missing"
+        return None
+
+    def hexdigest(self):
+        return None if self._hash is None else self._hash.hexdigest()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_sink(object):
+
+    def __init__(self, fid, plan, done = None, split = None, validate = False, checksum = None):
+        """range_sink(fid, plan, done = None, split = None, validate = False, checksum = None)
+
+        Writes downloaded data into the local file. The data are
+        identified by their byte position in the remote file and written
+        to the corresponding position in the local file. Data not belonging
+        to one of the segments (over-fetched bytes) are ignored.
+
+        Parameters
+        ----------
+        fid : None or file
+            local file, opened in binary mode. If None, the data are
+            only written into the parameter-based files (see 'split').
+        plan : range_plan
+            the plan used to download the data.
+        done : None, set, or dict
+            indices of the segments which have already been
+            downloaded (e.g., see read_manifest). If a dict, the values
+            are the checksums of the segments.
+        split : None or dict
+            files (opened in binary mode) for the parameter-based output.
+            Each segment is in addition written into the file
+            split[<name of the segment>] (see range_segment).
+        validate : bool
+            if True, each segment has to be one valid grib2 message
+            (see message_validator).
+        checksum : None or str
+            if set (and validate = True), the checksum of each
+            segment is computed (see message_validator).
+
+        Details
+        -------
+        Keeps track of the number of bytes received for each segment.
+        Segments are complete once all bytes have been received
+        (open-ended segments: see 'commit'); the indices of the complete
+        segments are stored in the attribute 'done'. Invalid segments are
+        not complete; the reason is stored in the attribute 'invalid'.
+        The methods can be called from different threads (e.g., the
+        transfer_engine and the thread waiting for the transfers); the
+        attribute 'lock' (reentrant) is held while writing.
+        """
+        from threading import RLock
+        self.lock     = RLock()
+        self._starts  = [x.start for x in plan.segments]
+        self._plan    = plan
+        self.done     = set() if done is None else set(done)
+        self.received = [0] * len(plan.segments)
+        self.invalid  = {}
+        self.checksums = dict(done) if isinstance(done, dict) else {}
+        self._validators = None if not validate else \
+                           [message_validator(x.size(), checksum) for x in plan.segments]
+
+        # Where to write the segments: list of (file, offset) per segment
+        self._fids    = ([] if fid is None else [fid]) + ([] if split is None else list(split.values()))
+        self._targets = []
+        for seg in plan.segments:
+            tmp = [] if fid is None else [(fid, seg.offset)]
+            if split is not None: tmp.append((split[seg.name], 0))
+            self._targets.append(tmp)
+
+    def write(self, pos, data):
+        """write(pos, data)
+
+        Parameters
+        ----------
+        pos : int
+            position of the first byte of 'data' in the remote file.
+        data : bytes
+            data to be written.
+        """
+        from bisect import bisect_right
+        segments = self._plan.segments
+        last     = pos + len(data) - 1
+        # First segment which could contain 'pos'
+        k = max(0, bisect_right(self._starts, pos) - 1)
+        with self.lock:
+            self._write(k, pos, last, data)
+
+    def _write(self, k, pos, last, data):
+        segments = self._plan.segments
+        while k < len(segments) and segments[k].start <= last:
+            seg = segments[k]
+            a   = max(pos, seg.start)
+            b   = last if seg.end is None else min(last, seg.end)
+            if b >= a and not k in self.done:
+                chunk = memoryview(data)[(a - pos):(b - pos + 1)]
+                for fid,offset in self._targets[k]:
+                    write_at(fid, chunk, offset + a - seg.start)
+                if self._validators is not None:
+                    self._validators[k].update(a - seg.start, chunk)
+                self.received[k] += b - a + 1
+                if seg.end is not None and self.received[k] >= seg.size():
+                    self._complete(k)
+            k += 1
+
+    def _complete(self, k):
+        # Segment k received; check content (if requested)
+        if self._validators is not None:
+            error = self._validators[k].check()
+            if error is not None:
+                self.invalid[k] = error
+                return
+            self.checksums[k] = self._validators[k].hexdigest()
+        self.done.add(k)
+
+    def commit(self, spans):
+        """commit(spans)
+
+        Called after a request has been completed successfully.
+        Open-ended segments (end of file) within the requested spans
+        are complete if data have been received.
+
+        Parameters
+        ----------
+        spans : list
+            list of spans [start, end] of the request.
+        """
+        with self.lock:
+            for k,seg in enumerate(self._plan.segments):
+                if seg.end is None and self.received[k] > 0 and not k in self.done and \
+                   any([a <= seg.start and b is None for a,b in spans]):
+                    self._complete(k)
+
+    def reset(self, segments = None):
+        """reset(segments = None)
+
+        Called after a failed request. Data received for incomplete
+        segments will be downloaded again.
+
+        Parameters
+        ----------
+        segments : None or list
+            indices of the segments to be reset (e.g., the segments
+            of one request, see range_plan.request_segments); all if None.
+        """
+        with self.lock:
+            for k in range(len(self.received)) if segments is None else segments:
+                if not k in self.done:
+                    self.received[k] = 0
+                    if self._validators is not None: self._validators[k].reset()
+                self.invalid.pop(k, None)
+
+    def complete(self):
+        """complete()
+
+        Returns
+        -------
+        True if all segments have been downloaded, else False.
+        """
+        return len(self.done) == len(self._plan.segments)
+
+    def write_manifest(self, file, url):
+        """write_manifest(file, url)
+
+        Writes the list of complete segments into a manifest file
+        (json) used to resume the download (see read_manifest). The
+        local files are flushed to disc first.
+
+        Parameters
+        ----------
+        file : str
+            name of the manifest file.
+        url : str
+            URL of the remote file.
+        """
+        import os
+        import json
+        with self.lock:
+            for fid in self._fids:
+                fid.flush()
+                os.fsync(fid.fileno())
+            data = {"url": url, "segments": self._plan.key(), "done": sorted(self.done),
+                    "checksums": [self.checksums.get(k) for k in sorted(self.done)]}
+        with open(file + ".tmp", "w") as fid: json.dump(data, fid)
+        os.replace(file + ".tmp", file)
+
+    @staticmethod
+    def read_manifest(file, url, plan):
+        """read_manifest(file, url, plan)
+
+        Parameters
+        ----------
+        file : str
+            name of the manifest file.
+        url : str
+            URL of the remote file.
+        plan : range_plan
+            the plan used to download the data.
+
+        Returns
+        -------
+        Dictionary with the indices of the segments already downloaded
+        (keys) and their checksums (values; None if not computed), or None
+        if there is no (matching) manifest file.
+        """
+        import os
+        import json
+        if not os.path.isfile(file): return None
+        try:
+            with open(file, "r") as fid: data = json.load(fid)
+        except:
+            return None
+        if not data.get("url") == url or not data.get("segments") == plan.key():
+            return None
+        return dict(zip(data["done"], data.get("checksums", [None] * len(data["done"]))))
+
+    def write_checksums(self, file, filesize):
+        """write_checksums(file, filesize)
+
+        Writes the checksums of the segments into 'file', one line
+        per segment: "<checksum>  <offset in the local file>  <size>  <name>".
+        'filesize' is the size of the local file (size of the last message
+        if open-ended).
+        """
+        import os
+        lines = []
+        for k,seg in enumerate(self._plan.segments):
+            lines.append("{:s}  {:d}  {:d}  {:s}".format(str(self.checksums.get(k)), seg.offset,
+                         filesize - seg.offset if seg.end is None else seg.size(), str(seg.name)))
+        with open(file + ".tmp", "w") as fid: fid.write("\n".join(lines) + "\n")
+        os.replace(file + ".tmp", file)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_response(object):
+
+    def __init__(self, sink, cancel = None, full = None):
+        """range_response(sink, cancel = None, full = None)
+
+        Handles the response of one (multi-)range request. Used as pycurl
+        HEADERFUNCTION and WRITEFUNCTION. Depending on the response the
+        body is the full file (status 200), one single range (status 206,
+        Content-Range header) or several ranges (status 206,
+        multipart/byteranges). The data are forwarded to the sink along
+        with their position in the remote file.
+
+        Parameters
+        ----------
+        sink : range_sink object
+            where to write the data.
+        cancel : None or function
+            if set and returning True, the transfer is aborted.
+        full : None or function
+            called once if the server ignores the range and sends the
+            whole file (status 200). If returning False, the transfer is
+            aborted before writing anything and 'dropped' is set to True.
+        """
+        self._sink     = sink
+        self._cancel   = cancel
+        self._full     = full
+        self.dropped   = False
+        self.status    = None
+        self._headers  = {}
+        self._pos      = None
+        self._boundary = None
+        self._buf      = bytearray()
+        self._left     = 0
+
+    def header(self, line):
+        """header(line)
+
+        pycurl HEADERFUNCTION: called once per header line.
+        """
+        from re import match
+        line = line.decode("iso-8859-1").strip()
+        tmp = match(r"^HTTP/\S+\s+(\d+)", line)
+        if tmp:
+            # New response (e.g., after '100 Continue'); reset
+            self.status   = int(tmp.group(1))
+            self._headers = {}
+        elif ":" in line:
+            key, val = line.split(":", 1)
+            self._headers[key.strip().lower()] = val.strip()
+
+    @property
+    def retry_after(self):
+        """retry_after
+
+        Seconds to wait as sent by the server (Retry-After header),
+        None if not set.
+        """
+        return rate_limiter.retry_after(self._headers.get("retry-after"))
+
+    def _setup(self):
+        from re import match, search
+        ctype  = self._headers.get("content-type", "")
+        crange = match(r"^bytes\s+(\d+)-", self._headers.get("content-range", ""))
+        if self.status == 206 and ctype.startswith("multipart/byteranges"):
+            tmp = search(r"boundary=\"?([^\";]+)\"?", ctype)
+            if not tmp:
+                raise Exception("multipart/byteranges response without boundary")
+            self._boundary = tmp.group(1)
+        elif self.status == 206 and crange:
+            self._pos = int(crange.group(1))
+        elif self.status == 200:
+            self._pos = 0
+
+    def write(self, data):
+        """write(data)
+
+        pycurl WRITEFUNCTION: called with chunks of the body.
+        """
+        if self._cancel is not None and self._cancel():
+            return 0 # Aborts the transfer
+        if self._pos is None and self._boundary is None:
+            self._setup()
+            if self.status == 200 and self._full is not None and not self._full():
+                self.dropped = True
+        if self.dropped:
+            return 0 # Aborts the transfer
+        if self._boundary is not None:
+            self._multipart(data)
+        elif self._pos is not None:
+            self._sink.write(self._pos, data)
+            self._pos += len(data)
+        # Else: error response, do not write anything
+
+    def _multipart(self, data):
+        from re import search, IGNORECASE
+        self._buf += data
+        while len(self._buf) > 0:
+            # Inside a body part: forward data to sink
+            if self._left > 0:
+                n = min(self._left, len(self._buf))
+                self._sink.write(self._pos, bytes(self._buf[:n]))
+                self._pos  += n
+                self._left -= n
+                del self._buf[:n]
+                continue
+            # Else searching for the next part header ("--boundary ... \r\n\r\n")
+            i = self._buf.find(b"\r\n\r\n")
+            if i < 0: break
+            head = self._buf[:i].decode("iso-8859-1")
+            del self._buf[:(i + 4)]
+            tmp = search(r"content-range:\s*bytes\s+(\d+)-(\d+)", head, IGNORECASE)
+            if not tmp and "--{:s}--".format(self._boundary) in head:
+                self._buf = bytearray() # Closing boundary, done
+                break
+            elif not tmp:
+                raise Exception("multipart/byteranges part without Content-Range")
+            self._pos  = int(tmp.group(1))
+            self._left = int(tmp.group(2)) - self._pos + 1
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_error(Exception):
+
+    # Curl errors worth a retry: could not resolve/connect, partial file,
+    # timeout, ssl connect error, got nothing, send/recv error, http2 error.
+    CURL_RETRYABLE = [6, 7, 16, 18, 28, 35, 52, 55, 56, 92]
+
+    def __init__(self, message, retryable = False, retry_after = None, status = None):
+        """download_error(message, retryable = False, retry_after = None, status = None)
+
+        Exception raised by download_range.
+
+        Parameters
+        ----------
+        message : str
+            error message.
+        retryable : bool
+            True if the request should be retried (e.g., timeouts,
+            server errors), False if not (e.g., file not found).
+        retry_after : None or float
+            seconds to wait before retrying as requested by the server.
+        status : None or int
+            HTTP status code of the response (if any).
+        """
+        Exception.__init__(self, message)
+        self.retryable   = retryable
+        self.retry_after = retry_after
+        self.status      = status
+
+    @staticmethod
+    def from_http(status, url, retry_after = None):
+        """from_http(status, url, retry_after = None)
+
+        Returns a download_error for a HTTP status code. Server errors
+        (5xx), 408 (timeout) and 429 (too many requests) are retryable.
+        """
+        return download_error("HTTP error {:d} for {:s}".format(status, url),
+                              status >= 500 or status in [408, 429], retry_after, status)
+
+    @staticmethod
+    def from_curl(e):
+        """from_curl(e)
+
+        Returns a download_error for a pycurl.error.
+        """
+        code = e.args[0] if len(e.args) > 0 else -1
+        return download_error("curl error {:d}: {:s}".format(code, str(e.args[-1])),
+                              code in download_error.CURL_RETRYABLE)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_gate(object):
+
+    def __init__(self, sink):
+        """range_gate(sink)
+
+        Forwards the data of one request to the sink (see range_sink)
+        until closed; used to stop a transfer from writing once another
+        one (e.g., on a second mirror) has taken over.
+        """
+        self._sink  = sink
+        self.closed = False
+
+    def write(self, pos, data):
+        with self._sink.lock:
+            if not self.closed: self._sink.write(pos, data)
+
+    def close(self):
+        with self._sink.lock:
+            self.closed = True
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_buffer(object):
+
+    # Data kept in memory up to this size (bytes), written to a
+    # temporary file beyond.
+    MEMORY = 16 * 1024**2
+
+    def __init__(self):
+        """range_buffer()
+
+        Keeps the data of one request (used for requests racing against
+        another request for the same ranges) in a spooled temporary file;
+        written to the sink by 'replay' if the request wins. Data written
+        after 'close' are ignored.
+        """
+        from threading import Lock
+        from tempfile import SpooledTemporaryFile
+        self._lock   = Lock()
+        self._file   = SpooledTemporaryFile(max_size = range_buffer.MEMORY)
+        self._chunks = []
+
+    def write(self, pos, data):
+        with self._lock:
+            if self._file is None: return
+            self._chunks.append((pos, len(data)))
+            self._file.write(data)
+
+    def replay(self, sink, chunksize = 1024**2):
+        with self._lock:
+            self._file.seek(0)
+            for pos,size in self._chunks:
+                for k in range(0, size, chunksize):
+                    sink.write(pos + k, self._file.read(min(chunksize, size - k)))
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None: self._file.close()
+            self._file, self._chunks = None, []
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class range_fetcher(object):
+
+    def __init__(self, config, grib, sink, limiter, engine = None, curl = None,
+                 metrics = None, attempt = 0, cancel = None):
+        """range_fetcher(config, grib, sink, limiter, engine = None, curl = None, metrics = None, attempt = 0, cancel = None)
+
+        Performs the requests of a range_plan (see 'run'), used by
+        download_range. If 'limiter' is a host_limiter, failed requests
+        are sent to the next mirror. With a transfer engine, the requests
+        can be spread across the mirrors ('config.mirror_spread') and a
+        request not done after 'config.mirror_race' seconds is started on
+        a second mirror as well; the first one to finish wins. If the
+        server ignores the ranges and sends the whole file (status 200),
+        the first such request takes over; the other requests are stopped.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        grib : str
+            URL of the grib file.
+        sink : range_sink object
+            where to write the data.
+        limiter : rate_limiter or host_limiter object
+            used to limit the requests to the server(s).
+        engine : None or transfer_engine object
+            used for the requests if set, else 'curl'.
+        curl : None or pycurl.Curl object
+            used for the requests (one after another) if no engine is set.
+        metrics : None or metrics_record object
+            if set, the requests are recorded.
+        attempt : int
+            attempt (see download_range), used for the metrics.
+        cancel : None or function
+            if set and returning True, the transfers are stopped and
+            'run' raises a download_error (see download_range).
+        """
+        from queue import Queue
+        self.config  = config
+        self.cancel  = cancel
+        self.grib    = grib
+        self.sink    = sink
+        self.engine  = engine
+        self.curl    = curl
+        self.metrics = metrics
+        self.attempt = attempt
+        self.hosts   = limiter if isinstance(limiter, host_limiter) else None
+        self.limiter = limiter
+        self.spread  = engine is not None and self.hosts is not None and \
+                       len(self.hosts.mirrors) > 1 and config.mirror_spread
+        self.race    = engine is not None and self.hosts is not None and \
+                       len(self.hosts.mirrors) > 1 and config.mirror_race > 0
+        self.parallel = config.download_parallel if engine is not None else 1
+        self._notify = Queue()
+        self._full   = None
+        self._gates  = []
+        self._dropped = set()
+
+    def concurrency(self):
+        """concurrency()
+
+        Returns
+        -------
+        Number of requests running at the same time (plus racing requests):
+        'config.download_parallel' (with a transfer engine) or the number
+        of mirrors if spreading, whichever is larger.
+        """
+        return max(len(self.hosts.mirrors) if self.spread else 1, self.parallel)
+
+    def _limiter(self, url):
+        return self.limiter if self.hosts is None else self.hosts(url)
+
+    def _submit(self, url, target, rng, full = None):
+        # Starts one request, returns a transfer object
+        import pycurl
+        response = range_response(target, self.cancel, full)
+        if self.engine is not None:
+            job = self.engine.submit(url, response.header, response.write, range = rng,
+                                     notify = self._notify)
+        else:
+            # One curl handle, one request after another
+            c   = self.curl
+            job = transfer(url, response.header, response.write, [], self._notify)
+            c.setopt(pycurl.URL, url)
+            c.setopt(pycurl.RANGE, rng)
+            c.setopt(pycurl.HEADERFUNCTION, response.header)
+            c.setopt(pycurl.WRITEFUNCTION,  response.write)
+            try:
+                c.perform()
+                error = None
+            except pycurl.error as e:
+                error = e
+            job.finish(error, None if self.metrics is None else download_metrics.curl_info(c))
+        job.response = response
+        return job
+
+    def _start(self, plan, i, url, race = False):
+        # Starts request 'i' on 'url' (racing: data buffered, given up
+        # if the mirror sends the whole file)
+        from time import monotonic
+        target = range_buffer() if race else range_gate(self.sink)
+        if not race: self._gates.append((i, target))
+        if race:
+            full = lambda: False
+        else:
+            full = None if len(plan) == 1 else lambda: self._claim(plan, i)
+        job = self._submit(url, target, plan.range_string(i), full)
+        job.request, job.race, job.target, job.started = i, race, target, monotonic()
+        return job
+
+    def _claim(self, plan, i):
+        # Called (transfer thread) if request 'i' receives the whole file
+        # (status 200) instead of its ranges. The first one takes over:
+        # the other requests stop writing (see _takeover), their data are
+        # covered by the whole file. Returns False for the other requests.
+        with self.sink.lock:
+            if self._full is None:
+                print("Server sends the whole file for request {:d}, stopping the other requests".format(i + 1))
+                self._full = i
+                for k,gate in self._gates:
+                    if k == i or gate.closed: continue
+                    gate.close()
+                    self.sink.reset(plan.request_segments(k))
+            return self._full == i
+
+    def _takeover(self, running):
+        # One request receives the whole file (see _claim): cancel the
+        # requests for other ranges, downloaded again if it fails.
+        if self._full is None: return
+        for job in running:
+            if job.request == self._full or job.cancelled: continue
+            job.cancelled = True
+            if self.engine is not None: self.engine.cancel(job)
+            self._dropped.add(job.request)
+
+    def _choose(self, i, tried, running):
+        # Mirror for request 'i': the healthy one with the fewest running
+        # requests (spread), else the first healthy one.
+        if self.hosts is None: return self.grib
+        urls = self.hosts.candidates(self.grib, tried[i])
+        if len(urls) == 0: return None
+        if not self.spread: return urls[0]
+        busy = [self.hosts.mirror(x.url) for x in running]
+        return min(urls, key = lambda x: busy.count(self.hosts.mirror(x)))
+
+    def run(self, plan, manifest = None):
+        """run(plan, manifest = None)
+
+        Performs all requests of 'plan'.
+
+        Parameters
+        ----------
+        plan : range_plan object
+            the requests to be made.
+        manifest : None or str
+            if set, the manifest is written after each request (see
+            range_sink.write_manifest).
+
+        Raises a download_error if a request failed on all mirrors (or
+        if the data are invalid).
+        """
+        from time import monotonic
+        from queue import Empty
+        pending = list(range(len(plan)))
+        tried   = dict([(i, []) for i in pending])
+        running = []
+        raced   = set()
+        self._full, self._gates, self._dropped = None, [], set()
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                # Start requests (one at a time unless spreading); none
+                # while one request receives the whole file.
+                self._takeover(running)
+                while self._full is None and len(pending) > 0 and \
+                      len([x for x in running if not x.race]) < self.concurrency():
+                    i   = pending[0]
+                    url = self._choose(i, tried, running)
+                    if not self._limiter(url).acquire(wait = len(running) == 0): break
+                    pending.pop(0)
+                    running.append(self._start(plan, i, url))
+
+                # Racing: start requests taking too long on another mirror
+                timeout = None
+                if self.race:
+                    now = monotonic()
+                    # At most one race per request, only on healthy mirrors
+                    for job in [x for x in running if not (x.race or x.cancelled)]:
+                        if job.request in raced or self._full not in [None, job.request]: continue
+                        wait = job.started + self.config.mirror_race - now
+                        urls = self.hosts.candidates(self.grib, tried[job.request] +
+                                                     [self.hosts.mirror(job.url)], healthy = True)
+                        if wait > 0:
+                            timeout = wait if timeout is None else min(timeout, wait)
+                        elif len(urls) > 0 and self._limiter(urls[0]).acquire(wait = False):
+                            print("Request {:d} slow, racing on {:s}".format(job.request + 1,
+                                  self.hosts.mirror(urls[0])))
+                            running.append(self._start(plan, job.request, urls[0], race = True))
+                            raced.add(job.request)
+                        elif len(urls) > 0:
+                            timeout = 0.1 if timeout is None else min(timeout, 0.1)
+
+                # Cancelled: stop the transfers (see finally)
+                if self.cancel is not None:
+                    if self.cancel():
+                        raise download_error("download of {:s} cancelled".format(self.grib), False)
+                    timeout = 1. if timeout is None else min(timeout, 1.)
+
+                try:
+                    job = self._notify.get(timeout = timeout)
+                except Empty:
+                    continue
+                running.remove(job)
+                self._takeover([job] + running)
+                try:
+                    self._done(plan, job, running, pending, tried, manifest)
+                finally:
+                    if job.race: job.target.close()
+        finally:
+            # Stop the transfers still running (error)
+            for job in running:
+                job.target.close()
+                job.cancelled = True
+                if self.engine is not None: self.engine.cancel(job)
+            while len(running) > 0:
+                job = self._notify.get()
+                running.remove(job)
+                self._release(job)
+
+    def _release(self, job):
+        # Releases the slot of a finished request; cancelled and
+        # dropped requests (see range_response) do not count as errors.
+        from time import monotonic
+        status = 200 if job.cancelled or job.response.dropped else None if job.error is not None else job.response.status
+        self._limiter(job.url).release(status, monotonic() - job.started, job.response.retry_after)
+
+    def _done(self, plan, job, running, pending, tried, manifest):
+        # Handles a finished request
+        i, response = job.request, job.response
+        status = None if job.error is not None else response.status
+        self._release(job)
+        if job.cancelled: return
+        if response.dropped:
+            # Whole file sent: racing requests are given up, the others
+            # are covered by the request receiving the whole file (see _claim)
+            if not job.race:
+                if self._full is None: pending.append(i)
+                else: self._dropped.add(i)
+            return
+        if self.metrics is not None:
+            self.metrics.request(0 if status is None else status, job.info,
+                                 len(plan.requests[i]), self.attempt,
+                                 None if job.error is None else str(job.error))
+        others = [x for x in running if x.request == i]
+        if job.error is not None:
+            error = download_error.from_curl(job.error)
+        elif not status in [200, 206]:
+            error = download_error.from_http(status, job.url, response.retry_after)
+        else:
+            error = None
+        if self.hosts is not None:
+            self.hosts.report(job.url, error is None or not (error.retryable or error.status == 404))
+
+        if error is not None:
+            # Do not use the failed mirror again for these ranges
+            if self.hosts is not None: tried[i].append(self.hosts.mirror(job.url))
+            # Another request for the same ranges still running
+            if len(others) > 0: return
+            if self._full == i:
+                # Whole file failed: the stopped requests have to be made again
+                self._full = None
+                self.sink.reset()
+                pending.extend(sorted(self._dropped))
+                self._dropped = set()
+            else:
+                self.sink.reset(plan.request_segments(i))
+            if self.hosts is None or not (error.retryable or error.status == 404): raise error
+            if len(self.hosts.candidates(self.grib, tried[i])) == 0: raise error
+            print("Request {:d} failed on {:s}, trying next mirror".format(i + 1,
+                  self.hosts.mirror(job.url)))
+            pending.insert(0, i)
+            return
+
+        # Success: stop the other requests for the same ranges (all
+        # if the whole file has been received)
+        whole = self._full == i and status == 200
+        for other in (running if whole else others):
+            other.target.close()
+            other.cancelled = True
+            if self.engine is not None: self.engine.cancel(other)
+        if self._full == i and not whole:
+            # Ranges received from another mirror; make the stopped requests again
+            self._full = None
+            self.sink.reset([k for k in range(len(plan.segments)) if not k in plan.request_segments(i)])
+            pending.extend(sorted(self._dropped))
+            self._dropped = set()
+        if job.race:
+            self.sink.reset(plan.request_segments(i))
+            job.target.replay(self.sink)
+        if whole:
+            del pending[:]
+            self._dropped = set()
+            for rng in plan.requests: self.sink.commit(rng)
+        else:
+            self.sink.commit(plan.requests[i])
+        if manifest is not None: self.sink.write_manifest(manifest, self.grib)
+        if len(self.sink.invalid) > 0:
+            raise download_error("invalid grib2 data for {:s}: {:s}".format(self.grib,
+                  "; ".join(["message {:d}: {:s}".format(k + 1, x) for k,x in sorted(self.sink.invalid.items())])),
+                  True)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def write_at(fid, data, offset):
+    """write_at(fid, data, offset)
+
+    Writes data at a given position of a file without moving the file
+    position (os.pwrite; seek and write if not available). Used to write
+    the data of parallel requests into the same (preallocated) file.
+
+    Parameters
+    ----------
+    fid : file
+        file opened in binary mode.
+    data : bytes or memoryview
+        data to be written.
+    offset : int
+        position in the file.
+    """
+    import os
+    if not hasattr(os, "pwrite"):
+        fid.seek(offset)
+        fid.write(data)
+        return
+    fid.flush()
+    data = memoryview(data)
+    while len(data) > 0:
+        n       = os.pwrite(fid.fileno(), data, offset)
+        data    = data[n:]
+        offset += n
+
+
+def preallocate(fid, size):
+    """preallocate(fid, size)
+
+    Reserves the disc space for a file of 'size' bytes (posix_fallocate)
+    such that the data of parallel requests can be written in any order
+    without fragmenting the file. Falls back to extending the file
+    (sparse) if not supported by the system or file system.
+
+    Parameters
+    ----------
+    fid : file
+        file opened in binary mode (writable).
+    size : int
+        final size of the file in bytes.
+    """
+    import os
+    if size <= 0: return
+    fid.flush()
+    try:
+        os.posix_fallocate(fid.fileno(), 0, size)
+    except (AttributeError, OSError):
+        if os.fstat(fid.fileno()).st_size < size:
+            os.ftruncate(fid.fileno(), size)
+
+
+def resolve_curlrange(config, grib, curlrange, limiter = None, engine = None):
+    """resolve_curlrange(config, grib, curlrange, limiter = None, engine = None)
+
+    The last message of a grib file has no end byte in the index file
+    (open-ended range "<start>-"). Asks the server for the size of the
+    file (HEAD request, Content-Length) to close the open-ended range such
+    that the size of all messages is known (required to split the download
+    into parallel requests and to preallocate the local file).
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    grib : str
+        URL of the grib file.
+    curlrange : list
+        as returned by 'get_required_bytes()'.
+    limiter : None, rate_limiter, or host_limiter object
+        see request_url.
+    engine : None or transfer_engine object
+        see request_url.
+
+    Returns
+    -------
+    List of the same form as 'curlrange'. Unchanged if there is no
+    open-ended range or if the size of the file is unknown.
+    """
+    def parse(rec):
+        return rec if isinstance(rec, tuple) else (None, rec)
+    if not any([parse(x)[1].endswith("-") for x in curlrange]):
+        return curlrange
+
+    from urllib.request import Request
+    try:
+        res, data = request_url(Request(grib, method = "HEAD"), limiter,
+                                config.curl_timeout, engine)
+        size = int(res.headers.get("Content-Length"))
+    except Exception as e:
+        print("Size of {:s} unknown ({:s}), last message open-ended".format(grib, str(e)))
+        return curlrange
+
+    res = []
+    for rec in curlrange:
+        name, tmp = parse(rec)
+        if tmp.endswith("-"):
+            if int(tmp[:-1]) >= size: return curlrange
+            tmp = "{:s}{:d}".format(tmp, size - 1)
+        res.append(tmp if name is None else (name, tmp))
+    return res
+
+
+class range_source(object):
+
+    def __init__(self, file, curlrange):
+        """range_source(file, curlrange)
+
+        Local copy of the byte ranges of a remote file, as written by
+        download_range (messages in the same order as in the remote file).
+        Used as the source for other outputs of the same remote file
+        instead of downloading the data again (see batch_gribfiles).
+
+        Parameters
+        ----------
+        file : str
+            name of the local file.
+        curlrange : list
+            the byte ranges the file has been downloaded with.
+        """
+        self.file      = file
+        self._segments = dict([(x.start, x) for x in range_plan(curlrange).segments])
+
+    def covers(self, curlrange):
+        """covers(curlrange)
+
+        Returns
+        -------
+        True if all byte ranges of 'curlrange' are in the local file.
+        """
+        return all([x.start in self._segments for x in range_plan(curlrange).segments])
+
+    def replay(self, plan, sink, chunksize = 1048576):
+        """replay(plan, sink, chunksize = 1048576)
+
+        Writes the segments of 'plan' not yet received into 'sink'
+        (see range_sink), as if downloaded from the remote file.
+        """
+        with open(self.file, "rb") as fid:
+            for k,seg in enumerate(plan.segments):
+                if k in sink.done: continue
+                src = self._segments.get(seg.start)
+                if src is None:
+                    raise download_error("message {:s} not in {:s}".format(str(seg), self.file), False)
+                size = seg.size() if src.size() is None else src.size()
+                fid.seek(src.offset)
+                pos = seg.start
+                while size is None or pos - seg.start < size:
+                    data = fid.read(chunksize if size is None else min(chunksize, size - pos + seg.start))
+                    if len(data) == 0: break
+                    sink.write(pos, data)
+                    pos += len(data)
+        sink.commit(plan.spans)
+
+
+def download_range(config, grib, local, curlrange, split = None, limiter = None, metrics = None,
+                   engine = None, source = None, cancel = None):
+    """download_range(config, grib, local, curlrange, split = None, limiter = None, metrics = None, engine = None, source = None, cancel = None)
+
+    Actually downloading the data.
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    grib : str
+        URL of the grib file (source).
+    local : str
+        Name/path of the file on the local disc.
+    curlrange : list
+        Defines the byte ranges to be downloaded; as returned
+        by 'get_required_bytes()'. Adjacent ranges are merged
+        and combined into multi-range requests (see range_plan).
+        The messages are stored in the same order as in the
+        remote file.
+    split : None or dict
+        names of the local parameter-based files. If set, each message
+        is in addition written into its own file (dictionary key is the
+        parameter name, see get_required_bytes with names = True). If
+        'config.download_combined' is False, 'local' is not written.
+    limiter : None, rate_limiter, or host_limiter object
+        if set, used to limit the requests to the server. If a host_limiter,
+        failed requests are sent to the next mirror; with a transfer engine
+        the requests can be spread across the mirrors or raced on a second
+        mirror (see range_fetcher).
+    metrics : None or metrics_record object
+        if set, each request (pycurl timings, bytes, ranges, attempt)
+        is recorded (see download_metrics).
+    engine : None or transfer_engine object
+        if set, the requests are made through the transfer engine (shared
+        connections and handles), else a new curl handle is used. Required
+        to fetch the ranges of a file in parallel ('config.download_parallel').
+    source : None or range_source object
+        if set, the data are taken from this local copy of the remote
+        file; no request is made.
+    cancel : None or function
+        called while downloading; if it returns True the download is
+        stopped, the temporary files are left to whoever took over (no
+        manifest written, not renamed), and False is returned.
+
+    Return
+    ------
+    Returns boolean True on success, else False.
+
+    Details
+    -------
+    The data are written into "<local>.tmp" (and "<split file>.tmp")
+    and the files are renamed once all messages have been downloaded.
+    If 'config.download_validate' is set, each message is checked while
+    downloading (see message_validator); invalid data are downloaded again
+    (retryable error). If 'config.download_checksum' is set, the checksums
+    of the messages are written into "<local>.<checksum>". The messages downloaded so
+    far are listed in the manifest "<local>.tmp.json". Failed downloads
+    are resumed (in the same or a later run), only the missing messages
+    are downloaded again. Retryable errors (timeouts, server errors) are
+    retried up to 'config.curl_retries' times with exponential backoff
+    or after the time requested by the server (Retry-After).
+    If 'config.download_parallel' is larger than 1, the byte ranges are
+    split into (up to) as many requests running at the same time; the
+    output files are preallocated and each request writes its data
+    directly to the final position (see resolve_curlrange, write_at).
+    """
+
+    print("- Downloading data for {:s}".format(local))
+    import os
+    # Several workers may create the same (date) directory
+    os.makedirs(os.path.dirname(local), exist_ok = True)
+
+    import pycurl
+    from time import sleep
+    from random import uniform
+
+    # Planning the requests. If a manifest of a previous (failed)
+    # attempt exists: resume the download.
+    if engine is not None and config.download_parallel > 1 and source is None:
+        curlrange = resolve_curlrange(config, grib, curlrange, limiter, engine)
+    tmpfile  = "{:s}.tmp".format(local)
+    manifest = "{:s}.json".format(tmpfile)
+    plan     = range_plan(curlrange, config.download_gap, config.download_multirange)
+    done     = range_sink.read_manifest(manifest, grib, plan)
+    if done is not None:
+        print("Resuming download, {:d} of {:d} messages already downloaded".format(
+              len(done), len(plan.segments)))
+    combined = split is None or config.download_combined
+    tmpfiles = ([tmpfile] if combined else []) + \
+               ([] if split is None else ["{:s}.tmp".format(x) for x in split.values()])
+    if done is not None and not all([os.path.isfile(x) for x in tmpfiles]):
+        done = None
+    mode = "wb" if done is None else "r+b"
+    fp   = open(tmpfile, mode) if combined else None
+    fps  = None if split is None else \
+           dict([(x, open("{:s}.tmp".format(split[x]), mode)) for x in split])
+    # Reserve the space if the size of all messages is known
+    if not plan.segments[-1].end is None:
+        if fp is not None:
+            preallocate(fp, plan.segments[-1].offset + plan.segments[-1].size())
+        if fps is not None:
+            for seg in plan.segments: preallocate(fps[seg.name], seg.size())
+    sink = range_sink(fp, plan, done, fps, config.download_validate, config.download_checksum)
+    if limiter is None: limiter = rate_limiter()
+
+    # Start downloading the file
+    c = None
+    if engine is None and source is None:
+       c = pycurl.Curl()
+       # Progress bar only makes sense if one file is downloaded at a time
+       c.setopt(c.NOPROGRESS, 0 if config.download_workers == 1 else 1)
+       if config.curl_timeout:
+          print("Curl timeout is {:d}".format(config.curl_timeout))
+          c.setopt(pycurl.CONNECTTIMEOUT, config.curl_timeout)
+       c.setopt(pycurl.FOLLOWLOCATION, 0)
+
+    attempt = 0
+    success = False
+    # Download with retries if set
+    while True:
+       print("Retries left: {:d}".format(config.curl_retries - attempt))
+       try:
+          fetcher = range_fetcher(config, grib, sink, limiter, engine, c, metrics, attempt, cancel)
+          # Only request the segments not yet downloaded; at least one
+          # request per mirror if spreading the requests across mirrors
+          # and split into 'config.download_parallel' parts.
+          plan = range_plan(curlrange, config.download_gap, config.download_multirange, sink.done,
+                            fetcher.parallel)
+          if len(plan) < fetcher.concurrency() and len(plan.spans) > len(plan):
+             plan = range_plan(curlrange, config.download_gap,
+                               max(1, len(plan.spans) // fetcher.concurrency()), sink.done,
+                               fetcher.concurrency())
+          print(plan)
+          if source is not None:
+             print("Copying {:s} -> {:s}".format(source.file, tmpfile))
+             source.replay(plan, sink)
+          else:
+             print("Downloading -> {:s}".format(tmpfile))
+             fetcher.run(plan, manifest)
+
+          if not sink.complete():
+             raise download_error("incomplete response for {:s}".format(grib), True)
 
-    retries_left = config.curl_retries
-    success = False
-    # Download with retries if set
-    while retries_left >= 0:
-       print("Retries left: {:d}".format(retries_left))
-       try:
-          fp = open("{:s}.tmp".format(local), "wb")
-          c.setopt(pycurl.WRITEDATA, fp)
-          c.setopt(c.NOPROGRESS, 0)
-          if config.curl_timeout:
-             print("Curl timeout is {:d}".format(config.curl_timeout))
-             c.setopt(pycurl.CONNECTTIMEOUT, config.curl_timeout)
-
-          c.setopt(pycurl.FOLLOWLOCATION, 0)
-          print("Downloading -> {:s}.tmp".format(local))
-
-          for i in range(0, len(curlrange)):
-             c.setopt(c.RANGE, curlrange[i])
-             c.perform()
-
-          if curllog:
-             now    = dt.now()
-             nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
-             curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format(nowstr,
-                int((now-timer).seconds), "success", local))
-          fp.close()
           success = True
           break
        except Exception as e:
           print("Problems with download")
           print(e)
-          retries_left -= 1
-          if curllog:
-             now    = dt.now()
-             nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
-             curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format( nowstr,
-                int((now - timer).seconds),"ftp-error-{:d}".format(e[0]), local))
-          if config.curl_sleeptime:
-             log.info("Sleeping {:.0f} seconds and retry download".format(config.curl_sleeptime))
-             time.sleep(config.curl_sleeptime)
-
-    # Rename the file (after success)
+          if cancel is not None and cancel(): break
+          # Keep track of the messages downloaded so far
+          sink.reset()
+          sink.write_manifest(manifest, grib)
+          retryable = e.retryable if isinstance(e, download_error) else False
+          if not retryable or attempt >= config.curl_retries:
+             break
+          # Exponential backoff with jitter
+          wait = min(config.curl_maxsleeptime, config.curl_sleeptime * 2**attempt)
+          wait = uniform(wait / 2., wait)
+          if e.retry_after is not None:
+             wait = min(config.curl_maxsleeptime, e.retry_after)
+          attempt += 1
+          if wait > 0:
+             print("Sleeping {:.1f} seconds and retry download".format(wait))
+             sleep(wait)
+
+    for fid in [fp] + ([] if fps is None else list(fps.values())):
+        if fid is not None: fid.close()
+    if c is not None: c.close()
+
+    # Rename the file(s) (after success)
+    if success and cancel is not None and cancel():
+        print("Download of {:s} cancelled".format(grib))
+        success = False
+    if success:
+        from shutil import move
+        if fp is not None: move(tmpfile, local)
+        if fps is not None:
+            for x in split: move("{:s}.tmp".format(split[x]), split[x])
+        if os.path.isfile(manifest): os.remove(manifest)
+        if fp is not None and config.download_checksum is not None:
+            sink.write_checksums("{:s}.{:s}".format(local, config.download_checksum),
+                                 os.path.getsize(local))
+
+    return success
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class transfer(object):
+
+    def __init__(self, url, header, write, options, notify = None):
+        """transfer(url, header, write, options, notify = None)
+
+        One request handled by the transfer_engine (see
+        transfer_engine.submit).
+
+        Parameters
+        ----------
+        url : str
+            URL to be requested.
+        header : function
+            pycurl HEADERFUNCTION.
+        write : function
+            pycurl WRITEFUNCTION.
+        options : list
+            additional pycurl options, list of tuples (option, value).
+        notify : None or queue.Queue
+            if set, the transfer is put into the queue once done.
+
+        Attributes
+        ----------
+        error : None or pycurl.error
+            set if the transfer failed.
+        info : dict
+            curl timings, bytes, and speed (see download_metrics.curl_info),
+            available once the transfer is done.
+        """
+        from threading import Event
+        self.url       = url
+        self.header    = header
+        self.write     = write
+        self.options   = options
+        self.notify    = notify
+        self.error     = None
+        self.info      = {}
+        self.cancelled = False
+        self._done     = Event()
+
+    def finish(self, error = None, info = None):
+        """finish(error = None, info = None)
+
+        Marks the transfer as done (called by the transfer_engine).
+        """
+        self.error = error
+        self.info  = {} if info is None else info
+        self._done.set()
+        if self.notify is not None: self.notify.put(self)
+
+    def wait(self):
+        """wait()
+
+        Blocks until the transfer is done. Raises the pycurl.error if
+        the transfer failed.
+        """
+        self._done.wait()
+        if self.error is not None: raise self.error
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class http_response(object):
+
+    def __init__(self, url, ranged = False):
+        """http_response(url, ranged = False)
+
+        Response of a request made with transfer_engine.urlopen; behaves
+        like the response of urllib.request.urlopen (attributes 'status',
+        'headers', 'url', method 'read'). The body is kept in memory.
+        If 'ranged' (range request) and the server sends the whole file
+        (status 200), the transfer is aborted (attribute 'aborted').
+        """
+        from io import BytesIO
+        from email.message import Message
+        self.url     = url
+        self.status  = None
+        self.headers = Message()
+        self.aborted = False
+        self._ranged = ranged
+        self._body   = BytesIO()
+
+    def header(self, line):
+        # pycurl HEADERFUNCTION; a new status line (redirect,
+        # '100 Continue') resets the headers.
+        from re import match
+        from email.message import Message
+        line = line.decode("iso-8859-1").strip()
+        tmp = match(r"^HTTP/\S+\s+(\d+)", line)
+        if tmp:
+            self.status  = int(tmp.group(1))
+            self.headers = Message()
+        elif ":" in line:
+            key, val = line.split(":", 1)
+            self.headers[key.strip()] = val.strip()
+
+    def write(self, data):
+        if self._ranged and self.status == 200:
+            self.aborted = True
+            return 0 # Aborts the transfer
+        self._body.write(data)
+
+    def read(self, size = -1):
+        return self._body.read(size)
+
+    def close(self):
+        pass
+
+    def getcode(self):
+        return self.status
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class transfer_engine(object):
+
+    def __init__(self, config):
+        """transfer_engine(config)
+
+        Transfer engine based on pycurl.CurlMulti. All requests (listings,
+        index files, data) are handed over to one event loop (background
+        thread) driving all transfers at once; the calling threads only
+        wait for their transfers to finish (see 'submit', 'urlopen').
+
+        Connections are kept open and reused across requests and files
+        (connection cache of the multi handle, at most
+        'config.download_hostconnections' per host). The DNS cache and
+        the TLS sessions are shared by all handles (pycurl.CurlShare), the
+        curl handles are reused. If 'config.curl_http2' is set, HTTP/2 is
+        negotiated for https and the requests to one host are multiplexed
+        over one connection where the server supports it.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        """
+        import os
+        import pycurl
+        from queue import Queue
+        from threading import Thread, Lock
+        self.config  = config
+        self._share  = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self._multi  = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, config.download_hostconnections)
+        if config.curl_http2:
+            self._multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        self._free   = []    # Curl handles not in use
+        self._active = {}    # Curl handle: transfer
+        self._queue  = Queue()
+        self._lock   = Lock()
+        self._closed = False
+        self._cancel = False
+        # Pipe used to wake up the event loop if a new transfer is submitted
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[0], False)
+        self._thread = Thread(target = self._run, name = "transfer_engine", daemon = True)
+        self._thread.start()
+        # Bookkeeping, see __repr__
+        self.requests = 0
+        self.handles  = 0
+
+    def submit(self, url, header, write, range = None, headers = None, nobody = False,
+               follow = False, timeout = None, notify = None):
+        """submit(url, header, write, range = None, headers = None, nobody = False, follow = False, timeout = None, notify = None)
+
+        Adds a request to the event loop. The callbacks are called in the
+        thread of the event loop.
+
+        Parameters
+        ----------
+        url : str
+            URL to be requested.
+        header : function
+            pycurl HEADERFUNCTION, called once per header line.
+        write : function
+            pycurl WRITEFUNCTION, called with chunks of the body.
+        range : None or str
+            byte range(s) to be requested (e.g., "0-100,200-300").
+        headers : None or list
+            additional request headers ("Key: value").
+        nobody : bool
+            True for HEAD requests.
+        follow : bool
+            if True, redirects are followed.
+        timeout : None or int
+            connect timeout in seconds; transfers slower than one byte per
+            second for 'timeout' seconds are aborted. Default is
+            'config.curl_timeout'.
+        notify : None or queue.Queue
+            if set, the transfer is put into the queue once done (used to
+            wait for one of several transfers).
+
+        Returns
+        -------
+        A transfer object (see transfer.wait).
+        """
+        import os
+        import pycurl
+        if timeout is None: timeout = self.config.curl_timeout
+        options = [(pycurl.FOLLOWLOCATION, 1 if follow else 0)]
+        if range is not None:   options.append((pycurl.RANGE, range))
+        if headers is not None: options.append((pycurl.HTTPHEADER, headers))
+        if nobody:              options.append((pycurl.NOBODY, 1))
+        if timeout:
+            options += [(pycurl.CONNECTTIMEOUT, timeout),
+                        (pycurl.LOW_SPEED_LIMIT, 1), (pycurl.LOW_SPEED_TIME, timeout)]
+        job = transfer(url, header, write, options, notify)
+        with self._lock:
+            if self._closed: raise Exception("transfer_engine has been closed")
+            self._queue.put(job)
+        os.write(self._wakeup[1], b"x")
+        return job
+
+    def cancel(self, job):
+        """cancel(job)
+
+        Aborts a transfer (see submit); it finishes with a pycurl.error.
+        """
+        import os
+        job.cancelled = True
+        with self._lock:
+            self._cancel = True
+        os.write(self._wakeup[1], b"x")
+
+    def perform(self, url, header, write, **kwargs):
+        """perform(url, header, write, ...)
+
+        Same as 'submit' but waits for the transfer to finish.
+
+        Returns
+        -------
+        The curl timings of the transfer (see transfer.info). Raises
+        a pycurl.error if the transfer failed.
+        """
+        job = self.submit(url, header, write, **kwargs)
+        job.wait()
+        return job.info
+
+    def urlopen(self, req, timeout = None):
+        """urlopen(req, timeout = None)
+
+        Replacement for urllib.request.urlopen (GET and HEAD requests).
+
+        Parameters
+        ----------
+        req : str or urllib.request.Request
+            URL or request (additional headers, method).
+        timeout : None or int
+            see 'submit'.
+
+        Returns
+        -------
+        A http_response object. Raises urllib.error.HTTPError if the
+        server does not respond with a 2xx status code (e.g., 304 for
+        conditional requests) and urllib.error.URLError if the request
+        failed. Range requests answered with the whole file (status 200)
+        are aborted, the body of the response is empty.
+        """
+        import pycurl
+        from urllib.error import HTTPError, URLError
+        from urllib.request import Request
+        if isinstance(req, str): req = Request(req)
+        res = http_response(req.full_url, req.has_header("Range"))
+        try:
+            self.perform(req.full_url, res.header, res.write, follow = True, timeout = timeout,
+                         headers = ["{:s}: {:s}".format(k, v) for k,v in req.header_items()],
+                         nobody = req.get_method() == "HEAD")
+        except pycurl.error as e:
+            if not res.aborted: raise URLError(str(e))
+        res._body.seek(0)
+        if res.status is None or not 200 <= res.status < 300:
+            raise HTTPError(req.full_url, 0 if res.status is None else res.status,
+                            "HTTP error", res.headers, None)
+        return res
+
+    def _handle(self, job):
+        # Returns a (reused) curl handle set up for 'job'
+        import pycurl
+        if len(self._free) > 0:
+            c = self._free.pop() # Reset, but still sharing (see _finish)
+        else:
+            c = pycurl.Curl()
+            c.setopt(pycurl.SHARE, self._share)
+            self.handles += 1
+        c.setopt(pycurl.NOSIGNAL, 1)
+        if self.config.curl_http2:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            c.setopt(pycurl.PIPEWAIT, 1)
+        c.setopt(pycurl.URL, job.url)
+        c.setopt(pycurl.HEADERFUNCTION, job.header)
+        c.setopt(pycurl.WRITEFUNCTION, job.write)
+        for key,val in job.options: c.setopt(key, val)
+        return c
+
+    def _start(self):
+        # Adds the submitted transfers to the multi handle
+        import pycurl
+        from queue import Empty
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Empty:
+                return
+            if job.cancelled:
+                job.finish(pycurl.error(pycurl.E_ABORTED_BY_CALLBACK, "cancelled"))
+                continue
+            try:
+                c = self._handle(job)
+                self._multi.add_handle(c)
+            except Exception as e:
+                job.finish(e)
+                continue
+            self._active[c] = job
+            self.requests  += 1
+
+    def _cancelled(self):
+        # Removes the cancelled transfers
+        import pycurl
+        with self._lock:
+            if not self._cancel: return
+            self._cancel = False
+        for c,job in list(self._active.items()):
+            if job.cancelled: self._finish(c, pycurl.error(pycurl.E_ABORTED_BY_CALLBACK, "cancelled"))
+
+    def _finish(self, c, error):
+        job = self._active.pop(c)
+        self._multi.remove_handle(c)
+        try:
+            info = download_metrics.curl_info(c)
+        except Exception:
+            info = {}
+        # Drop the references to the callbacks before reusing the handle
+        c.reset()
+        self._free.append(c)
+        job.finish(error, info)
+
+    def _run(self):
+        # Event loop
+        import os
+        import pycurl
+        from select import select
+        while True:
+            self._start()
+            self._cancelled()
+            with self._lock:
+                if self._closed and len(self._active) == 0 and self._queue.empty(): break
+            while True:
+                ret, num = self._multi.perform()
+                if not ret == pycurl.E_CALL_MULTI_PERFORM: break
+            while True:
+                nqueue, ok, failed = self._multi.info_read()
+                for c in ok: self._finish(c, None)
+                for c, errno, errmsg in failed: self._finish(c, pycurl.error(errno, errmsg))
+                if nqueue == 0: break
+            # Wait for activity on the sockets or a new transfer
+            rfds, wfds, xfds = self._multi.fdset() if len(self._active) > 0 else ([], [], [])
+            timeout = self._multi.timeout() / 1000. if len(self._active) > 0 else -1
+            if timeout < 0: timeout = 1. if len(self._active) == 0 else 0.1
+            if len(self._active) > 0 and len(rfds) + len(wfds) + len(xfds) == 0:
+                timeout = min(timeout, 0.1)
+            select(rfds + [self._wakeup[0]], wfds, xfds, timeout)
+            try:
+                while os.read(self._wakeup[0], 4096): pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        """close()
+
+        Waits for the running transfers and stops the event loop.
+        """
+        import os
+        with self._lock:
+            if self._closed: return
+            self._closed = True
+        os.write(self._wakeup[1], b"x")
+        self._thread.join()
+        for c in self._free: c.close()
+        self._free = []
+        self._multi.close()
+        self._share.close()
+        for fd in self._wakeup: os.close(fd)
+
+    def __repr__(self):
+        res  = "Transfer engine (curl multi):\n"
+        res += "   Requests:                  {:d}\n".format(self.requests)
+        res += "   Curl handles:              {:d}\n".format(self.handles)
+        res += "   HTTP/2 multiplexing:       {:s}\n".format("yes" if self.config.curl_http2 else "no")
+        return res
+
+
+def request_url(req, limiter = None, timeout = None, engine = None, read = None):
+    """request_url(req, limiter = None, timeout = None, engine = None, read = None)
+
+    Parameters
+    ----------
+    req : str or urllib.request.Request
+        URL or request.
+    limiter : None, rate_limiter, or host_limiter object
+        used to limit the requests to the server. If a host_limiter,
+        the request fails over to the mirrors (see host_limiter.fetch).
+    timeout : None or int
+        timeout in seconds.
+    engine : None or transfer_engine object
+        see open_url.
+    read : None or function
+        called with the response to read the body; by default the
+        body is read (bytes).
+
+    Returns
+    -------
+    Tuple with the response (see open_url) and the body (or the value
+    returned by 'read'). The body is read while the request holds its slot
+    (see rate_limiter.request).
+    """
+    if isinstance(limiter, host_limiter):
+        return limiter.fetch(req, timeout, engine, read)
+    if limiter is None: limiter = rate_limiter()
+    with limiter.request():
+        res = open_url(req, timeout, engine)
+        return res, res.read() if read is None else read(res)
+
+
+def open_url(req, timeout = None, engine = None):
+    """open_url(req, timeout = None, engine = None)
+
+    Parameters
+    ----------
+    req : str or urllib.request.Request
+        URL or request.
+    timeout : None or int
+        timeout in seconds.
+    engine : None or transfer_engine object
+        if set, the request is made through the transfer engine
+        (see transfer_engine.urlopen), else urllib.request.urlopen
+        is used.
+
+    Returns
+    -------
+    The response (file-like object with the attributes 'status'
+    and 'headers').
+    """
+    if engine is not None:
+        return engine.urlopen(req, timeout)
+    from urllib.request import urlopen
+    return urlopen(req, timeout = timeout)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class rate_limiter(object):
+
+    def __init__(self, rate = 0, burst = 1, maxconn = 0, maxlatency = 0, maxwait = 60):
+        """rate_limiter(rate = 0, burst = 1, maxconn = 0, maxlatency = 0, maxwait = 60)
+
+        Adaptive limiter for the requests to one host. Each request has to
+        acquire a token (token bucket, 'rate' requests per second, up to
+        'burst' requests at once) and a connection slot (see 'request').
+        The number of slots is adjusted on the fly (AIMD): increased by
+        one per round of successful requests, halved if the server throttles
+        (429, 503), on server errors or broken connections, and if the
+        request took longer than 'maxlatency' seconds. If the server sends
+        a Retry-After header all requests are paused accordingly.
+
+        Parameters
+        ----------
+        rate : float
+            requests per second, 0 for no limit.
+        burst : int
+            size of the token bucket.
+        maxconn : int
+            maximum number of simultaneous requests, 0 for no limit.
+        maxlatency : float
+            latency in seconds considered as a sign of an overloaded
+            server, 0 to disable.
+        maxwait : float
+            Retry-After values larger than 'maxwait' seconds are truncated.
+        """
+        from threading import Condition
+        from time import monotonic
+        self.rate       = float(rate)
+        self.burst      = max(1, int(burst))
+        self.maxconn    = int(maxconn)
+        self.maxlatency = float(maxlatency)
+        self.maxwait    = float(maxwait)
+        self.limit      = float(maxconn)
+        self._cond      = Condition()
+        self._tokens    = float(self.burst)
+        self._refilled  = monotonic()
+        self._created   = monotonic()
+        self._until     = 0.
+        self._decreased = 0.
+        self._active    = 0
+        # Bookkeeping, see __repr__
+        self.requests   = 0
+        self.throttled  = 0
+        self.errors     = 0
+        self.decreases  = 0
+        self.waited     = 0.
+
+    def acquire(self, wait = True):
+        """acquire(wait = True)
+
+        Acquires a slot for one request (see 'request'); has to be
+        released by calling 'release' once the request is done.
+
+        Parameters
+        ----------
+        wait : bool
+            if False, returns immediately if no slot is available.
+
+        Returns
+        -------
+        True if the slot has been acquired, else False (wait = False only).
+        """
+        from time import monotonic
+        t0 = monotonic()
+        with self._cond:
+            while True:
+                now = monotonic()
+                if self.rate > 0:
+                    self._tokens   = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                    self._refilled = now
+                if self._until > now:
+                    delay = self._until - now
+                elif self.maxconn > 0 and self._active >= int(self.limit):
+                    delay = None # Until a request has finished
+                elif self.rate > 0 and self._tokens < 1:
+                    delay = (1. - self._tokens) / self.rate
+                else:
+                    break
+                if not wait: return False
+                self._cond.wait(delay)
+            if self.rate > 0: self._tokens -= 1.
+            self._active   += 1
+            self.requests  += 1
+            self.waited    += monotonic() - t0
+        return True
+
+    def release(self, status, latency, retry_after = None):
+        """release(status, latency, retry_after = None)
+
+        Releases a slot acquired by 'acquire'.
+
+        Parameters
+        ----------
+        status : None or int
+            HTTP status of the response, None if the request failed.
+        latency : float
+            duration of the request in seconds.
+        retry_after : None or float
+            seconds to wait as requested by the server (Retry-After).
+        """
+        from time import monotonic
+        with self._cond:
+            self._active -= 1
+            now = monotonic()
+            if retry_after is not None:
+                self._until = max(self._until, now + min(self.maxwait, retry_after))
+            throttled = status in [429, 503]
+            if throttled:
+                self.throttled += 1
+            elif status is None or status >= 500:
+                self.errors    += 1
+            if throttled or status is None or status >= 500 or \
+               (self.maxlatency > 0 and latency > self.maxlatency):
+                # Multiplicative decrease, at most once per round trip
+                if now - self._decreased > latency:
+                    self.limit      = max(1., self.limit / 2.)
+                    self._decreased = now
+                    self.decreases += 1
+            elif self.maxconn > 0:
+                # Additive increase, about one slot per round of requests
+                self.limit = min(float(self.maxconn), self.limit + 1. / self.limit)
+            self._cond.notify_all()
+
+    def request(self):
+        """request()
+
+        Returns a context manager to be used for each single request.
+        Blocks until the request is allowed. The object returned by the
+        context manager has a method 'report(status, retry_after = None)'
+        to report the HTTP status of the response and the value of the
+        Retry-After header (seconds, see 'retry_after'). Exceptions raised
+        within the block count as errors; urllib HTTPErrors are reported
+        automatically. No report and no exception counts as success.
+        """
+        from contextlib import contextmanager
+        from time import monotonic
+        from urllib.error import HTTPError
+
+        class response(object):
+            status      = 200
+            retry_after = None
+            def report(self, status, retry_after = None):
+                self.status      = status
+                self.retry_after = retry_after
+
+        @contextmanager
+        def slot():
+            self.acquire()
+            res = response()
+            t0  = monotonic()
+            try:
+                yield res
+            except HTTPError as e:
+                res.report(e.code, rate_limiter.retry_after(e.headers.get("Retry-After")))
+                raise
+            except Exception:
+                res.report(None)
+                raise
+            finally:
+                self.release(res.status, monotonic() - t0, res.retry_after)
+        return slot()
+
+    @staticmethod
+    def retry_after(value):
+        """retry_after(value)
+
+        Parameters
+        ----------
+        value : None or str
+            value of the Retry-After header; seconds or a HTTP date.
+
+        Returns
+        -------
+        None if not set or invalid, else the number of seconds (float).
+        """
+        if value is None: return None
+        value = value.strip()
+        if value.isdigit(): return float(value)
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime as dt, timezone
+        try:
+            date = parsedate_to_datetime(value)
+        except Exception:
+            return None
+        if date is None: return None
+        return max(0., (date - dt.now(timezone.utc)).total_seconds())
+
+    def __repr__(self):
+        from time import monotonic
+        sec = max(monotonic() - self._created, 1e-6)
+        res  = "      Requests:               {:d} ({:.2f} per second, limit {:s})\n".format(
+               self.requests, self.requests / sec,
+               "none" if self.rate <= 0 else "{:g} per second".format(self.rate))
+        res += "      Connections:            {:s} (max {:s})\n".format(
+               "{:.1f}".format(self.limit) if self.maxconn > 0 else "no limit",
+               str(self.maxconn) if self.maxconn > 0 else "none")
+        res += "      Throttled/errors:       {:d}/{:d} ({:d} times backed off)\n".format(
+               self.throttled, self.errors, self.decreases)
+        res += "      Time waited:            {:.1f} seconds (all requests)\n".format(self.waited)
+        return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class host_limiter:
+
+    def __init__(self, config):
+        """host_limiter(config)
+
+        Keeps one rate_limiter per host. Calling the object with an URL
+        returns the rate_limiter of the host of the URL; shared by all
+        requests (listing, index files, data) to that host.
+
+        Also keeps track of the health of the mirrors ('config.mirrors').
+        A mirror failing a request is not used for 'config.mirror_holddown'
+        seconds (doubled for each consecutive failure, up to ten minutes)
+        unless all mirrors are down; see 'candidates' and 'fetch'.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'. The limits are defined in the
+            [download] section (hostconnections, rate, burst, maxlatency).
+        """
+        from threading import Lock
+        self.config  = config
+        self.mirrors = list(config.mirrors)
+        self._lock   = Lock()
+        self._hosts  = {}
+        self._health = dict([(x, {"failures": 0, "until": 0., "requests": 0, "errors": 0})
+                             for x in self.mirrors])
+
+    def __call__(self, url):
+        from urllib.parse import urlparse
+        host = urlparse(url).netloc
+        with self._lock:
+            if not host in self._hosts:
+                self._hosts[host] = rate_limiter(self.config.download_rate,
+                                                 self.config.download_burst,
+                                                 self.config.download_hostconnections,
+                                                 self.config.download_maxlatency,
+                                                 self.config.curl_maxsleeptime)
+            return self._hosts[host]
+
+    def _mirror(self, url):
+        # Returns (mirror, path) or (None, url) if not on one of the mirrors
+        for mirror in self.mirrors:
+            if url == mirror or url.startswith(mirror + "/"):
+                return mirror, url[len(mirror):]
+        return None, url
+
+    def candidates(self, url, exclude = None, healthy = False):
+        """candidates(url, exclude = None, healthy = False)
+
+        Parameters
+        ----------
+        url : str
+            URL on one of the mirrors (e.g., gribfile.url).
+        exclude : None or list
+            mirrors (base URLs) not to be used.
+        healthy : bool
+            if True, the mirrors currently held down are not returned.
+
+        Returns
+        -------
+        List of the URLs of the same file on all mirrors (except 'exclude'),
+        the healthy mirrors first (in the order of preference), followed by
+        the ones currently held down. [url] if 'url' is not on a mirror.
+        """
+        from time import monotonic
+        mirror, path = self._mirror(url)
+        if mirror is None: return [url]
+        now = monotonic()
+        with self._lock:
+            tmp = [x for x in self.mirrors if exclude is None or not x in exclude]
+            up  = [x for x in tmp if self._health[x]["until"] <= now]
+            tmp = [] if healthy else \
+                  sorted([x for x in tmp if not x in up], key = lambda x: self._health[x]["until"])
+        return [x + path for x in up + tmp]
+
+    def mirror(self, url):
+        """mirror(url)
+
+        Returns
+        -------
+        The mirror (base URL) of 'url', None if not on a mirror.
+        """
+        return self._mirror(url)[0]
+
+    def report(self, url, success):
+        """report(url, success)
+
+        Reports the result of a request to 'url' (see candidates).
+
+        Parameters
+        ----------
+        url : str
+            URL requested.
+        success : bool
+            False if the mirror failed (no response, server error,
+            throttled), else True.
+        """
+        from time import monotonic
+        mirror = self._mirror(url)[0]
+        if mirror is None: return
+        with self._lock:
+            health = self._health[mirror]
+            health["requests"] += 1
+            if success:
+                health["failures"] = 0
+            else:
+                health["errors"]   += 1
+                health["failures"] += 1
+                health["until"]     = monotonic() + min(600., self.config.mirror_holddown *
+                                                        2.**(health["failures"] - 1))
+
+    def fetch(self, req, timeout = None, engine = None, read = None):
+        """fetch(req, timeout = None, engine = None, read = None)
+
+        Requests 'req' from the first healthy mirror; on failure (no
+        response, server error, throttled, or file not found on the
+        mirror) the request is sent to the next mirror.
+
+        Parameters
+        ----------
+        req : str or urllib.request.Request
+            URL (on one of the mirrors) or request.
+        timeout : None or int
+            timeout in seconds.
+        engine : None or transfer_engine object
+            see open_url.
+        read : None or function
+            called with the response to read the body (e.g., streaming
+            parser); by default the body is read (bytes).
+
+        Returns
+        -------
+        Tuple (response, body), see request_url. Raises the error of the
+        last mirror if all mirrors failed.
+        """
+        from urllib.request import Request
+        from urllib.error import HTTPError
+        if isinstance(req, str): req = Request(req)
+        error = None
+        for url in self.candidates(req.full_url):
+            tmp = Request(url, headers = dict(req.header_items()), method = req.get_method())
+            try:
+                res = request_url(tmp, self(url), timeout, engine, read)
+            except HTTPError as e:
+                # Not modified or client error: the mirror works. Not found: the
+                # file may not (yet) be available on this mirror, hold it down
+                # (as for data requests, see range_fetcher) and try the next one.
+                failed = e.code >= 500 or e.code in [404, 408, 429]
+                self.report(url, not failed)
+                if not failed: raise
+                error = e
+                continue
+            except Exception as e:
+                self.report(url, False)
+                error = e
+                continue
+            self.report(url, True)
+            return res
+        raise error
+
+    def __repr__(self):
+        from time import monotonic
+        res = "Request rate summary:\n"
+        with self._lock:
+            for host,limiter in self._hosts.items():
+                res += "   Host {:s}:\n{:s}".format(host, str(limiter))
+            if len(self.mirrors) > 1:
+                res += "   Mirrors:\n"
+                for mirror,health in self._health.items():
+                    res += "   - {:s}: {:d} requests, {:d} failed{:s}\n".format(mirror,
+                           health["requests"], health["errors"],
+                           ", down" if health["until"] > monotonic() else "")
+        return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_stats:
+
+    def __init__(self):
+        """download_stats()
+
+        Thread-safe bookkeeping used by download_gribfiles. Counts
+        the number of downloaded/skipped/failed files and the number
+        of bytes written to disc to report the aggregate throughput.
+        Also keeps track of the time spent in the different phases
+        (summed over all workers, see 'phase').
+        """
+        from threading import Lock
+        from datetime import datetime as dt
+        self._lock   = Lock()
+        self._timer  = dt.now()
+        self.counts  = {"success": 0, "skipped": 0, "failed": 0}
+        self.bytes   = 0
+        self.phases  = {}
+
+    def add(self, status, nbytes = 0):
+        """add(status, nbytes = 0)
+
+        Parameters
+        ----------
+        status : str
+            one of "success", "skipped", or "failed".
+        nbytes : int
+            number of bytes downloaded.
+        """
+        with self._lock:
+            self.counts[status] += 1
+            self.bytes          += nbytes
+
+    def phase(self, name, times = None):
+        """phase(name, times = None)
+
+        Returns a context manager measuring the time spent in the
+        block; added to the total time of phase 'name'.
+
+        Parameters
+        ----------
+        name : str
+            name of the phase (e.g., "idx", "match", "transfer").
+        times : None or dict
+            if set, the time is also added to times[name] (e.g., the
+            phases of a metrics_record).
+        """
+        from contextlib import contextmanager
+        from time import perf_counter
+        @contextmanager
+        def timer():
+            t0 = perf_counter()
+            try:
+                yield
+            finally:
+                dt = perf_counter() - t0
+                with self._lock:
+                    self.phases[name] = self.phases.get(name, 0.) + dt
+                if times is not None: times[name] = times.get(name, 0.) + dt
+        return timer()
+
+    def elapsed(self):
+        """elapsed()
+
+        Returns
+        -------
+        Seconds (float) since the object has been created.
+        """
+        from datetime import datetime as dt
+        return (dt.now() - self._timer).total_seconds()
+
+    def __repr__(self):
+        sec = max(self.elapsed(), 1e-6)
+        res  = "Download summary:\n"
+        res += "   Files downloaded:          {:d}\n".format(self.counts["success"])
+        res += "   Files skipped:             {:d}\n".format(self.counts["skipped"])
+        res += "   Files failed:              {:d}\n".format(self.counts["failed"])
+        res += "   Bytes downloaded:          {:d} ({:.1f} MB)\n".format(self.bytes, self.bytes / 1e6)
+        res += "   Elapsed time:              {:.1f} seconds\n".format(sec)
+        res += "   Throughput:                {:.2f} MB/s, {:.2f} files/s\n".format(
+               self.bytes / 1e6 / sec, self.counts["success"] / sec)
+        for key,val in self.phases.items():
+            res += "   Time in phase {:12s} {:.2f} seconds (all workers)\n".format(key + ":", val)
+        return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_metrics(object):
+
+    # pycurl timings (seconds) recorded for each data request
+    CURL_TIMES = ["namelookup", "connect", "pretransfer", "starttransfer", "total"]
+
+    def __init__(self, config):
+        """download_metrics(config)
+
+        Machine-readable performance metrics. Each listing request, each
+        data request (with the pycurl timings), and each processed file
+        (time spent in the phases, bytes, ranges, requests, retries) is
+        appended as one JSON object per line to 'config.metrics_file'.
+        Aggregated counters are written to 'config.metrics_prometheus'
+        (Prometheus textfile collector format) by 'flush'. Thread-safe.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        """
+        import os
+        from time import time
+        from threading import Lock
+        self.config  = config
+        self.enabled = config.metrics_enabled
+        self._lock   = Lock()
+        self._fid    = None
+        self._start  = time()
+        self.totals  = {} # (metric name, labels): value
+        if self.enabled and config.metrics_file:
+            if len(os.path.dirname(config.metrics_file)) > 0:
+                os.makedirs(os.path.dirname(config.metrics_file), exist_ok = True)
+            self._fid = open(config.metrics_file, "a")
+
+    def _add(self, name, value, **labels):
+        # Called with the lock held
+        key = (name, tuple(sorted(labels.items())))
+        self.totals[key] = self.totals.get(key, 0) + value
+
+    def _write(self, event, record):
+        # Called with the lock held
+        import json
+        from time import time
+        if self._fid is None: return
+        record = dict([("time", round(time(), 3)), ("event", event)] + list(record.items()))
+        self._fid.write(json.dumps(record, separators = (",", ":")) + "\n")
+
+    def record(self, url):
+        """record(url)
+
+        Returns
+        -------
+        A metrics_record object collecting the metrics of one file;
+        written by 'file' once the file has been processed.
+        """
+        return metrics_record(self, url)
+
+    def listing(self, url, status, seconds, files = 0):
+        """listing(url, status, seconds, files = 0)
+
+        Records one listing request.
+
+        Parameters
+        ----------
+        url : str
+            URL of the listing.
+        status : int
+            HTTP status code (e.g., 200, 304; 0 if the request failed).
+        seconds : float
+            time needed to fetch and parse the listing.
+        files : int
+            number of (matching) links found.
+        """
+        with self._lock:
+            self._add("listing_requests_total", 1, status = status)
+            self._add("phase_seconds_total", seconds, phase = "listing")
+            self._write("listing", {"url": url, "status": status,
+                        "seconds": round(seconds, 6), "files": files})
+
+    def request(self, url, status, curl = None, ranges = 0, attempt = 0, error = None):
+        """request(url, status, curl = None, ranges = 0, attempt = 0, error = None)
+
+        Records one data request.
+
+        Parameters
+        ----------
+        url : str
+            URL of the grib file.
+        status : int
+            HTTP status code (0 if the request failed).
+        curl : None, dict, or pycurl.Curl object
+            if set, the timings, the number of bytes, and the download speed
+            of the last transfer are taken from the curl handle (or the
+            dictionary returned by curl_info).
+        ranges : int
+            number of byte ranges requested.
+        attempt : int
+            attempt (0 for the first one, > 0 for retries).
+        error : None or str
+            error message if the request failed.
+        """
+        rec = {"url": url, "status": status, "ranges": ranges, "attempt": attempt}
+        if curl is not None: rec.update(curl if isinstance(curl, dict) else download_metrics.curl_info(curl))
+        if error is not None: rec["error"] = error
+        with self._lock:
+            self._add("requests_total", 1, status = status)
+            self._add("request_bytes_total", rec.get("bytes", 0))
+            for key in download_metrics.CURL_TIMES:
+                if key in rec: self._add("request_seconds_total", rec[key], timing = key)
+            self._write("request", rec)
+
+    def file(self, record, status, nbytes = 0):
+        """file(record, status, nbytes = 0)
+
+        Records a processed file.
+
+        Parameters
+        ----------
+        record : metrics_record object
+            as returned by 'record'.
+        status : str
+            "success", "skipped", or "failed".
+        nbytes : int
+            number of bytes written to disc.
+        """
+        rec = {"url": record.url, "status": status, "bytes": nbytes,
+               "ranges": record.ranges, "requests": record.requests, "retries": record.retries,
+               "phases": dict([(x, round(y, 6)) for x,y in record.phases.items()])}
+        with self._lock:
+            self._add("files_total", 1, status = status)
+            self._add("bytes_total", nbytes)
+            self._add("retries_total", record.retries)
+            for key,val in record.phases.items():
+                self._add("phase_seconds_total", val, phase = key)
+            self._write("file", rec)
+            if self._fid is not None: self._fid.flush()
+
+    @staticmethod
+    def curl_info(curl):
+        """curl_info(curl)
+
+        Parameters
+        ----------
+        curl : pycurl.Curl object
+            handle of the last transfer.
+
+        Returns
+        -------
+        Dictionary with the (cumulative) time for name lookup, connect,
+        pretransfer, start of transfer and the total time (seconds), the
+        number of bytes downloaded ("bytes") and the average download
+        speed ("speed", bytes per second).
+        """
+        import pycurl
+        res = {}
+        for key in download_metrics.CURL_TIMES:
+            res[key] = round(curl.getinfo(getattr(pycurl, key.upper() + "_TIME")), 6)
+        res["bytes"] = int(curl.getinfo(pycurl.SIZE_DOWNLOAD))
+        res["speed"] = round(curl.getinfo(pycurl.SPEED_DOWNLOAD), 1)
+        return res
+
+    def prometheus(self):
+        """prometheus()
+
+        Returns
+        -------
+        The aggregated counters in the Prometheus text format.
+        """
+        from time import time
+        with self._lock:
+            totals = sorted(self.totals.items())
+        res  = "# TYPE hrrr_download_last_run_timestamp_seconds gauge\n"
+        res += "hrrr_download_last_run_timestamp_seconds {:.3f}\n".format(time())
+        res += "# TYPE hrrr_download_run_seconds gauge\n"
+        res += "hrrr_download_run_seconds {:.3f}\n".format(time() - self._start)
+        last = None
+        for (name, labels), val in totals:
+            if not name == last:
+                res += "# TYPE hrrr_download_{:s} counter\n".format(name)
+                last = name
+            labels = ",".join(["{:s}=\"{:s}\"".format(k, str(v)) for k,v in labels])
+            res += "hrrr_download_{:s}{:s} {:s}\n".format(name,
+                   "" if len(labels) == 0 else "{" + labels + "}",
+                   str(val if isinstance(val, int) else round(val, 6)))
+        return res
+
+    def flush(self):
+        """flush()
+
+        Flushes the JSON-lines file and (re-)writes the Prometheus textfile
+        (atomic, the collector never reads a partially written file).
+        """
+        import os
+        if not self.enabled: return
+        with self._lock:
+            if self._fid is not None: self._fid.flush()
+        if self.config.metrics_prometheus:
+            tmp = "{:s}.{:d}.tmp".format(self.config.metrics_prometheus, os.getpid())
+            with open(tmp, "w") as fid: fid.write(self.prometheus())
+            os.replace(tmp, self.config.metrics_prometheus)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._fid is not None: self._fid.close()
+            self._fid = None
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class metrics_record(object):
+
+    def __init__(self, metrics, url):
+        """metrics_record(metrics, url)
+
+        Metrics of one file (see download_metrics.record). The time
+        spent in the phases is collected in 'phases' (see
+        download_stats.phase), the requests are counted by 'request'.
+
+        Parameters
+        ----------
+        metrics : download_metrics object
+            where the records are written to.
+        url : str
+            URL of the grib file.
+        """
+        self.metrics  = metrics
+        self.url      = url
+        self.phases   = {}
+        self.ranges   = 0
+        self.requests = 0
+        self.retries  = 0
+
+    def request(self, status, curl = None, ranges = 0, attempt = 0, error = None):
+        """request(status, curl = None, ranges = 0, attempt = 0, error = None)
+
+        Records one data request, see download_metrics.request.
+        """
+        self.requests += 1
+        self.ranges   += ranges
+        self.retries   = max(self.retries, attempt)
+        self.metrics.request(self.url, status, curl, ranges, attempt, error)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_ledger(object):
+
+    def __init__(self, config):
+        """download_ledger(config)
+
+        Local SQLite database ('config.ledger_file') keeping track of the
+        files processed: URL, ETag of the index file, hash of the parameter
+        set (see 'paramhash'), byte ranges, number of bytes, duration, and
+        status of the last attempt. Used to skip completed files without
+        any request to the server and to detect files downloaded with a
+        different parameter set.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        """
+        import os
+        import sqlite3
+        from threading import Lock
+        self.config    = config
+        self.paramhash = download_ledger.hash_params(config)
+        if len(os.path.dirname(config.ledger_file)) > 0:
+            os.makedirs(os.path.dirname(config.ledger_file), exist_ok = True)
+        self._lock = Lock()
+        self._db   = sqlite3.connect(config.ledger_file, check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (url TEXT PRIMARY KEY, " +
+                         "local TEXT, etag TEXT, paramhash TEXT, ranges TEXT, bytes INTEGER, " +
+                         "duration REAL, status TEXT, updated REAL, params TEXT)")
+        self._db.commit()
+
+    @staticmethod
+    def hash_params(config):
+        """hash_params(config)
+
+        Returns
+        -------
+        Hash (str) of the parameter set and output options of the config.
+        A different hash means that the local files differ.
+        """
+        import json
+        from hashlib import sha1
+        key = [sorted(config.params.items()), config.download_combined, config.download_split]
+        return sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def check(self, file):
+        """check(file)
+
+        Parameters
+        ----------
+        file : gribfile object
+            the file to be checked.
+
+        Returns
+        -------
+        None if the file is not in the ledger, "done" if it has been
+        downloaded successfully with the current parameter set and is still
+        on disc, "changed" if it has been downloaded with a different
+        parameter set, "todo" else (failed, no messages found, removed).
+        Only the parameter-based files of the parameters found in the index
+        file are expected on disc (see 'record').
+        """
+        import json
+        with self._lock:
+            row = self._db.execute("SELECT paramhash, status, params FROM files WHERE url = ?",
+                                   (file.get("url"),)).fetchone()
+        params = None if row is None or row[2] is None else json.loads(row[2])
+        if row is None:
+            return None
+        elif not row[0] == self.paramhash and (row[1] == "success" or file.on_disc(self.config, params)):
+            return "changed"
+        elif row[1] == "success" and file.on_disc(self.config, params):
+            return "done"
+        return "todo"
+
+    def record(self, file, status, etag = None, ranges = None, nbytes = 0, duration = 0.,
+               params = None):
+        """record(file, status, etag = None, ranges = None, nbytes = 0, duration = 0., params = None)
+
+        Stores the result of the last attempt to download 'file'.
+
+        Parameters
+        ----------
+        file : gribfile object
+            the file.
+        status : str
+            "success", "skipped" (no messages found), or "failed".
+        etag : None or str
+            ETag of the index file used.
+        ranges : None or list
+            byte ranges downloaded (as returned by get_required_bytes).
+        nbytes : int
+            number of bytes written.
+        duration : float
+            seconds needed to download the file.
+        params : None or list
+            names of the parameters found in the index file (i.e., the
+            parameter-based files written); None for all parameters.
+        """
+        import json
+        from time import time
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files (url, local, etag, paramhash, ranges, " +
+                             "bytes, duration, status, updated, params) " +
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (file.get("url"), file.get("local"), etag, self.paramhash,
+                              None if ranges is None else json.dumps(ranges),
+                              nbytes, duration, status, time(),
+                              None if params is None else json.dumps(params)))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class download_session(object):
+
+    def __init__(self, config, hosts = None, metrics = None, engine = None, ledger = True):
+        """download_session(config, hosts = None, metrics = None, engine = None, ledger = True)
+
+        Objects shared by all files processed in one run (see
+        download_gribfiles).
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        hosts : None or host_limiter object
+            if set, the limits are shared with other requests (e.g.,
+            get_gribfiles_on_server); else a new one is created.
+        metrics : None or download_metrics object
+            if set, the metrics of the files/requests are recorded.
+        engine : None or transfer_engine object
+            if set, all requests are made through the transfer engine.
+        ledger : bool
+            if False, the ledger is not used (even if enabled in the config).
+
+        Attributes
+        ----------
+        config : read_config object
+            the configuration.
+        hosts : host_limiter object
+            limits the request rate and connections per host.
+        stats : download_stats object
+            used to keep track of the number of files/bytes.
+        cache : None or idx_cache object
+            if set, the index files are read trough the cache.
+        matcher : param_matcher object
+            used to identify the required messages.
+        ledger : None or download_ledger object
+            if set, the results are recorded in the ledger.
+        metrics : None or download_metrics object
+            if set, the metrics are recorded (see download_metrics).
+        engine : None or transfer_engine object
+            if set, used for all requests (see transfer_engine).
+        store : None or store.array_store object
+            if set, the fields downloaded are added to the store.
+        stations : None or stations.station_extractor object
+            if set, the values at the stations are extracted from the
+            fields downloaded.
+        batch : None or dict
+            batch mode (see batch_gribfiles): index data and range_source
+            of the remote files shared with other sessions, keyed by URL.
+        cancel : None or function
+            called with a gribfile object; if it returns True the download
+            of the file is stopped (see download_range, backfill_gribfiles).
+        """
+        from store import array_store
+        from stations import station_extractor
+        self.config  = config
+        self.hosts   = host_limiter(config) if hosts is None else hosts
+        self.stats   = download_stats()
+        self.cache   = idx_cache(config, engine) if config.cache_enabled else None
+        self.matcher = param_matcher(config.params)
+        self.ledger  = download_ledger(config) if config.ledger_enabled and ledger else None
+        self.metrics = metrics
+        self.engine  = engine
+        self.store   = array_store(config) if config.store_enabled else None
+        self.stations = None if config.stations_file is None else station_extractor(config)
+        self.batch   = None
+        self.cancel  = None
+
+    def state(self, file):
+        """state(file)
+
+        Returns
+        -------
+        "done" if 'file' does not have to be downloaded, "changed" if it
+        has to be downloaded again as the parameter set has changed, None
+        else. Uses the ledger if enabled; files not in the ledger (or if
+        the ledger is disabled) are "done" if the local file(s) exist
+        ("changed" if top-up is enabled and the ledger is used). No request
+        to the server is made.
+        """
+        state = None if self.ledger is None else self.ledger.check(file)
+        if state is None and file.on_disc(self.config):
+            # Not in the ledger: check existing files for missing messages
+            # once if top-up is enabled (see process_gribfile).
+            return "changed" if self.ledger is not None and self.config.download_topup else "done"
+        return None if state in [None, "todo"] else state
+
+    def record(self, file, status, *args, **kwargs):
+        """record(file, status, ...)
+
+        Records the result in the ledger (if enabled), see download_ledger.record.
+        """
+        if self.ledger is not None:
+            self.ledger.record(file, status, *args, **kwargs)
+
+    def compact(self):
+        """compact()
+
+        Compresses the blocks of the array store (if enabled) older than
+        the newest block of each parameter (see store.array_store.compact);
+        called at the end of each run/poll.
+        """
+        if self.store is None: return
+        try:
+            self.store.compact(newest = False)
+        except Exception as e:
+            print("[!] Cannot compact the array store: {:s}".format(str(e)))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def process_gribfile(session, file, status = False):
+    """process_gribfile(session, file, status = False)
+
+    Processing one single grib file: reading the index file, identifying
+    the required messages, and downloading them. Used by download_gribfiles.
+
+    Parameters
+    ----------
+    session : download_session object
+        objects shared by all files of the current run.
+    file : gribfile object
+        the file to be processed.
+    status : bool
+        if True, the status is returned instead of a boolean.
+
+    Return
+    ------
+    Returns boolean True on success, else False. If 'status' is True:
+    "success", "skipped" (on disc or no messages to be downloaded),
+    or "failed".
+    """
+
+    import os
+    from time import perf_counter
+    stats = session.stats
+
+    # Metrics of this file (time spent in the phases, requests)
+    rec   = None if session.metrics is None else session.metrics.record(file.get("url"))
+    times = None if rec is None else rec.phases
+    outcome = []
+    def done(res, nbytes = 0):
+        outcome.append(res)
+        stats.add(res, nbytes)
+        if rec is not None: session.metrics.file(rec, res, nbytes)
+    def result(success):
+        return outcome[-1] if status else success
+
+    # Check if we have the file(s) on our local disc (and downloaded
+    # with the same parameter set, see download_ledger). If so,
+    # we do not have to process it again.
+    config = session.config
+    split  = file.param_files(config.params) if config.download_split else None
+    state  = session.state(file)
+    if state == "done":
+        print("File exists on disc, skip ...")
+        done("skipped")
+        return result(False)
+    elif state == "changed" and not config.download_topup:
+        print("Parameter set changed since last download, download again ...")
+
+    # Read index file (once per forecast step as the file changes
+    # with forecast step).
+    # Batch mode: index file and data shared with other configs
+    shared = None if session.batch is None else session.batch.get(file.get("url"))
+    with stats.phase("idx", times):
+        if shared is not None:
+            idx = shared[0]
+        else:
+            idx = fetch_index_data(file.get("idx"), session.cache, session.hosts, session.engine)
+    with stats.phase("parse", times):
+        idx = None if idx is None or len(idx) == 0 else parse_index_data(idx)
+    # No index file on the server: create the index from the
+    # grib2 file itself (see create_index_file)
+    if idx is None and shared is None:
+        print("Index file not available, reading the index from the grib2 file ...")
+        with stats.phase("idx", times):
+            idx = create_index_file(file.get("url"), True, config.curl_timeout,
+                                    session.hosts, session.engine)
+    if idx is None:
+        print("Not able to download/parse the index file. Possible reason:")
+        print("problems with internet/server or the forecast is not available.")
+        print("Continue and skip this one ...")
+        done("failed")
+        session.record(file, "failed")
+        return result(False)
+
+    # Read/parse index file (if possible) and identify the
+    # required sections (byte-sections) for curl download.
+    with stats.phase("match", times):
+        selected = session.matcher.select(idx)
+    # Parameters found in the index file (split files written)
+    matched = sorted(set([x[0] for x in selected]))
+
+    # Top-up: only download the messages missing in the local file
+    # (the parameter set has changed), see read_local_index.
+    local = file.get("local")
+    topup = state == "changed" and config.download_topup and \
+            config.download_combined and os.path.isfile(local)
+    if topup:
+        have = read_local_index(local)
+        if have is None:
+            print("Cannot read local file, download again ...")
+            topup = False
+        else:
+            keys     = set(have.keys)
+            selected = [x for x in selected if not x[1].key() in keys]
+            print("Top-up: {:d} required messages missing in local file".format(len(selected)))
+            if len(selected) == 0:
+                done("skipped")
+                session.record(file, "success", params = matched)
+                return result(False)
+    required = [(param, x.range()) for param,x in selected]
+
+    # Parameter-based files: skip the ones already on disc. Combined and
+    # parameter-based files: skip the file if all files of the messages
+    # found are on disc (parameters not in the index file have no file).
+    if split is not None and not config.download_combined:
+        required = [x for x in required if not os.path.isfile(split[x[0]])]
+    elif split is not None and state is None and os.path.isfile(local) and \
+         all([os.path.isfile(split[x[0]]) for x in required]):
+        required = []
+    if split is not None:
+        split = dict([(x[0], split[x[0]]) for x in required])
+
+    # If no messages found (or all on disc): continue
+    etag = None if session.cache is None else session.cache.info(file.get("idx")).get("etag")
+    if len(selected) > 0 and len(required) == 0:
+        print("All required fields on disc, skip ...")
+        done("skipped")
+        session.record(file, "success", etag, params = matched)
+        return result(False)
+    if required is None or len(required) == 0:
+        print("Could not find any required fields, skip ...")
+        done("skipped")
+        session.record(file, "skipped", etag)
+        return result(False)
+
+    # Downloading the data (top-up: into a separate file, appended
+    # to the local file once complete)
+    t0     = perf_counter()
+    target = "{:s}.topup".format(local) if topup else local
+    source = None if shared is None or shared[1] is None or not shared[1].covers(required) else shared[1]
+    with stats.phase("transfer", times):
+        cancel  = None if session.cancel is None else lambda: session.cancel(file)
+        success = download_range(config, file.get("url"), target, required, split,
+                                 session.hosts, rec, session.engine, source, cancel)
+
     if success:
-        from shutil import move
-        move("{:s}.tmp".format(local), local)
+        files  = ([target] if config.download_combined else []) + \
+                 ([] if split is None else list(split.values()))
+        nbytes = sum([os.path.getsize(x) for x in files])
+        done("success", nbytes)
+        # Index file of the local file (used for top-ups)
+        if config.download_combined and config.download_topup:
+            entries = sorted([x[1] for x in selected], key = lambda x: x.start_byte())
+            if topup:
+                append_gribfile(local, target, config.download_checksum)
+                entries = list(have) + entries
+            write_local_index(local, entries)
+        # Decode the new fields for the array store/station time series
+        targets = [x for x in [session.store, session.stations] if x is not None]
+        if len(targets) > 0:
+            params = dict([(x[0], config.params[x[0]]) for x in required])
+            try:
+                with stats.phase("decode", times):
+                    for name,values,grid in gribfile_fields(file, params,
+                                                            None if config.download_combined else split):
+                        for x in targets:
+                            x.append(name, file.get("date"), file.get("step"), values, grid)
+            except Exception as e:
+                print("[!] Cannot decode the fields downloaded: {:s}".format(str(e)))
+    else:
+        nbytes = 0
+        done("failed")
+    session.record(file, "success" if success else "failed", etag,
+                   [x[1] for x in required], nbytes, perf_counter() - t0, matched)
+    return result(success)
 
-    return success
 
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def download_gribfiles(config, files, hosts = None, metrics = None, engine = None):
+    """download_gribfiles(config, files, hosts = None, metrics = None, engine = None)
+
+    Downloading a set of grib files using a pool of 'config.download_workers'
+    worker threads, each of them processing one file at a time (see
+    process_gribfile). The requests to one host are limited by a
+    rate_limiter (see host_limiter; at most 'config.download_hostconnections'
+    simultaneous connections).
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    files : list
+        list of gribfile objects, e.g., as returned by get_gribfiles_on_server.
+    hosts : None or host_limiter object
+        if set, the limits are shared with other requests (e.g., the
+        host_limiter used by get_gribfiles_on_server).
+    metrics : None or download_metrics object
+        if set, the metrics of the files and requests are recorded
+        (flushed once all files have been processed).
+    engine : None or transfer_engine object
+        if set, all requests are made through the transfer engine
+        (shared connections, see transfer_engine).
+
+    Return
+    ------
+    Returns a download_stats object.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    session = download_session(config, hosts, metrics, engine)
+
+    # Filter out completed files (no requests needed)
+    if session.ledger is not None:
+        todo = [x for x in files if not session.state(x) == "done"]
+        print("Ledger: {:d} of {:d} files complete, {:d} to process".format(
+              len(files) - len(todo), len(files), len(todo)))
+        for k in range(len(files) - len(todo)): session.stats.add("skipped")
+        files = todo
+
+    with ThreadPoolExecutor(max_workers = config.download_workers) as pool:
+        jobs = [pool.submit(process_gribfile, session, f) for f in files]
+        for job,file in zip(jobs, files):
+            try:
+                job.result()
+            except Exception as e:
+                print("[!] Problems processing {:s}".format(file.get("url")))
+                print(e)
+                session.stats.add("failed")
+
+    session.compact()
+    if metrics is not None: metrics.flush()
+    return session.stats
+
+
+def batch_gribfiles(configs, hosts = None, metrics = None, engine = None):
+    """batch_gribfiles(configs, hosts = None, metrics = None, engine = None)
+
+    Batch mode: downloads the files of several configs (e.g., different
+    parameter sets and types) from the same server in one run. The
+    listings are crawled once (union of the files of all configs), the
+    index file of each grib file is fetched once, and the union of the
+    byte ranges required by the configs is downloaded once into
+    "<local>.batch" (local file of the first config). The outputs of
+    each config (gribdir, combined/split files, ledger, store, stations)
+    are then written from this local copy (see range_source,
+    process_gribfile) and the copy is removed. Uses a pool of
+    'download_workers' (first config) worker threads, one grib file
+    at a time.
+
+    Parameters
+    ----------
+    configs : list
+        list of read_config objects. All configs have to use the same
+        server (url) and domain.
+    hosts : None or host_limiter object
+        used to limit the requests to the server (first config).
+    metrics : None or download_metrics object
+        if set, the metrics are recorded.
+    engine : None or transfer_engine object
+        if set, all requests are made through the transfer engine.
+
+    Return
+    ------
+    Returns a list of download_stats objects (one per config).
+    """
+    import os
+    from re import compile
+    from concurrent.futures import ThreadPoolExecutor
+
+    first = configs[0]
+    for config in configs[1:]:
+        if not config.url == first.url or not config.domain == first.domain:
+            raise Exception("all configs in batch mode have to use the same url and domain.")
+    sessions = [download_session(x, hosts, metrics, engine) for x in configs]
+    hosts    = sessions[0].hosts
+    shared   = {}
+    for session in sessions: session.batch = shared
+
+    # One crawl for all configs (the most dates requested)
+    latest  = [x.latestdates for x in configs]
+    listing = first if 0 in latest else configs[latest.index(max(latest))]
+    pattern = compile("|".join(["(?:{:s})".format(gribfile_pattern(x).pattern) for x in configs]))
+    gribfiles = get_gribfiles_on_server(listing, hosts, metrics, engine, pattern = pattern)
+
+    # Files per remote URL: list of (session, gribfile)
+    files = {}
+    for session in sessions:
+        config = session.config
+        dirs   = gribfiles.dirs if config.latestdates == 0 else gribfiles.dirs[-config.latestdates:]
+        for x in gribfiles.get("files"):
+            if not x.get("dir") in dirs or not x.wanted(config): continue
+            file = gribfile(config, x.get("dir"), x.get("file"))
+            if session.state(file) == "done" and session.ledger is not None:
+                session.stats.add("skipped")
+                continue
+            files.setdefault(file.get("url"), []).append((session, file))
+    print("Batch: {:d} configs, {:d} grib files to process".format(len(configs), len(files)))
+
+    def process(url, items):
+        # Index file and union of the byte ranges of all configs
+        batchfile = "{:s}.batch".format(items[0][1].get("local"))
+        todo = [(s,f) for s,f in items if not s.state(f) == "done"]
+        try:
+            if len(todo) > 0:
+                data = fetch_index_data(todo[0][1].get("idx"), todo[0][0].cache, hosts, engine)
+                idx  = None if data is None or len(data) == 0 else parse_index_data(data)
+                union, source = set(), None
+                if idx is not None:
+                    for s,f in todo: union.update([x.range() for param,x in s.matcher.select(idx)])
+                if len(union) > 0:
+                    rec = None if metrics is None else metrics.record(url)
+                    if download_range(todo[0][0].config, url, batchfile, sorted(union), None,
+                                      hosts, rec, engine):
+                        source = range_source(batchfile, sorted(union))
+                shared[url] = (data, source)
+            # Each config: outputs written from the local copy (if complete)
+            for s,f in items:
+                try:
+                    process_gribfile(s, f)
+                except Exception as e:
+                    print("[!] Problems processing {:s}".format(url))
+                    print(e)
+                    s.stats.add("failed")
+        finally:
+            shared.pop(url, None)
+            for x in [batchfile] + ["{:s}.{:s}".format(batchfile, x.download_checksum)
+                                    for x in configs if x.download_checksum is not None]:
+                if os.path.isfile(x): os.remove(x)
+
+    with ThreadPoolExecutor(max_workers = first.download_workers) as pool:
+        jobs = [pool.submit(process, url, items) for url,items in files.items()]
+        for job in jobs: job.result()
+
+    for session in sessions: session.compact()
+    if metrics is not None: metrics.flush()
+    return [x.stats for x in sessions]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class gribfile_watcher(object):
+
+    def __init__(self, config, hosts = None, metrics = None, engine = None):
+        """gribfile_watcher(config, hosts = None, metrics = None, engine = None)
 
+        Keeps track of the files available on the server (used by
+        watch_gribfiles). Only the main listing and the newest
+        'config.watch_dirs' date directories are polled; conditional
+        requests (If-None-Match, If-Modified-Since) are used so that
+        unchanged listings are not downloaded again. A grib file is
+        considered as published once its index file shows up.
 
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        hosts : None or host_limiter object
+            used to limit the requests to the server.
+        metrics : None or download_metrics object
+            if set, the listing requests are recorded.
+        engine : None or transfer_engine object
+            if set, the listings are requested through the transfer engine.
+        """
+        from threading import Lock
+        self.config    = config
+        self.hosts     = host_limiter(config) if hosts is None else hosts
+        self.metrics   = metrics
+        self.engine    = engine
+        self._lock     = Lock()
+        self._listings = {} # url: (etag, last modified, links)
+        self.seen      = {} # url of the grib file: time first seen
+
+    def _links(self, url, pattern = None):
+        # Returns the links of the listing; the cached ones if not modified
+        from time import perf_counter
+        from urllib.request import Request
+        from urllib.error import HTTPError
+        def record(status, links = ()):
+            if self.metrics is not None:
+                self.metrics.listing(url, status, perf_counter() - t0, len(links))
+        t0     = perf_counter()
+        cached = self._listings.get(url)
+        req    = Request(url)
+        if cached and cached[0]: req.add_header("If-None-Match", cached[0])
+        if cached and cached[1]: req.add_header("If-Modified-Since", cached[1])
+        try:
+            res, data = request_url(req, self.hosts, self.config.curl_timeout, self.engine)
+        except HTTPError as e:
+            record(e.code)
+            if e.code == 304 and cached: return cached[2]
+            raise
+        except Exception:
+            record(0)
+            raise
+        links = get_listing_links(data, pattern)
+        record(200, links)
+        self._listings[url] = (res.headers.get("ETag"), res.headers.get("Last-Modified"), links)
+        return links
+
+    def poll(self):
+        """poll()
+
+        Returns
+        -------
+        List of gribfile objects published (and requested in the config)
+        since the last call.
+        """
+        from time import time
+
+        dirs  = get_date_dirs(self._links(self.config.url + "/"))[-self.config.watch_dirs:]
+        urls  = ["{:s}/{:s}/{:s}/".format(self.config.url, x, self.config.domain) for x in dirs]
+        # Forget the listings of the directories no longer polled
+        for url in list(self._listings.keys()):
+            if not url in urls and not url == self.config.url + "/": del self._listings[url]
+
+        result  = []
+        pattern = gribfile_pattern(self.config, idx = True)
+        for dir,url in zip(dirs, urls):
+            links = set(self._links(url, pattern))
+            for name in sorted(links):
+                if name.endswith(".idx") or not name + ".idx" in links: continue
+                tmp = gribfile(self.config, dir, name)
+                with self._lock:
+                    if tmp.get("url") in self.seen: continue
+                    self.seen[tmp.get("url")] = time()
+                result.append(tmp)
+        return result
+
+    def forget(self, file):
+        """forget(file)
+
+        Removes a file from the list of seen files; it will be returned by
+        the next call of 'poll' again (e.g., if the download failed).
+        """
+        with self._lock:
+            self.seen.pop(file.get("url"), None)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _watch_process(session, watcher, file):
+    # Processing one file in watch mode and logging the latencies
+    from time import time
+    from datetime import datetime as dt
+    from email.utils import parsedate_to_datetime
+    if session.state(file) == "done": return
+    try:
+        status = process_gribfile(session, file, status = True)
+    except Exception as e:
+        print("[!] Problems processing {:s}".format(file.get("url")))
+        print(e)
+        session.stats.add("failed")
+        status = "failed"
+    # Try again with the next poll (download failed); files without
+    # required messages are not processed again.
+    if status == "failed":
+        watcher.forget(file)
+    if not status == "success":
+        return
+
+    # Publication time: Last-Modified of the index file
+    done      = time()
+    published = None
+    if session.cache is not None:
+        published = session.cache.info(file.get("idx")).get("last_modified")
+    if published is None:
+        from urllib.request import Request
+        try:
+            res, data = request_url(Request(file.get("idx"), method = "HEAD"), session.hosts,
+                                    session.config.curl_timeout, session.engine)
+            published = res.headers.get("Last-Modified")
+        except Exception:
+            published = None
+    try:
+        published = parsedate_to_datetime(published).timestamp()
+    except Exception:
+        published = None
+
+    seen = watcher.seen.get(file.get("url"), done)
+    line = "{:s}; {:>8s}; {:>8s}; {:s}".format(dt.now().strftime("%Y-%m-%d %H:%M:%S"),
+           "-" if published is None else "{:.1f}".format(seen - published),
+           "-" if published is None else "{:.1f}".format(done - published), file.get("local"))
+    print("[watch] published -> detected; -> local (seconds): {:s}".format(line))
+    if session.config.watch_logfile:
+        with watcher._lock:
+            with open(session.config.watch_logfile, "a") as fid: fid.write(line + "\n")
+
+
+def watch_gribfiles(config, hosts = None, polls = 0, metrics = None, engine = None):
+    """watch_gribfiles(config, hosts = None, polls = 0, metrics = None, engine = None)
+
+    Watch mode: polling the server every 'config.watch_interval' seconds
+    (see gribfile_watcher) and downloading new files as soon as they are
+    published using a pool of 'config.download_workers' worker threads.
+    Runs until interrupted (Ctrl-C) or 'polls' polls have been made.
+
+    For each downloaded file the time from publication (Last-Modified of the
+    index file) to detection and to having the file on the local disc is
+    printed and, if set, appended to 'config.watch_logfile'.
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    hosts : None or host_limiter object
+        used to limit the requests to the server.
+    polls : int
+        number of polls, 0 (default) runs forever.
+    metrics : None or download_metrics object
+        if set, the metrics of the listings, files, and requests are
+        recorded (flushed after each poll).
+    engine : None or transfer_engine object
+        if set, all requests are made through the transfer engine.
+
+    Return
+    ------
+    Returns a download_stats object.
+    """
+    from time import sleep, monotonic
+    from concurrent.futures import ThreadPoolExecutor
+
+    session = download_session(config, hosts, metrics, engine)
+    watcher = gribfile_watcher(config, session.hosts, metrics, engine)
+    pool    = ThreadPoolExecutor(max_workers = config.download_workers)
+    count   = 0
+    try:
+        while True:
+            t0 = monotonic()
+            try:
+                files = watcher.poll()
+            except Exception as e:
+                print("[!] Problems polling the server, try again in {:d} seconds".format(
+                      config.watch_interval))
+                print(e)
+                files = []
+            for file in files:
+                pool.submit(_watch_process, session, watcher, file)
+            session.compact()
+            if metrics is not None: metrics.flush()
+            count += 1
+            if polls > 0 and count >= polls: break
+            sleep(max(0., config.watch_interval - (monotonic() - t0)))
+    except KeyboardInterrupt:
+        print("Stopping watch mode, waiting for running downloads ...")
+    finally:
+        pool.shutdown(wait = True)
+        session.compact()
+        if metrics is not None: metrics.flush()
+
+    return session.stats
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class backfill_queue(object):
+
+    def __init__(self, config, name, shard = 0, shards = 1, worker = None):
+        """backfill_queue(config, name, shard = 0, shards = 1, worker = None)
+
+        Work queue on (shared) disc used to split a backfill over several
+        processes/machines ('config.backfill_dir'/<name>; e.g., on the NFS
+        gribdir). The items (files) are listed in a plan written once by
+        the first worker (see plan). An item is processed by the worker
+        holding its lease (file in leases/, created exclusively); leases
+        are renewed (heartbeat) every 'config.backfill_lease'/4 seconds.
+        Leases not renewed for 'config.backfill_lease' seconds (worker
+        died) are reclaimed by other workers. Completed items are marked
+        in done/, failed attempts are counted in failed/ (the item is
+        given up after 'config.backfill_attempts' attempts).
+
+        Each worker first processes the items of its shard (stable hash of
+        the item, see shard_of), then takes over the remaining items of
+        the other shards.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        name : str
+            name of the queue (e.g., date range).
+        shard : int
+            shard of this worker (0, ..., shards - 1).
+        shards : int
+            number of shards (usually the number of workers).
+        worker : None or str
+            name of this worker, default <hostname>.<pid>.
+        """
+        import os
+        import socket
+        from threading import Lock, Event
+        if not 0 <= shard < shards:
+            raise ValueError("shard has to be in 0, ..., shards - 1")
+        self.config  = config
+        self.dir     = os.path.join(config.backfill_dir, name)
+        self.shard   = shard
+        self.shards  = shards
+        self.worker  = "{:s}.{:d}".format(socket.gethostname(), os.getpid()) if worker is None else worker
+        self.timeout = config.backfill_lease
+        self.items   = []
+        self._offset = None
+        self._done   = set()
+        self._held   = {}
+        self._lock   = Lock()
+        self._stop   = Event()
+        self._thread = None
+        for sub in ["leases", "done", "failed"]:
+            os.makedirs(os.path.join(self.dir, sub), exist_ok = True)
+
+    def shard_of(self, name):
+        """shard_of(name)
+
+        Returns
+        -------
+        Shard of item 'name' (stable hash, the same on all workers).
+        """
+        from hashlib import sha1
+        return int(sha1(name.encode("utf-8")).hexdigest()[:8], 16) % self.shards
+
+    def _path(self, sub, name):
+        import os
+        from hashlib import sha1
+        return os.path.join(self.dir, sub, sha1(name.encode("utf-8")).hexdigest()[:20])
+
+    def plan(self, create):
+        """plan(create)
+
+        Reads the plan (list of items) of the queue. If not yet available,
+        the plan is created by calling 'create' and written (only the first
+        worker succeeds; all workers use the same plan).
+
+        Parameters
+        ----------
+        create : function
+            function without arguments returning the list of items (str).
+
+        Returns
+        -------
+        List of items, the order in which this worker processes them.
+        """
+        import os
+        from time import sleep
+        file = os.path.join(self.dir, "plan.txt")
+        lock = os.path.join(self.dir, "plan.lock")
+        self._clock()
+        while not os.path.isfile(file):
+            # Only one worker creates the plan (lock renewed by the
+            # heartbeat), the others wait for it.
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if self._stale(lock):
+                    try:
+                        os.remove(lock)
+                    except FileNotFoundError:
+                        pass
+                sleep(0.2)
+                continue
+            with os.fdopen(fd, "w") as fid: fid.write(self.worker + "\n")
+            with self._lock: self._held[".plan"] = lock
+            self._heartbeat()
+            try:
+                tmp = "{:s}.{:s}.tmp".format(file, self.worker)
+                with open(tmp, "w") as fid:
+                    fid.write("".join(["{:s}\n".format(x) for x in create()]))
+                    fid.flush()
+                    os.fsync(fid.fileno())
+                try:
+                    os.link(tmp, file) # Atomic, fails if the plan exists
+                except FileExistsError:
+                    pass
+                os.remove(tmp)
+            finally:
+                with self._lock: self._held.pop(".plan", None)
+                if self._owner(lock): os.remove(lock)
+        with open(file, "r") as fid:
+            items = [x.strip() for x in fid if len(x.strip()) > 0]
+        # Own shard first, then the following shards
+        self.items = sorted(items, key = lambda x: (self.shard_of(x) - self.shard) % self.shards)
+        return self.items
+
+    def _clock(self):
+        # Measures the offset of the clock of the (shared) file system to
+        # the local clock (avoids clock skew between the machines when
+        # checking the leases). Once per pass over the items, using a
+        # file of this worker.
+        import os
+        from time import time
+        clock = os.path.join(self.dir, ".clock.{:s}".format(self.worker))
+        with open(clock, "a"): pass
+        os.utime(clock)
+        self._offset = os.stat(clock).st_mtime - time()
+
+    def _now(self):
+        # Current time of the (shared) file system, see _clock
+        from time import time
+        if self._offset is None: self._clock()
+        return time() + self._offset
+
+    def _stale(self, path):
+        import os
+        try:
+            return self._now() - os.stat(path).st_mtime > self.timeout
+        except FileNotFoundError:
+            return False
+
+    def done(self, name):
+        """done(name)
+
+        Returns
+        -------
+        True if item 'name' has been completed (or given up).
+        """
+        import os
+        if not name in self._done and os.path.isfile(self._path("done", name)):
+            with self._lock: self._done.add(name)
+        return name in self._done
+
+    def _lease(self, name):
+        """_lease(name)
+
+        Tries to get the lease of item 'name'.
+
+        Returns
+        -------
+        "leased" if successful, "done" if the item has been completed,
+        else "busy" (leased by another worker).
+        """
+        import os
+        path = self._path("leases", name)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not self._stale(path): return "busy"
+            # Reclaim: only one worker succeeds renaming the stale lease
+            tmp = "{:s}.{:s}.stale".format(path, self.worker)
+            try:
+                os.rename(path, tmp)
+            except FileNotFoundError:
+                return "busy"
+            if not self._stale(tmp):
+                # Renewed in the meantime: put it back
+                try:
+                    os.link(tmp, path)
+                except FileExistsError:
+                    pass
+                os.remove(tmp)
+                return "busy"
+            with open(tmp, "r") as fid: owner = fid.read().strip()
+            os.remove(tmp)
+            print("Reclaiming stale lease of {:s} (worker {:s})".format(name, owner))
+            return self._lease(name)
+        with os.fdopen(fd, "w") as fid: fid.write(self.worker + "\n")
+        if self.done(name):
+            os.remove(path)
+            return "done"
+        with self._lock: self._held[name] = path
+        self._heartbeat()
+        return "leased"
+
+    def acquire(self):
+        """acquire()
+
+        Returns
+        -------
+        The next item to be processed by this worker (the lease is held
+        until release is called). None if all items have been completed.
+        Waits if the remaining items are leased by other workers.
+        """
+        while not self._stop.is_set():
+            with self._lock:
+                todo = [x for x in self.items if not x in self._done and not x in self._held]
+            self._clock()
+            busy = False
+            for name in todo:
+                if self.done(name): continue
+                res = self._lease(name)
+                if res == "leased": return name
+                busy = busy or res == "busy"
+            if not busy: break
+            self._stop.wait(min(1., self.timeout / 4.))
+        return None
+
+    def release(self, name, success):
+        """release(name, success)
+
+        Releases the lease of item 'name'. If 'success' the item is marked
+        as done, else the failed attempt is counted (and the item marked as
+        done once the maximum number of attempts is reached).
+        """
+        import os
+        status = "success" if success else None
+        if not success:
+            with open(self._path("failed", name), "a") as fid:
+                fid.write("{:s}\n".format(self.worker))
+            with open(self._path("failed", name), "r") as fid:
+                if len(fid.readlines()) >= self.config.backfill_attempts:
+                    print("[!] Giving up {:s} after {:d} attempts".format(name,
+                          self.config.backfill_attempts))
+                    status = "failed"
+        if status is not None:
+            tmp = "{:s}.{:s}.tmp".format(self._path("done", name), self.worker)
+            with open(tmp, "w") as fid: fid.write("{:s} {:s}\n".format(status, self.worker))
+            os.replace(tmp, self._path("done", name))
+            with self._lock: self._done.add(name)
+        with self._lock: path = self._held.pop(name, None)
+        if path is not None and self._owner(path):
+            os.remove(path)
+
+    def holds(self, name):
+        """holds(name)
+
+        Returns
+        -------
+        True if this worker holds the lease of item 'name', False if not
+        (e.g., lost: not renewed in time and reclaimed by another worker).
+        """
+        with self._lock:
+            return name in self._held
+
+    def _owner(self, path):
+        # True if the lease 'path' is held by this worker
+        try:
+            with open(path, "r") as fid: return fid.read().strip() == self.worker
+        except FileNotFoundError:
+            return False
+
+    def _heartbeat(self):
+        # Starts the heartbeat thread (renewing the leases) if not running
+        from threading import Thread
+        with self._lock:
+            if self._thread is not None: return
+            self._thread = Thread(target = self._renew, daemon = True)
+            self._thread.start()
+
+    def _renew(self):
+        import os
+        while not self._stop.wait(self.timeout / 4.):
+            with self._lock: held = list(self._held.items())
+            for name,path in held:
+                if self._owner(path):
+                    try:
+                        os.utime(path)
+                        continue
+                    except FileNotFoundError:
+                        pass
+                print("[!] Lost lease of {:s} (reclaimed by another worker)".format(name))
+                with self._lock: self._held.pop(name, None)
+
+    def status(self):
+        """status()
+
+        Returns
+        -------
+        Dictionary with the number of items in the plan ("items"), items
+        completed ("done"), and items currently leased ("leased").
+        """
+        import os
+        return {"items": len(self.items),
+                "done": len(os.listdir(os.path.join(self.dir, "done"))),
+                "leased": len([x for x in os.listdir(os.path.join(self.dir, "leases")) if len(x) == 20])}
+
+    def close(self):
+        """close()
+
+        Stops the heartbeat and releases the leases still held (not done).
+        """
+        import os
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        with self._lock: held, self._held = list(self._held.values()), {}
+        for path in held:
+            if self._owner(path): os.remove(path)
+        try:
+            os.remove(os.path.join(self.dir, ".clock.{:s}".format(self.worker)))
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        res = self.status()
+        return "Backfill queue {:s}: {:d} files, {:d} done, {:d} leased (worker {:s}, shard {:d}/{:d})".format(
+               self.dir, res["items"], res["done"], res["leased"], self.worker, self.shard, self.shards)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def backfill_gribfiles(config, start, end, shard = 0, shards = 1, hosts = None, metrics = None,
+                       engine = None):
+    """backfill_gribfiles(config, start, end, shard = 0, shards = 1, hosts = None, metrics = None, engine = None)
+
+    Backfill mode: downloads all files of the dates 'start' to 'end'
+    using a shared work queue (see backfill_queue), i.e., the work can be
+    split over several processes/machines sharing the same gribdir, each
+    one started with the same date range and its own shard. Each process
+    uses a pool of 'config.download_workers' worker threads.
+    The ledger is not used (SQLite on network file systems); completed
+    files (and files without required messages) are marked in the queue.
+    If the lease of a file is lost, its download is stopped (the worker
+    which reclaimed the lease writes the same temporary files).
+
+    Parameters
+    ----------
+    config : read_config object
+        As returned by 'read_config()'
+    start, end : str
+        first and last date (YYYYMMDD).
+    shard, shards : int
+        shard of this process and number of shards (see backfill_queue).
+    hosts : None or host_limiter object
+        used to limit the requests to the server.
+    metrics : None or download_metrics object
+        if set, the metrics are recorded.
+    engine : None or transfer_engine object
+        if set, all requests are made through the transfer engine.
+
+    Return
+    ------
+    Returns a download_stats object.
+    """
+    import datetime as dt
+    from concurrent.futures import ThreadPoolExecutor
+
+    first = dt.datetime.strptime(start, "%Y%m%d")
+    last  = dt.datetime.strptime(end, "%Y%m%d")
+    if last < first:
+        raise ValueError("end date of the backfill before start date")
+    dates = [(first + dt.timedelta(days = k)).strftime("%Y%m%d") for k in range((last - first).days + 1)]
+
+    session = download_session(config, hosts, metrics, engine, ledger = False)
+    queue   = backfill_queue(config, "{:s}-{:s}".format(start, end), shard, shards)
+    # Stop downloading a file once its lease is lost (the other worker
+    # writes the same temporary files)
+    session.cancel = lambda file: not queue.holds("{:s}/{:s}".format(file.get("dir"), file.get("file")))
+    def create():
+        files = get_gribfiles_on_server(config, session.hosts, metrics, engine, dates).get("files")
+        return ["{:s}/{:s}".format(x.get("dir"), x.get("file")) for x in files]
+    queue.plan(create)
+    print(queue)
+
+    def work():
+        while True:
+            name = queue.acquire()
+            if name is None: break
+            file = gribfile(config, *name.split("/"))
+            try:
+                status = process_gribfile(session, file, status = True)
+            except Exception as e:
+                print("[!] Problems processing {:s}".format(file.get("url")))
+                print(e)
+                session.stats.add("failed")
+                status = "failed"
+            # Lease lost: the file is processed by another worker
+            if not queue.holds(name): continue
+            # Skipped (no required messages, on disc): done as well
+            queue.release(name, not status == "failed" or file.on_disc(config))
+
+    try:
+        with ThreadPoolExecutor(max_workers = config.download_workers) as pool:
+            jobs = [pool.submit(work) for k in range(config.download_workers)]
+            for job in jobs: job.result()
+    finally:
+        queue.close()
+        session.compact()
+        if metrics is not None: metrics.flush()
+    print(queue)
+    return session.stats
@@ -0,0 +1,676 @@
+# -------------------------------------------------------------------
+# - NAME:        grib2.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Minimal GRIB2 reader used by functions.py. Walks
+#                trough the messages of a (local or remote) grib2
+#                file using small (ranged) reads and creates index
+#                file entries without the need of wgrib2.
+# -------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------
+# Parameter names (discipline, category, number) as used by wgrib2
+# -------------------------------------------------------------------
+PARAMS = {
+    (0,  0,   0): "TMP",    (0,  0,   2): "POT",    (0,  0,   6): "DPT",
+    (0,  0,  10): "LHTFL",  (0,  0,  11): "SHTFL",  (0,  0,  17): "SKINT",
+    (0,  1,   0): "SPFH",   (0,  1,   1): "RH",     (0,  1,   3): "PWAT",
+    (0,  1,   7): "PRATE",  (0,  1,   8): "APCP",   (0,  1,  11): "SNOD",
+    (0,  1,  13): "WEASD",  (0,  1,  22): "CLWMR",  (0,  1,  23): "ICMR",
+    (0,  1,  24): "RWMR",   (0,  1,  25): "SNMR",   (0,  1,  29): "ASNOW",
+    (0,  1,  32): "GRLE",   (0,  1,  39): "CPOFP",  (0,  1,  82): "CIMIXR",
+    (0,  1, 192): "CRAIN",  (0,  1, 193): "CFRZR",  (0,  1, 194): "CICEP",
+    (0,  1, 195): "CSNOW",  (0,  1, 225): "FRZR",
+    (0,  2,   0): "WDIR",   (0,  2,   1): "WIND",   (0,  2,   2): "UGRD",
+    (0,  2,   3): "VGRD",   (0,  2,   8): "VVEL",   (0,  2,   9): "DZDT",
+    (0,  2,  10): "ABSV",   (0,  2,  22): "GUST",   (0,  2, 220): "MAXUVV",
+    (0,  2, 221): "MAXDVV", (0,  2, 222): "MAXUW",  (0,  2, 223): "MAXVW",
+    (0,  3,   0): "PRES",   (0,  3,   1): "PRMSL",  (0,  3,   5): "HGT",
+    (0,  3,  18): "HPBL",   (0,  3, 196): "HPBL",   (0,  3, 198): "MSLMA",
+    (0,  4,   7): "DSWRF",  (0,  4,   8): "USWRF",  (0,  4, 200): "VBDSF",
+    (0,  4, 201): "VDDSF",  (0,  5,   3): "DLWRF",  (0,  5,   4): "ULWRF",
+    (0,  6,   1): "TCDC",   (0,  6,   3): "LCDC",   (0,  6,   4): "MCDC",
+    (0,  6,   5): "HCDC",   (0,  7,   6): "CAPE",   (0,  7,   7): "CIN",
+    (0,  7,   8): "HLCY",   (0,  7, 199): "MXUPHL", (0, 16, 195): "REFD",
+    (0, 16, 196): "REFC",   (0, 16, 197): "RETOP",  (0, 19,   0): "VIS",
+    (0, 19,  11): "TKE",    (2,  0,   0): "LAND",   (2,  0,   1): "SFCR",
+    (2,  0,   5): "EVCW",   (2,  0, 192): "SOILW",  (10, 2,   0): "ICEC",
+}
+
+# -------------------------------------------------------------------
+# Fixed surfaces (code table 4.5). Either a string (no value) or
+# a format string ("{:s}": value of the surface).
+# -------------------------------------------------------------------
+LEVELS = {
+      1: "surface",                    2: "cloud base",
+      3: "cloud top",                  4: "0C isotherm",
+      5: "level of adiabatic condensation from sfc",
+      6: "max wind",                   7: "tropopause",
+      8: "top of atmosphere",
+     10: "entire atmosphere",
+     14: "level of free convection",  20: "{:s} K level",
+    100: "{:s} mb",                  101: "mean sea level",
+    102: "{:s} m above mean sea level",
+    103: "{:s} m above ground",      104: "{:s} sigma level",
+    105: "{:s} hybrid level",        106: "{:s} m below ground",
+    108: "{:s} mb above ground",
+    200: "entire atmosphere (considered as a single layer)",
+    204: "highest tropospheric freezing level",
+    211: "boundary layer cloud layer",
+    214: "low cloud layer",          215: "cloud ceiling",
+    220: "planetary boundary layer", 224: "middle cloud layer",
+    234: "high cloud layer",
+}
+
+# Statistical process (code table 4.10)
+STATISTICS = {0: "ave", 1: "acc", 2: "max", 3: "min"}
+
+# Units of time (code table 4.4)
+TIMEUNITS = {0: "min", 1: "hour", 2: "day"}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def file_reader(file):
+    """file_reader(file)
+
+    Parameters
+    ----------
+    file : str
+        name of a local grib2 file.
+
+    Returns
+    -------
+    Function read(offset, size) returning (up to) 'size' bytes
+    starting at byte 'offset' of the file.
+    """
+    def read(offset, size):
+        with open(file, "rb") as fid:
+            fid.seek(offset)
+            return fid.read(size)
+    return read
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _uint(buf, pos, size):
+    return int.from_bytes(buf[pos:(pos + size)], "big")
+
+def _int(buf, pos, size):
+    # Signed integers are stored as sign and magnitude
+    x = _uint(buf, pos, size)
+    sign = 1 << (8 * size - 1)
+    return -(x & (sign - 1)) if x & sign else x
+
+def _surface(ftype, scale, value):
+    """_surface(ftype, scale, value)
+
+    Returns
+    -------
+    Value of a fixed surface as string (e.g., "2", "0.1"), or None if missing.
+    """
+    if ftype == 255 or value == -(2**31 - 1) or scale == -127:
+        return None
+    x = value * 10.**(-scale)
+    if ftype in [100, 108]: x = x / 100. # Pa -> hPa
+    return "{:g}".format(x)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def message_sections(buf):
+    """message_sections(buf)
+
+    Parameters
+    ----------
+    buf : bytes
+        (the beginning of) one grib2 message, starting with "GRIB".
+
+    Returns
+    -------
+    Dictionary with the position (start byte within the message) of the
+    sections 1-7 of the (first field of the) message. Sections not
+    (completely) contained in 'buf' are not included. Used to find the
+    sections needed to create the index entry or decode the data.
+    """
+    res = {}
+    pos = 16
+    while pos + 5 <= len(buf):
+        if buf[pos:(pos + 4)] == b"7777": break
+        length = _uint(buf, pos, 4)
+        number = buf[pos + 4]
+        if number in res or length < 5: break # Second field or garbage
+        if pos + length > len(buf): break
+        res[number] = pos
+        pos += length
+    return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def message_inventory(buf):
+    """message_inventory(buf)
+
+    Parameters
+    ----------
+    buf : bytes
+        beginning of one grib2 message, must at least contain
+        the sections 0, 1, and 4.
+
+    Returns
+    -------
+    Tuple (date, param, level, step) with strings as used in grib2
+    index files (e.g., "2020061600", "TMP", "2 m above ground", "anl").
+    """
+
+    sec = message_sections(buf)
+    if not 1 in sec or not 4 in sec:
+        raise Exception("section 1 or 4 not found in grib2 message")
+
+    # Reference time (section 1)
+    s1   = sec[1]
+    date = "{:04d}{:02d}{:02d}{:02d}".format(_uint(buf, s1 + 12, 2),
+           buf[s1 + 14], buf[s1 + 15], buf[s1 + 16])
+
+    # Product definition (section 4)
+    s4       = sec[4]
+    template = _uint(buf, s4 + 7, 2)
+    disc     = buf[6]
+    key      = (disc, buf[s4 + 9], buf[s4 + 10])
+    param    = PARAMS.get(key, "var{:d}_{:d}_{:d}".format(*key))
+
+    # Level
+    ftype1 = buf[s4 + 22]
+    ftype2 = buf[s4 + 28]
+    val1   = _surface(ftype1, _int(buf, s4 + 23, 1), _int(buf, s4 + 24, 4))
+    val2   = _surface(ftype2, _int(buf, s4 + 29, 1), _int(buf, s4 + 30, 4))
+    level  = LEVELS.get(ftype1, "level type {:d}".format(ftype1))
+    if "{:s}" in level:
+        if val2 is not None and ftype2 == ftype1: val1 = "{:s}-{:s}".format(val1, val2)
+        level = level.format("" if val1 is None else val1)
+
+    # Forecast time (template 4.0/4.8)
+    unit  = TIMEUNITS.get(buf[s4 + 17], "unit{:d}".format(buf[s4 + 17]))
+    fcst  = _int(buf, s4 + 18, 4)
+    if template == 8 and len(buf) >= s4 + 53:
+        stat   = STATISTICS.get(buf[s4 + 46], "stat{:d}".format(buf[s4 + 46]))
+        length = _uint(buf, s4 + 49, 4)
+        # wgrib2 writes empty intervals as "0-0 day"
+        if fcst == 0 and length == 0: unit = "day"
+        step   = "{:d}-{:d} {:s} {:s} fcst".format(fcst, fcst + length, unit, stat)
+    elif fcst == 0:
+        step   = "anl"
+    else:
+        step   = "{:d} {:s} fcst".format(fcst, unit)
+
+    return date, param, level, step
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def scan_messages(read, blocksize = 1024):
+    """scan_messages(read, blocksize = 1024)
+
+    Walks trough the messages of a grib2 file. For each message only
+    the first 'blocksize' bytes are read (more if needed to get section
+    4), the next message is found using the total length of the message
+    (section 0).
+
+    Parameters
+    ----------
+    read : function
+        function read(offset, size), see file_reader
+        (local files) and functions.range_reader (remote files).
+    blocksize : int
+        number of bytes read at the beginning of each message.
+
+    Returns
+    -------
+    Generator yielding a tuple (offset, length, date, param, level, step)
+    for each message (see message_inventory).
+    """
+    offset = 0
+    while True:
+        buf = read(offset, blocksize)
+        if len(buf) < 16: break
+        if not buf[:4] == b"GRIB" or not buf[7] == 2:
+            raise Exception("no grib2 message found at byte {:d}".format(offset))
+        length = _uint(buf, 8, 8)
+        # Read more if section 4 is not yet complete
+        size = blocksize
+        while not 4 in message_sections(buf) and size < length:
+            size = min(2 * size, length)
+            buf  = read(offset, size)
+        yield (offset, length) + message_inventory(buf)
+        offset += length
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def inventory(read, blocksize = 1024):
+    """inventory(read, blocksize = 1024)
+
+    Parameters
+    ----------
+    read : function
+        function read(offset, size), see file_reader
+        (local files) and functions.range_reader (remote files).
+    blocksize : int
+        see scan_messages.
+
+    Returns
+    -------
+    Tuple (text, end) where 'text' is the content of a grib2 index file
+    ("<number>:<byte>:d=<date>:<param>:<level>:<step>:", one line per
+    message) and 'end' the last byte of the last message.
+    """
+    lines = []
+    end   = -1
+    for k,rec in enumerate(scan_messages(read, blocksize)):
+        lines.append("{:d}:{:d}:d={:s}:{:s}:{:s}:{:s}:".format(k + 1, rec[0], *rec[2:]))
+        end = rec[0] + rec[1] - 1
+    return "\n".join(lines) + "\n", end
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def unpack_bits(data, bitpos, nbits):
+    """unpack_bits(data, bitpos, nbits)
+
+    Vectorized extraction of unsigned integers from a big-endian bit
+    stream (as used in the grib2 sections 6 and 7).
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        bit stream (uint8).
+    bitpos : numpy.ndarray
+        position (bit) of the first bit of each value.
+    nbits : int or numpy.ndarray
+        number of bits per value (common or one per value); 0-32.
+
+    Returns
+    -------
+    numpy.ndarray (uint64) with the values; 0 for values with 0 bits.
+    """
+    import numpy as np
+    bitpos = np.asarray(bitpos, dtype = np.int64)
+    nbits  = np.asarray(nbits, dtype = np.uint64)
+    if bitpos.size == 0: return np.zeros(0, dtype = np.uint64)
+    maxbits = int(nbits.max())
+    if maxbits > 32:
+        raise Exception("cannot unpack values with more than 32 bits")
+    # Each value is read trough an (overlapping, unaligned) big-endian
+    # window of 8 bytes starting at the byte containing its first bit.
+    data   = np.concatenate((data, np.zeros(8, dtype = np.uint8)))
+    window = np.ndarray(shape = (data.size - 7,), dtype = ">u8", buffer = data, strides = (1,))
+    res    = window[bitpos >> 3].astype(np.uint64)
+    res  >>= np.uint64(64) - (bitpos & 7).astype(np.uint64) - nbits
+    return res & ((np.uint64(1) << nbits) - np.uint64(1))
+
+
+def _unpack_fixed(data, bit, count, nbits):
+    # 'count' values with 'nbits' bits each starting at bit 'bit'
+    import numpy as np
+    if nbits == 0 or count == 0:
+        return np.zeros(count, dtype = np.uint64)
+    if bit % 8 == 0 and nbits in [8, 16, 32]:
+        dtype = {8: ">u1", 16: ">u2", 32: ">u4"}[nbits]
+        return np.frombuffer(data, dtype = dtype, count = count, offset = bit // 8).astype(np.uint64)
+    return unpack_bits(data, bit + np.arange(count, dtype = np.int64) * nbits, nbits)
+
+
+def _octets(bits):
+    # Number of bits rounded up to full octets
+    return (bits + 7) // 8 * 8
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def message_grid(buf, sec = None):
+    """message_grid(buf, sec = None)
+
+    Parameters
+    ----------
+    buf : bytes or memoryview
+        one grib2 message.
+    sec : None or dict
+        position of the sections (see message_sections).
+
+    Returns
+    -------
+    Dictionary with the grid definition template ("template"), the
+    number of data points ("npoints"), and, for the templates 3.0
+    (regular lat/lon), 3.20 (polar stereographic), and 3.30 (Lambert
+    conformal), the dimension ("nx", "ny") and the scanning mode
+    ("scanning"). For the templates 3.20/3.30 the parameters of the
+    projection are included as well ("la1", "lo1", "lad", "lov", "dx",
+    "dy", "latin1", "latin2", "radius"; degrees and meters).
+    """
+    if sec is None: sec = message_sections(buf)
+    if not 3 in sec:
+        raise Exception("section 3 not found in grib2 message")
+    s3  = sec[3]
+    res = {"template": _uint(buf, s3 + 12, 2), "npoints": _uint(buf, s3 + 6, 4)}
+    if res["template"] in [0, 20, 30]:
+        res["nx"] = _uint(buf, s3 + 30, 4)
+        res["ny"] = _uint(buf, s3 + 34, 4)
+        res["scanning"] = buf[s3 + (71 if res["template"] == 0 else 64)]
+    if res["template"] in [20, 30]:
+        # Radius of the earth (shape of the earth, code table 3.2)
+        shape = buf[s3 + 14]
+        res["radius"] = {0: 6367470., 6: 6371229., 8: 6371200.}.get(shape, 6371229.)
+        if shape == 1: res["radius"] = _uint(buf, s3 + 16, 4) * 10.**(-_int(buf, s3 + 15, 1))
+        res.update(dict(la1 = _int(buf, s3 + 38, 4) * 1e-6, lo1 = _int(buf, s3 + 42, 4) * 1e-6,
+                        lad = _int(buf, s3 + 47, 4) * 1e-6, lov = _int(buf, s3 + 51, 4) * 1e-6,
+                        dx  = _uint(buf, s3 + 55, 4) * 1e-3, dy  = _uint(buf, s3 + 59, 4) * 1e-3))
+    if res["template"] == 30:
+        res.update(dict(latin1 = _int(buf, s3 + 65, 4) * 1e-6, latin2 = _int(buf, s3 + 69, 4) * 1e-6))
+    return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def lambert_forward(grid, lat, lon):
+    """lambert_forward(grid, lat, lon)
+
+    Vectorized forward transform of the Lambert conformal projection
+    (spherical earth, grid template 3.30).
+
+    Parameters
+    ----------
+    grid : dict
+        grid definition (see message_grid).
+    lat, lon : numpy.ndarray
+        latitude and longitude (degrees).
+
+    Returns
+    -------
+    Tuple (i, j) with the (fractional) column and row of the points in
+    the field as returned by decode_message (0, 0: first grid point).
+    """
+    import numpy as np
+    if not grid.get("template") == 30:
+        raise Exception("grid template 3.{:s} not supported (Lambert conformal only)".format(
+                        str(grid.get("template"))))
+    rad  = np.pi / 180.
+    phi1 = grid["latin1"] * rad
+    phi2 = grid["latin2"] * rad
+    t    = lambda phi: np.tan(np.pi / 4. + phi / 2.)
+    if abs(phi1 - phi2) < 1e-10:
+        n = np.sin(phi1)
+    else:
+        n = np.log(np.cos(phi1) / np.cos(phi2)) / np.log(t(phi2) / t(phi1))
+    F = grid["radius"] * np.cos(phi1) * t(phi1)**n / n
+
+    def forward(lat, lon):
+        dlon  = (np.asarray(lon, dtype = float) - grid["lov"] + 180.) % 360. - 180.
+        rho   = F / t(np.asarray(lat, dtype = float) * rad)**n
+        theta = n * dlon * rad
+        return rho * np.sin(theta), -rho * np.cos(theta)
+
+    x0, y0 = forward(grid["la1"], grid["lo1"])
+    x,  y  = forward(lat, lon)
+    i = (x - x0) / grid["dx"]
+    j = (y - y0) / grid["dy"]
+    # Scanning mode: points in -i direction, points in +j direction
+    if grid["scanning"] & 0x80:     i = -i
+    if not grid["scanning"] & 0x40: j = -j
+    return i, j
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _simple_packing(data, ndata, nbits):
+    # Template 5.0: 'ndata' values with 'nbits' bits each
+    return _unpack_fixed(data, 0, ndata, nbits).astype("int64")
+
+
+def _complex_packing(buf, s5, data, ndata, nbits, template):
+    """_complex_packing(buf, s5, data, ndata, nbits, template)
+
+    Unpacks the data of the templates 5.2 (complex packing) and 5.3
+    (complex packing and spatial differencing).
+
+    Returns
+    -------
+    Tuple (values, missing): numpy.ndarray (int64) with the (not yet
+    scaled) values and a boolean numpy.ndarray flagging missing values
+    (None if the message uses no missing value management).
+    """
+    import numpy as np
+    missing = buf[s5 + 22]
+    ngroups = _uint(buf, s5 + 31, 4)
+    wref    = buf[s5 + 35]
+    wbits   = buf[s5 + 36]
+    lref    = _uint(buf, s5 + 37, 4)
+    linc    = buf[s5 + 41]
+    llast   = _uint(buf, s5 + 42, 4)
+    lbits   = buf[s5 + 46]
+    order   = buf[s5 + 47] if template == 3 else 0
+    nextra  = buf[s5 + 48] if template == 3 else 0
+    if not order in [0, 1, 2]:
+        raise Exception("order of spatial differencing {:d} not supported".format(order))
+
+    # Extra descriptors: first value(s) and the minimum of the differences
+    extra = bytes(data[:(nextra * (order + 1))]) if order > 0 else b""
+    first = [_int(extra, k * nextra, nextra) for k in range(order)]
+    dmin  = _int(extra, order * nextra, nextra) if order > 0 else 0
+
+    # Group reference values, widths, and lengths (each padded to full octets)
+    bit     = 8 * len(extra)
+    refs    = _unpack_fixed(data, bit, ngroups, nbits).astype(np.int64)
+    bit    += _octets(ngroups * nbits)
+    widths  = _unpack_fixed(data, bit, ngroups, wbits).astype(np.int64) + wref
+    bit    += _octets(ngroups * wbits)
+    lengths = _unpack_fixed(data, bit, ngroups, lbits).astype(np.int64) * linc + lref
+    bit    += _octets(ngroups * lbits)
+    if ngroups > 0: lengths[-1] = llast
+    if not lengths.sum() == ndata:
+        raise Exception("group lengths do not match the number of data points")
+    if (widths > 32).any():
+        raise Exception("group widths of more than 32 bits not supported")
+
+    # Position of each value: groups are stored one after another without padding
+    size    = lengths * widths
+    first_k = np.cumsum(lengths) - lengths
+    width   = np.repeat(widths, lengths)
+    pos     = np.repeat(bit + np.cumsum(size) - size - first_k * widths, lengths) + \
+              np.arange(ndata, dtype = np.int64) * width
+    packed  = unpack_bits(data, pos, width).astype(np.int64)
+    values  = np.repeat(refs, lengths) + packed
+
+    # Missing values: all bits set (primary) or all bits but the last (secondary)
+    miss = None
+    if missing in [1, 2]:
+        top  = np.repeat(np.where(widths == 0, 2**nbits - 1, 2**widths - 1), lengths)
+        miss = np.where(width == 0, values, packed) == top
+        if missing == 2:
+            miss |= np.where(width == 0, values, packed) == top - 1
+        values = values[~miss]
+
+    # Spatial differencing: reconstruct the original values
+    if order > 0 and values.size > 0:
+        values[order:] += dmin
+        values[:order]  = first[:values.size]
+        if order == 2 and values.size > 1:
+            values[1]  -= values[0]
+            values[1:]  = np.cumsum(values[1:])
+        values = np.cumsum(values)
+
+    return values, miss
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def decode_message(buf, dtype = "float32"):
+    """decode_message(buf, dtype = "float32")
+
+    Decodes the data of one grib2 message. Supported are simple packing
+    (template 5.0), complex packing (template 5.2), and complex packing
+    with spatial differencing (template 5.3), with or without bitmap.
+    Bits are unpacked vectorized (see unpack_bits), the data are not
+    copied before unpacking.
+
+    Parameters
+    ----------
+    buf : bytes or memoryview
+        one grib2 message (see grib2_file.message). Only the first field
+        is decoded if the message contains several fields.
+    dtype : str
+        data type of the values returned.
+
+    Returns
+    -------
+    numpy.ndarray with the values; missing values (bitmap, missing value
+    management) are set to NaN. Two-dimensional (ny, nx) for the grid
+    templates 3.0, 3.20, and 3.30 (rows in the order as stored, i.e.,
+    south to north for the scanning mode 64 as used by HRRR), else
+    one-dimensional.
+    """
+    import numpy as np
+    import struct
+
+    sec = message_sections(buf)
+    for k in [3, 5, 6, 7]:
+        if not k in sec:
+            raise Exception("section {:d} not found in grib2 message".format(k))
+    grid  = message_grid(buf, sec)
+    s5, s6, s7 = sec[5], sec[6], sec[7]
+
+    # Data representation (section 5)
+    ndata    = _uint(buf, s5 + 5, 4)
+    template = _uint(buf, s5 + 9, 2)
+    ref      = struct.unpack(">f", bytes(buf[(s5 + 11):(s5 + 15)]))[0]
+    binary   = _int(buf, s5 + 15, 2)
+    decimal  = _int(buf, s5 + 17, 2)
+    nbits    = buf[s5 + 19]
+
+    # Data (section 7; not copied)
+    data = np.frombuffer(buf, dtype = np.uint8, count = _uint(buf, s7, 4) - 5, offset = s7 + 5)
+    miss = None
+    if nbits == 0:
+        values = np.zeros(ndata, dtype = np.int64)
+    elif template == 0:
+        values = _simple_packing(data, ndata, nbits)
+    elif template in [2, 3]:
+        values, miss = _complex_packing(buf, s5, data, ndata, nbits, template)
+    else:
+        raise Exception("data representation template 5.{:d} not supported".format(template))
+    values = ((ref + values * 2.**binary) * 10.**(-decimal)).astype(dtype)
+
+    # Missing values (complex packing) and bitmap (section 6)
+    if miss is not None:
+        tmp = np.full(ndata, np.nan, dtype = dtype)
+        tmp[~miss] = values
+        values = tmp
+    indicator = buf[s6 + 5]
+    if indicator == 0:
+        npoints = grid["npoints"]
+        bitmap  = np.unpackbits(np.frombuffer(buf, dtype = np.uint8, count = (npoints + 7) // 8,
+                                              offset = s6 + 6))[:npoints].astype(bool)
+        if not bitmap.sum() == ndata:
+            raise Exception("bitmap does not match the number of data points")
+        tmp = np.full(npoints, np.nan, dtype = dtype)
+        tmp[bitmap] = values
+        values = tmp
+    elif not indicator == 255:
+        raise Exception("bitmap indicator {:d} not supported".format(indicator))
+
+    # Two-dimensional field
+    if "nx" in grid and values.size == grid["nx"] * grid["ny"]:
+        if grid["scanning"] & 0x20:
+            values = values.reshape((grid["nx"], grid["ny"])).T
+        else:
+            values = values.reshape((grid["ny"], grid["nx"]))
+        if grid["scanning"] & 0x10:
+            values[1::2] = values[1::2, ::-1].copy()
+    return values
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class grib2_file(object):
+
+    def __init__(self, file):
+        """grib2_file(file)
+
+        Memory-mapped local grib2 file. Messages are accessed by their
+        byte offset (e.g., from the index file); only the pages of the
+        messages decoded are read from disc.
+
+        Parameters
+        ----------
+        file : str
+            name of the local grib2 file.
+        """
+        import mmap
+        self.file = file
+        self._fid = open(file, "rb")
+        try:
+            self._mmap = mmap.mmap(self._fid.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            self._mmap = b"" # Empty file
+        self.size = len(self._mmap)
+
+    def read(self, offset, size):
+        """read(offset, size)
+
+        Returns (up to) 'size' bytes starting at byte 'offset' (same
+        interface as file_reader, can be used with scan_messages).
+        """
+        return bytes(self._mmap[offset:(offset + size)])
+
+    def message(self, offset, length = None):
+        """message(offset, length = None)
+
+        Parameters
+        ----------
+        offset : int
+            first byte of the message.
+        length : None or int
+            length of the message, taken from section 0 if not set.
+
+        Returns
+        -------
+        memoryview on the message (no copy).
+        """
+        if offset < 0 or offset + 16 > self.size or not self._mmap[offset:(offset + 4)] == b"GRIB":
+            raise Exception("no grib2 message found at byte {:d} in {:s}".format(offset, self.file))
+        if length is None:
+            length = _uint(self._mmap, offset + 8, 8)
+        if offset + length > self.size:
+            raise Exception("grib2 message at byte {:d} truncated in {:s}".format(offset, self.file))
+        return memoryview(self._mmap)[offset:(offset + length)]
+
+    def decode(self, offset, length = None, dtype = "float32"):
+        """decode(offset, length = None, dtype = "float32")
+
+        Decodes the message starting at byte 'offset' (see message and
+        decode_message).
+        """
+        return decode_message(self.message(offset, length), dtype)
+
+    def grid(self, offset):
+        """grid(offset)
+
+        Grid definition of the message starting at byte 'offset' (see
+        message_grid).
+        """
+        return message_grid(self.message(offset))
+
+    def close(self):
+        try:
+            if not isinstance(self._mmap, bytes): self._mmap.close()
+        except BufferError:
+            pass # Still in use (released by the garbage collector)
+        self._fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "<grib2_file {:s} ({:d} bytes)>".format(self.file, self.size)
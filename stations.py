@@ -0,0 +1,218 @@
+# -------------------------------------------------------------------
+# - NAME:        stations.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Extraction of the values at stations (interpolation
+#                weights computed once per domain) used by
+#                functions.py; the values are appended to CSV files.
+# -------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class station_extractor(object):
+
+    def __init__(self, config):
+        """station_extractor(config)
+
+        Extracts the values at a set of stations ('config.stations_file')
+        from the fields downloaded and appends them to one CSV file per
+        parameter (<dir>/<domain>/<param>.csv; one row per run and step,
+        one column per station, in the order the files are processed).
+
+        The grid cells and interpolation weights of the stations are
+        computed once per domain (see grib2.lambert_forward) and stored in
+        <dir>/<domain>.index.npz; the index is recomputed if the stations,
+        the method, or the grid change. Extracting the values of a field
+        is one single indexing operation (see extract).
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+        """
+        import os
+        from threading import Lock
+        self.config = config
+        self.dir    = config.stations_dir
+        self.method = config.stations_method
+        self.index_file = os.path.join(self.dir, "{:s}.index.npz".format(config.domain))
+        self.names, self.lat, self.lon = station_extractor.read_stations(config.stations_file)
+        self._index = None
+        self._grid  = None
+        self._lock  = Lock()
+
+    @staticmethod
+    def read_stations(file):
+        """read_stations(file)
+
+        Parameters
+        ----------
+        file : str
+            CSV file with the columns name, lat, and lon (header line).
+
+        Returns
+        -------
+        Tuple (names, lat, lon): list of names, numpy arrays with the
+        latitude and longitude (degrees) of the stations.
+        """
+        import csv
+        from numpy import array
+        with open(file, "r") as fid:
+            rows = list(csv.DictReader(fid, skipinitialspace = True))
+        if len(rows) == 0 or not all([x in rows[0] for x in ["name", "lat", "lon"]]):
+            raise ValueError("stations file \"{:s}\" needs the columns name, lat, lon".format(file))
+        names = [x["name"].strip() for x in rows]
+        if not len(set(names)) == len(names):
+            raise ValueError("station names in \"{:s}\" not unique".format(file))
+        return names, array([float(x["lat"]) for x in rows]), array([float(x["lon"]) for x in rows])
+
+    def _hash(self, grid):
+        # Key of the index: stations, method, and grid definition
+        import json
+        from hashlib import sha1
+        key = [self.names, self.lat.tolist(), self.lon.tolist(), self.method,
+               sorted([(k, v) for k,v in grid.items()])]
+        return sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def index(self, grid):
+        """index(grid)
+
+        Parameters
+        ----------
+        grid : dict
+            grid definition (see grib2.message_grid).
+
+        Returns
+        -------
+        Tuple (index, weights): numpy arrays (station, point) with the
+        positions of the grid points in the (flattened) field and their
+        weights (NaN for stations outside the domain). One point per
+        station for method "nearest", four for "bilinear". Loaded from
+        'index_file' if computed before.
+        """
+        import os
+        import numpy as np
+        import grib2
+        with self._lock:
+            if self._grid == grid: return self._index
+            key = self._hash(grid)
+            if os.path.isfile(self.index_file):
+                with np.load(self.index_file) as tmp:
+                    if str(tmp["key"]) == key:
+                        self._grid, self._index = dict(grid), (tmp["index"], tmp["weights"])
+                        return self._index
+
+            # Compute the index (all stations at once)
+            nx, ny = grid["nx"], grid["ny"]
+            i, j   = grib2.lambert_forward(grid, self.lat, self.lon)
+            if self.method == "nearest":
+                i0, j0  = np.round(i).astype(int), np.round(j).astype(int)
+                inside  = (i0 >= 0) & (i0 < nx) & (j0 >= 0) & (j0 < ny)
+                index   = (np.clip(j0, 0, ny - 1) * nx + np.clip(i0, 0, nx - 1))[:, None]
+                weights = np.ones(index.shape)
+            else:
+                eps     = 1e-6 # Points on the boundary
+                inside  = (i > -eps) & (i < nx - 1 + eps) & (j > -eps) & (j < ny - 1 + eps)
+                i0 = np.clip(np.floor(i).astype(int), 0, nx - 2)
+                j0 = np.clip(np.floor(j).astype(int), 0, ny - 2)
+                fi, fj  = i - i0, j - j0
+                index   = np.stack([j0 * nx + i0, j0 * nx + i0 + 1,
+                                    (j0 + 1) * nx + i0, (j0 + 1) * nx + i0 + 1], axis = 1)
+                weights = np.stack([(1 - fi) * (1 - fj), fi * (1 - fj), (1 - fi) * fj, fi * fj], axis = 1)
+            index[~inside]   = 0
+            weights[~inside] = np.nan
+            if not inside.all():
+                print("[!] {:d} stations outside the domain".format(int((~inside).sum())))
+
+            os.makedirs(self.dir, exist_ok = True)
+            tmp = "{:s}.tmp.npz".format(self.index_file[:-4])
+            np.savez(tmp, key = key, index = index, weights = weights)
+            os.replace(tmp, self.index_file)
+            self._grid, self._index = dict(grid), (index, weights)
+            return self._index
+
+    def extract(self, values, grid):
+        """extract(values, grid)
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            decoded field (see grib2.decode_message).
+        grid : dict
+            grid definition of the field (see grib2.message_grid).
+
+        Returns
+        -------
+        numpy.ndarray with the values at the stations.
+        """
+        index, weights = self.index(grid)
+        return (values.reshape(-1)[index] * weights).sum(axis = 1)
+
+    def append(self, param, date, step, values, grid):
+        """append(param, date, step, values, grid)
+
+        Extracts the values at the stations (see extract) and appends
+        them to the time series of the parameter ('file').
+        """
+        import os
+        import fcntl
+        res  = self.extract(values, grid)
+        file = self.file(param)
+        row  = "{:s},{:d},{:s}\n".format(date.strftime("%Y%m%d%H"), step,
+                                         ",".join(["{:.6g}".format(x) for x in res]))
+        os.makedirs(os.path.dirname(file), exist_ok = True)
+        with open(file, "a") as fid:
+            fcntl.flock(fid, fcntl.LOCK_EX)
+            try:
+                if fid.tell() == 0:
+                    fid.write(",".join(["run", "step"] + self.names) + "\n")
+                fid.write(row)
+            finally:
+                fcntl.flock(fid, fcntl.LOCK_UN)
+
+    def file(self, param):
+        """file(param)
+
+        Returns
+        -------
+        Name of the CSV file with the time series of parameter 'param'.
+        """
+        import os
+        return os.path.join(self.dir, self.config.domain, "{:s}.csv".format(param))
+
+    def read(self, param, station = None):
+        """read(param, station = None)
+
+        Parameters
+        ----------
+        param : str
+            name of the parameter.
+        station : None or str
+            name of the station; all if None.
+
+        Returns
+        -------
+        Tuple (runs, steps, values): list of the runs (datetime.datetime),
+        numpy array with the steps, and numpy array with the values
+        (row, station; one-dimensional if 'station' is set) sorted by
+        run and step. If a field has been processed several times, the
+        last row is used.
+        """
+        import csv
+        import datetime as dt
+        import numpy as np
+        with open(self.file(param), "r") as fid:
+            rows = list(csv.reader(fid))
+        header, rows = rows[0], dict([((x[0], int(x[1])), x[2:]) for x in rows[1:]])
+        if not header[2:] == self.names:
+            raise ValueError("stations in {:s} differ from {:s}".format(self.file(param),
+                             self.config.stations_file))
+        keys   = sorted(rows)
+        runs   = [dt.datetime.strptime(x[0], "%Y%m%d%H") for x in keys]
+        values = np.array([rows[x] for x in keys], dtype = float).reshape((len(keys), len(self.names)))
+        if station is not None: values = values[:, self.names.index(station)]
+        return runs, np.array([x[1] for x in keys], dtype = int), values
+
+    def __repr__(self):
+        return "Station extractor: {:d} stations ({:s}), {:s}".format(len(self.names),
+               self.method, self.dir)
@@ -0,0 +1,406 @@
+# -------------------------------------------------------------------
+# - NAME:        store.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Chunked, compressed on-disc array store used by
+#                functions.py: the decoded fields are stored per
+#                parameter for fast time series (point/box) reads.
+# -------------------------------------------------------------------
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class array_store(object):
+
+    # Run index 0 (see _index)
+    ORIGIN = "20000101"
+
+    def __init__(self, config):
+        """array_store(config)
+
+        Chunked, compressed on-disc array store for fast time series
+        extraction ('config.store_dir', one directory per domain and
+        parameter). The fields of a parameter are stored as an array
+        (run, step, y, x) split into blocks of 'config.store_runs'
+        consecutive runs. New fields are written into the (uncompressed,
+        memory-mapped) block file; once all runs and steps of a block
+        are available, or once newer runs are stored (see 'compact', called
+        at the end of each run/poll), the block is split into tiles
+        of 'config.store_tile' x 'config.store_tile' grid points
+        (all runs and steps of the block) which are compressed (zlib,
+        byte-shuffled) and stored one after another. Point and box reads
+        only read (memory-mapped) the tiles needed.
+
+        Parameters
+        ----------
+        config : read_config object
+            As returned by 'read_config()'
+
+        Details
+        -------
+        Files of parameter 'param' (<dir>/<domain>/<param>/):
+        - meta.json: grid size, steps, runhours, chunk size, grid definition.
+        - <block>.raw: uncompressed block (float32; run, step, y, x).
+        - <block>.mask: fields available in the block (uint8; run, step).
+        - <block>.tiles: compressed tiles (only once compacted).
+        - <block>.offsets.npy: byte offset and length of each tile.
+        Runs are numbered consecutively using the runhours of the store
+        (starting at ORIGIN), the blocks are named after their first run.
+        Concurrent processes are synchronized using file locks.
+        """
+        import os
+        self.config = config
+        self.dir    = os.path.join(config.store_dir, config.domain)
+        self.runs   = config.store_runs
+        self.tile   = config.store_tile
+        self.level  = config.store_level
+        self._meta  = {}
+
+    def _path(self, param, name = None):
+        import os
+        return os.path.join(self.dir, param) if name is None else os.path.join(self.dir, param, name)
+
+    def _lock(self, param, shared = False):
+        """_lock(param, shared = False)
+
+        Returns a context manager holding a lock on the files of 'param'
+        (exclusive, or shared for reading).
+        """
+        import fcntl
+        from contextlib import contextmanager
+        @contextmanager
+        def lock():
+            with open(self._path(param, ".lock"), "a") as fid:
+                fcntl.flock(fid, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fid, fcntl.LOCK_UN)
+        return lock()
+
+    def params(self):
+        """params()
+
+        Returns
+        -------
+        List with the names of the parameters in the store.
+        """
+        import os
+        if not os.path.isdir(self.dir): return []
+        return sorted([x for x in os.listdir(self.dir) if os.path.isfile(self._path(x, "meta.json"))])
+
+    def meta(self, param):
+        """meta(param)
+
+        Returns
+        -------
+        None if the parameter is not in the store, else a dictionary with
+        the grid size ("ny", "nx"), the steps and runhours, the number
+        of runs per block ("runs"), the tile size ("tile"), and the grid
+        definition ("grid", see grib2.message_grid; None if unknown).
+        """
+        import os
+        import json
+        if not param in self._meta:
+            if not os.path.isfile(self._path(param, "meta.json")): return None
+            with open(self._path(param, "meta.json"), "r") as fid:
+                self._meta[param] = json.load(fid)
+        return self._meta[param]
+
+    def _create(self, param, shape, grid):
+        # Creates the directory and meta data of a new parameter
+        import os
+        import json
+        os.makedirs(self._path(param), exist_ok = True)
+        with self._lock(param):
+            if self.meta(param) is not None: return
+            meta = {"ny": int(shape[0]), "nx": int(shape[1]),
+                    "steps": sorted([int(x) for x in self.config.steps]),
+                    "runhours": sorted([int(x) for x in self.config.runhours]),
+                    "runs": self.runs, "tile": self.tile, "origin": array_store.ORIGIN, "grid": grid}
+            tmp  = self._path(param, "meta.json.tmp")
+            with open(tmp, "w") as fid: json.dump(meta, fid)
+            os.replace(tmp, self._path(param, "meta.json"))
+
+    def _index(self, meta, date, step):
+        """_index(meta, date, step)
+
+        Returns
+        -------
+        Tuple (block, run, step) with the number of the block and the
+        position of the field within the block.
+        """
+        import datetime as dt
+        if not date.hour in meta["runhours"] or not step in meta["steps"]:
+            raise ValueError("run {:s} +{:d}h not covered by the store ".format(
+                             date.strftime("%Y-%m-%d %H UTC"), step) + \
+                             "(runhours/steps changed? use another store dir)")
+        days = (date - dt.datetime.strptime(meta["origin"], "%Y%m%d")).days
+        run  = days * len(meta["runhours"]) + meta["runhours"].index(date.hour)
+        return run // meta["runs"], run % meta["runs"], meta["steps"].index(step)
+
+    def _run_date(self, meta, run):
+        # Initialization of run number 'run' (see _index)
+        import datetime as dt
+        days, k = divmod(run, len(meta["runhours"]))
+        return dt.datetime.strptime(meta["origin"], "%Y%m%d") + \
+               dt.timedelta(days = days, hours = meta["runhours"][k])
+
+    def _block_name(self, meta, block):
+        return self._run_date(meta, block * meta["runs"]).strftime("%Y%m%d%H")
+
+    def blocks(self, param):
+        """blocks(param)
+
+        Returns
+        -------
+        Dictionary block number: state ("raw" or "tiles") of all blocks.
+        """
+        import os
+        import datetime as dt
+        meta = self.meta(param)
+        if meta is None: return {}
+        res = {}
+        for file in os.listdir(self._path(param)):
+            name, ext = os.path.splitext(file)
+            if not ext in [".raw", ".tiles"]: continue
+            block = self._index(meta, dt.datetime.strptime(name, "%Y%m%d%H"), meta["steps"][0])[0]
+            if not block in res or ext == ".raw": res[block] = ext[1:]
+        return res
+
+    def _mask(self, param, meta, block, mode = "r"):
+        # Fields available in a block (uint8 memmap; run, step)
+        from numpy import memmap, uint8
+        return memmap(self._path(param, self._block_name(meta, block) + ".mask"), dtype = uint8,
+                      mode = mode, shape = (meta["runs"], len(meta["steps"])))
+
+    def _raw(self, param, meta, block, mode = "r"):
+        # Uncompressed block (float32 memmap; run, step, y, x)
+        from numpy import memmap, float32
+        return memmap(self._path(param, self._block_name(meta, block) + ".raw"), dtype = float32,
+                      mode = mode, shape = (meta["runs"], len(meta["steps"]), meta["ny"], meta["nx"]))
+
+    def _tiles(self, meta):
+        # Slices (y, x) of all tiles
+        tile = meta["tile"]
+        return [[(slice(y, min(y + tile, meta["ny"])), slice(x, min(x + tile, meta["nx"])))
+                 for x in range(0, meta["nx"], tile)] for y in range(0, meta["ny"], tile)]
+
+    def append(self, param, date, step, values, grid = None):
+        """append(param, date, step, values, grid = None)
+
+        Writes one field into the store. Existing fields are replaced.
+
+        Parameters
+        ----------
+        param : str
+            name of the parameter.
+        date : datetime.datetime
+            model initialization.
+        step : int
+            forecast step.
+        values : numpy.ndarray
+            the field (ny, nx), see grib2.decode_message.
+        grid : None or dict
+            grid definition (see grib2.message_grid), stored when adding
+            a new parameter.
+        """
+        import os
+        if self.meta(param) is None: self._create(param, values.shape, grid)
+        meta = self.meta(param)
+        if not values.shape == (meta["ny"], meta["nx"]):
+            raise ValueError("field {:s} ({:s}) does not match the grid of the store".format(
+                             param, "x".join([str(x) for x in values.shape])))
+        block, run, k = self._index(meta, date, step)
+        name = self._block_name(meta, block)
+        with self._lock(param):
+            if not os.path.isfile(self._path(param, name + ".raw")):
+                if os.path.isfile(self._path(param, name + ".tiles")):
+                    self._expand(param, meta, block)
+                else:
+                    # New (sparse) block
+                    with open(self._path(param, name + ".raw"), "wb") as fid:
+                        fid.truncate(4 * meta["runs"] * len(meta["steps"]) * meta["ny"] * meta["nx"])
+                    if not os.path.isfile(self._path(param, name + ".mask")):
+                        with open(self._path(param, name + ".mask"), "wb") as fid:
+                            fid.truncate(meta["runs"] * len(meta["steps"]))
+            raw = self._raw(param, meta, block, "r+")
+            raw[run, k] = values
+            raw.flush()
+            del raw
+            mask = self._mask(param, meta, block, "r+")
+            mask[run, k] = 1
+            mask.flush()
+            complete = bool(mask.all())
+            del mask
+            if complete: self._compact(param, meta, block)
+
+    def compact(self, param = None, newest = True):
+        """compact(param = None, newest = True)
+
+        Compresses all (incomplete) blocks not yet compressed. Fields
+        can still be added afterwards (the block is expanded again).
+
+        Parameters
+        ----------
+        param : None or str
+            name of the parameter; all if None.
+        newest : bool
+            if False, the newest block of each parameter (still being
+            written) is not compressed.
+        """
+        for param in self.params() if param is None else [param]:
+            meta = self.meta(param)
+            with self._lock(param):
+                blocks = self.blocks(param)
+                for block,state in blocks.items():
+                    if not state == "raw" or (not newest and block == max(blocks)): continue
+                    self._compact(param, meta, block)
+
+    def _compact(self, param, meta, block):
+        """_compact(param, meta, block)
+
+        Splits a block into tiles, compresses them, and removes the
+        uncompressed block. Fields not available are stored as NaN.
+        Requires the exclusive lock.
+        """
+        import os
+        import zlib
+        from numpy import array, int64, nan
+        name    = self._block_name(meta, block)
+        raw     = self._raw(param, meta, block)
+        missing = self._mask(param, meta, block) == 0
+        tiles   = self._tiles(meta)
+        offsets = array([[[0, 0]] * len(tiles[0])] * len(tiles), dtype = int64)
+        tmp     = self._path(param, name + ".tiles.tmp")
+        with open(tmp, "wb") as fid:
+            for i,row in enumerate(tiles):
+                for j,(y,x) in enumerate(row):
+                    data = array(raw[:, :, y, x])
+                    data[missing] = nan
+                    # Byte shuffle (float32) improves compression
+                    data = zlib.compress(data.view("uint8").reshape((-1, 4)).T.tobytes(), self.level)
+                    offsets[i, j] = fid.tell(), len(data)
+                    fid.write(data)
+        del raw
+        with open(self._path(param, name + ".offsets.npy.tmp"), "wb") as fid:
+            from numpy import save
+            save(fid, offsets)
+        os.replace(self._path(param, name + ".offsets.npy.tmp"), self._path(param, name + ".offsets.npy"))
+        os.replace(tmp, self._path(param, name + ".tiles"))
+        os.remove(self._path(param, name + ".raw"))
+
+    def _read_tile(self, meta, tiles, offsets, i, j):
+        # Decompresses one tile (run, step, y, x)
+        import zlib
+        from numpy import frombuffer, uint8
+        y, x  = self._tiles(meta)[i][j]
+        shape = (meta["runs"], len(meta["steps"]), y.stop - y.start, x.stop - x.start)
+        data  = zlib.decompress(tiles[offsets[i, j, 0]:(offsets[i, j, 0] + offsets[i, j, 1])])
+        return frombuffer(data, dtype = uint8).reshape((4, -1)).T.copy().view("float32").reshape(shape)
+
+    def _expand(self, param, meta, block):
+        # Converts a compressed block back into an uncompressed block
+        import os
+        import mmap
+        from numpy import load
+        name    = self._block_name(meta, block)
+        offsets = load(self._path(param, name + ".offsets.npy"))
+        tmp     = self._path(param, name + ".raw.tmp")
+        with open(tmp, "wb") as fid:
+            fid.truncate(4 * meta["runs"] * len(meta["steps"]) * meta["ny"] * meta["nx"])
+        from numpy import memmap, float32
+        raw = memmap(tmp, dtype = float32, mode = "r+",
+                     shape = (meta["runs"], len(meta["steps"]), meta["ny"], meta["nx"]))
+        with open(self._path(param, name + ".tiles"), "rb") as fid:
+            tiles = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+            for i,row in enumerate(self._tiles(meta)):
+                for j,(y,x) in enumerate(row):
+                    raw[:, :, y, x] = self._read_tile(meta, tiles, offsets, i, j)
+            tiles.close()
+        raw.flush()
+        del raw
+        os.replace(tmp, self._path(param, name + ".raw"))
+        os.remove(self._path(param, name + ".tiles"))
+        os.remove(self._path(param, name + ".offsets.npy"))
+
+    def read(self, param, y, x, start = None, end = None):
+        """read(param, y, x, start = None, end = None)
+
+        Reads a time series of one grid point or a box.
+
+        Parameters
+        ----------
+        param : str
+            name of the parameter.
+        y, x : int or slice
+            grid point (row, column; see grib2.decode_message) or box.
+        start, end : None or datetime.datetime
+            first and last run (model initialization) to be read.
+
+        Returns
+        -------
+        Tuple (runs, steps, values): list of the runs (datetime.datetime)
+        available, list of the steps, and a numpy.ndarray (run, step) for
+        a grid point or (run, step, y, x) for a box. Fields not available
+        are NaN.
+        """
+        import mmap
+        from numpy import load, nan, concatenate, empty, float32
+        meta = self.meta(param)
+        if meta is None:
+            raise ValueError("parameter \"{:s}\" not in store {:s}".format(param, self.dir))
+        ys = y if isinstance(y, slice) else slice(y, y + 1)
+        xs = x if isinstance(x, slice) else slice(x, x + 1)
+        ys = slice(*ys.indices(meta["ny"])[:2])
+        xs = slice(*xs.indices(meta["nx"])[:2])
+        tile = meta["tile"]
+        first = None if start is None else self._index(meta, start, meta["steps"][0])[:2]
+        last  = None if end   is None else self._index(meta, end,   meta["steps"][0])[:2]
+
+        runs, values = [], []
+        with self._lock(param, shared = True):
+            for block,state in sorted(self.blocks(param).items()):
+                if first is not None and block < first[0]: continue
+                if last  is not None and block > last[0]:  continue
+                name  = self._block_name(meta, block)
+                shape = (meta["runs"], len(meta["steps"]), ys.stop - ys.start, xs.stop - xs.start)
+                mask  = self._mask(param, meta, block)[:].copy()
+                if state == "raw":
+                    data = self._raw(param, meta, block)[:, :, ys, xs].copy()
+                    data[mask == 0] = nan
+                else:
+                    # Only the tiles overlapping the box
+                    data    = empty(shape, dtype = float32)
+                    offsets = load(self._path(param, name + ".offsets.npy"), mmap_mode = "r")
+                    with open(self._path(param, name + ".tiles"), "rb") as fid:
+                        tiles = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+                        for i in range(ys.start // tile, (ys.stop - 1) // tile + 1):
+                            for j in range(xs.start // tile, (xs.stop - 1) // tile + 1):
+                                y0, x0 = max(ys.start, i * tile), max(xs.start, j * tile)
+                                y1, x1 = min(ys.stop, (i + 1) * tile), min(xs.stop, (j + 1) * tile)
+                                data[:, :, (y0 - ys.start):(y1 - ys.start), (x0 - xs.start):(x1 - xs.start)] = \
+                                    self._read_tile(meta, tiles, offsets, i, j)[:, :, (y0 - i * tile):(y1 - i * tile),
+                                                                                (x0 - j * tile):(x1 - j * tile)]
+                        tiles.close()
+                # Runs with at least one field
+                for run in range(meta["runs"]):
+                    if not mask[run].any(): continue
+                    if first is not None and (block, run) < first: continue
+                    if last  is not None and (block, run) > last:  continue
+                    runs.append(self._run_date(meta, block * meta["runs"] + run))
+                    values.append(data[run])
+
+        shape  = (0, len(meta["steps"]), ys.stop - ys.start, xs.stop - xs.start)
+        values = empty(shape, dtype = float32) if len(values) == 0 else \
+                 concatenate([v[None] for v in values])
+        if not isinstance(y, slice) and not isinstance(x, slice): values = values[:, :, 0, 0]
+        return runs, meta["steps"], values
+
+    def __repr__(self):
+        res = "Array store {:s} (blocks of {:d} runs, tiles of {:d}x{:d} points):\n".format(
+              self.dir, self.runs, self.tile, self.tile)
+        for param in self.params():
+            blocks = self.blocks(param)
+            res += "   - {:10s} {:d} blocks ({:d} uncompressed)\n".format(param, len(blocks),
+                   len([x for x in blocks.values() if x == "raw"]))
+        return res
@@ -0,0 +1,102 @@
+# -------------------------------------------------------------------
+# - NAME:        test_grib2.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Regression tests of the grib2 decoder (grib2.py).
+#                The messages are created with the encoder of the
+#                stand-in server (tools/standin_server.py) from fields
+#                with known values. Run with
+#                python -m unittest discover tests
+# -------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+import datetime as dt
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+import grib2
+import standin_server
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class test_decode_message(unittest.TestCase):
+
+    # Small grid (ny, nx); the group size does not divide the number
+    # of points (last group shorter).
+    NY, NX = 9, 13
+
+    def field(self):
+        # Integer values (exact after packing): trend plus some noise
+        y, x = np.mgrid[0:self.NY, 0:self.NX]
+        return (1000. + 7. * x - 3. * y + (x * y) % 5).astype(np.float64)
+
+    def encode(self, values, **kwargs):
+        return standin_server.encode_message(dt.datetime(2020, 6, 16), 0, standin_server.MESSAGES[7],
+                                             values, standin_server.GRID, **kwargs)
+
+    def section5(self, msg):
+        # Template and order of spatial differencing (section 5)
+        s5 = grib2.message_sections(msg)[5]
+        template = grib2._uint(msg, s5 + 9, 2)
+        return template, msg[s5 + 47] if template == 3 else 0
+
+    def check(self, msg, expected, template, order = 0):
+        self.assertEqual(self.section5(msg), (template, order))
+        res = grib2.decode_message(msg, "float64")
+        self.assertEqual(res.shape, expected.shape)
+        np.testing.assert_array_equal(np.isnan(res), np.isnan(expected))
+        np.testing.assert_allclose(res, expected, rtol = 0, atol = 1e-9)
+
+    def test_simple_packing(self):
+        values = self.field()
+        self.check(self.encode(values), values, 0)
+
+    def test_complex_packing(self):
+        values = self.field()
+        self.check(self.encode(values, template = 2, group = 8), values, 2)
+
+    def test_spatial_differencing(self):
+        values = self.field()
+        for order in [1, 2]:
+            self.check(self.encode(values, template = 3, order = order, group = 8), values, 3, order)
+
+    def test_spatial_differencing_negative(self):
+        # Decreasing values: negative first differences, negative minimum
+        values = self.field()[:, ::-1] - 1500.
+        for order in [1, 2]:
+            self.check(self.encode(values, template = 3, order = order, group = 8), values, 3, order)
+
+    def test_missing_values(self):
+        # Missing value management: single missing values and one
+        # group (points 16-23) with missing values only
+        values = self.field()
+        values.ravel()[[0, 5, 40, 41, 100]] = np.nan
+        values.ravel()[16:24] = np.nan
+        for template,order in [(2, 0), (3, 1), (3, 2)]:
+            msg = self.encode(values, template = template, order = order, group = 8)
+            self.check(msg, values, template, order)
+
+    def test_bitmap(self):
+        values = self.field()
+        values.ravel()[[3, 4, 50, 116]] = np.nan
+        for template,order in [(0, 0), (3, 2)]:
+            msg = self.encode(values, template = template, order = order, bitmap = True, group = 8)
+            self.assertEqual(msg[grib2.message_sections(msg)[6] + 5], 0) # Bitmap present
+            self.check(msg, values, template, order)
+
+    def test_known_values(self):
+        # Grid point values as stored (rows south to north)
+        values = self.field()
+        res    = grib2.decode_message(self.encode(values, template = 3, order = 2, group = 8), "float64")
+        self.assertEqual(res[0, 0], 1000.)
+        self.assertEqual(res[0, 12], 1084.)
+        self.assertEqual(res[8, 0], 976.)
+        self.assertEqual(res[8, 12], 1061.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        bench_index_parser.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Micro-benchmark, compares the column-wise index file
+#                parser (functions.parse_index_file) against the old
+#                line-by-line parser using a synthetic wrfprs-like
+#                index file.
+# -------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+import tempfile
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import functions
+
+
+# -------------------------------------------------------------------
+# Old (line-by-line) parser, used as reference
+# -------------------------------------------------------------------
+class legacy_index_entry(object):
+
+    def __init__(self, args):
+        from re import sub
+        self._byte_start = int(args["byte_start"])
+        self._byte_end   = False
+        self._var        = str(args["param"])
+        self._step       = str(args["step"])
+        self._lev        = sub(r"(\(|\)|\[|\]|\{|\})", "", str(args["level"]))
+
+    def add_end_byte(self, x):
+        self._byte_end = x
+
+    def start_byte(self):
+        return self._byte_start
+
+    def key(self):
+        return "{:s}:{:s}:{:s}".format(self._var, self._lev, self._step)
+
+    def step(self):
+        from re import match
+        tmp = match(r"^\d+-(\d+)\s\w+.*$", self._step)
+        if tmp: return int(tmp.group(1))
+        tmp = match(r"^(\d+)\s(\w+).*$", self._step)
+        if tmp and tmp.group(2) == "hour": return int(tmp.group(1))
+        raise Exception("Don't know how to deal with '{:s}'.".format(self._step))
+
+    def range(self):
+        end = "" if self._byte_end is None else "{:d}".format(self._byte_end)
+        return "{:d}-{:s}".format(self._byte_start, end)
+
+def legacy_parse_index_file(idxfile):
+    from re import compile, findall
+    with open(idxfile, "r") as fid:
+        data = "".join(fid.readlines()).split("\n")
+    idx_entries = []
+    comp = compile("^\\d+:(\\d+):d=(\\d{10}):([^:.?]+):([^:\\..?]*):(.*?):$")
+    comp_keys = ["byte_start", "date", "param", "level", "step"]
+    for line in data:
+        if len(line) == 0: continue
+        mtch = findall(comp, line.replace(".", "-"))
+        if not mtch:
+            raise Exception("whoops, pattern mismatch \"{:s}\"".format(line))
+        idx_entries.append(legacy_index_entry(dict(zip(comp_keys, mtch[0]))))
+    for k in range(0, len(idx_entries)):
+        if (k + 1) == len(idx_entries):
+            idx_entries[k].add_end_byte(None)
+        else:
+            idx_entries[k].add_end_byte(idx_entries[k+1].start_byte() - 1)
+    return idx_entries
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def synthetic_index(nlines, step = 3):
+    """synthetic_index(nlines, step = 3)
+
+    Returns the content of a wrfprs-like index file with 'nlines' lines.
+    """
+    params = ["HGT", "TMP", "RH", "DPT", "SPFH", "VVEL", "UGRD", "VGRD", "ABSV", "CLWMR",
+              "CICE", "RWMR", "SNMR", "GRLE", "APCP", "WEASD", "TCDC", "REFC"]
+    levels = ["{:d} mb".format(p) for p in range(1000, 25, -25)] + \
+             ["surface", "2 m above ground", "10 m above ground", "entire atmosphere (considered as a single layer)"]
+    lines = []
+    byte  = 0
+    for i in range(nlines):
+        param = params[i % len(params)]
+        level = levels[(i // len(params)) % len(levels)]
+        fcst  = "0-{:d} hour acc fcst".format(step) if param == "APCP" else "{:d} hour fcst".format(step)
+        lines.append("{:d}:{:d}:d=2020061600:{:s}:{:s}:{:s}:".format(i + 1, byte, param, level, fcst))
+        byte += 500000 + (i * 7919) % 300000
+    return "\n".join(lines) + "\n"
+
+
+# -------------------------------------------------------------------
+# Main script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark of the index file parser")
+    parser.add_argument("--lines", "-l", type = int, default = 1000,
+               help = "Number of lines of the synthetic index file. Default is 1000.")
+    parser.add_argument("--number", "-n", type = int, default = 20,
+               help = "Number of repetitions per timing. Default is 20.")
+    args = vars(parser.parse_args())
+
+    tmp = tempfile.NamedTemporaryFile(prefix = "HRRR_idx_", suffix = ".idx", mode = "w")
+    tmp.write(synthetic_index(args["lines"]))
+    tmp.flush()
+
+    # Both parsers have to give the same result
+    old = legacy_parse_index_file(tmp.name)
+    new = functions.parse_index_file(tmp.name, remote = False)
+    assert [x.key() for x in old] == [x.key() for x in new]
+    assert [x.range() for x in old] == [x.range() for x in new]
+    assert [x.step() for x in old] == [x.step() for x in new]
+
+    def parse_old(): legacy_parse_index_file(tmp.name)
+    def parse_new(): functions.parse_index_file(tmp.name, remote = False)
+    def access_old(): [(x.key(), x.step(), x.range()) for x in old]
+    def access_new(): [(x.key(), x.step(), x.range()) for x in new]
+
+    print("Index file with {:d} lines, best of 5 x {:d} repetitions".format(args["lines"], args["number"]))
+    print("{:25s} {:>12s} {:>12s} {:>8s}".format("", "old [ms]", "new [ms]", "speedup"))
+    for name, fold, fnew in [("parse", parse_old, parse_new),
+                             ("key/step/range access", access_old, access_new)]:
+        told = min(repeat(fold, number = args["number"], repeat = 5)) / args["number"] * 1e3
+        tnew = min(repeat(fnew, number = args["number"], repeat = 5)) / args["number"] * 1e3
+        print("{:25s} {:12.3f} {:12.3f} {:7.1f}x".format(name, told, tnew, told / tnew))
+
+    tmp.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        bench_listing_parser.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Micro-benchmark, compares the streaming listing
+#                parser (functions.get_listing_links with the filter
+#                from functions.gribfile_pattern) against the old
+#                BeautifulSoup based one using a synthetic (NOMADS
+#                like) conus directory listing.
+# -------------------------------------------------------------------
+
+import sys
+import os
+import io
+import argparse
+from types import SimpleNamespace
+from timeit import repeat
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import functions
+
+
+# -------------------------------------------------------------------
+# Old (BeautifulSoup) parser, used as reference; bs4 is optional
+# -------------------------------------------------------------------
+def legacy_get_files(config, dir, data):
+    from re import match
+    from bs4 import BeautifulSoup
+    result = []
+    root = BeautifulSoup(data, "html.parser")
+    for node in root.find_all("a"):
+        if match(r"^hrrr\..*\.grib2$", node.text):
+            tmp = functions.gribfile(config, dir, node.text)
+            if tmp.get("step") in config.steps and \
+               tmp.get("runhour") in config.runhours and \
+               tmp.get("type") in config._types:
+                   result.append(tmp)
+    return result
+
+
+def new_get_files(config, dir, data):
+    names = functions.get_listing_links(io.BytesIO(data), functions.gribfile_pattern(config))
+    return [functions.gribfile(config, dir, name) for name in names]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def synthetic_listing(types, runhours = range(24)):
+    """synthetic_listing(types, runhours = range(24))
+
+    Returns a conus directory listing (Apache style, bytes) with
+    grib files and index files for all 'types' and 'runhours'
+    (48 forecast steps for the main runs, 18 else).
+    """
+    rows = []
+    for rh in runhours:
+        for t in types:
+            for s in range(49 if rh % 6 == 0 else 19):
+                for name in ["hrrr.t{:02d}z.{:s}f{:02d}.grib2".format(rh, t, s)]:
+                    for x,size in [(name, "131M"), (name + ".idx", " 35K")]:
+                        rows.append("<a href=\"{0:s}\">{0:s}</a>{1:s}16-Jun-2020 {2:02d}:{3:02d}  {4:s}".format(
+                                    x, " " * (40 - len(x)), rh, s, size))
+    html = "<html>\n<head><title>Index of /pub/data/nccf/com/hrrr/prod/hrrr.20200616/conus</title></head>\n" + \
+           "<body>\n<h1>Index of /pub/data/nccf/com/hrrr/prod/hrrr.20200616/conus</h1>\n" + \
+           "<pre>Name                                    Last modified      Size  <hr>" + \
+           "<a href=\"/pub/data/nccf/com/hrrr/prod/hrrr.20200616/\">Parent Directory</a>\n" + \
+           "\n".join(rows) + "\n<hr></pre>\n</body></html>\n"
+    return html.encode("utf-8")
+
+
+# -------------------------------------------------------------------
+# Main script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark of the directory listing parser")
+    parser.add_argument("--types", type = str, default = "wrfsfc,wrfprs,wrfnat,wrfsubh",
+               help = "File types in the listing, comma separated. Default is wrfsfc,wrfprs,wrfnat,wrfsubh.")
+    parser.add_argument("--number", "-n", type = int, default = 5,
+               help = "Number of repetitions per timing. Default is 5.")
+    args = vars(parser.parse_args())
+
+    data   = synthetic_listing(args["types"].split(","))
+    config = SimpleNamespace(url = "https://nomads.ncep.noaa.gov/pub/data/nccf/com/hrrr/prod",
+                             domain = "conus", gribdir = "grib", steps = [0, 1, 2],
+                             runhours = [0, 6, 12, 18], _types = ["wrfsfc"])
+    dir    = "hrrr.20200616"
+
+    try:
+        import bs4
+    except ImportError:
+        bs4 = None
+        print("[!] bs4 not installed, only timing the new parser")
+
+    # Both parsers have to give the same result
+    new = new_get_files(config, dir, data)
+    if bs4 is not None:
+        old = legacy_get_files(config, dir, data)
+        assert [x.get("url") for x in old] == [x.get("url") for x in new]
+
+    nlinks = data.count(b"<a ")
+    print("Listing with {:d} links ({:.1f} kB), {:d} files selected, best of 5 x {:d} repetitions".format(
+          nlinks, len(data) / 1e3, len(new), args["number"]))
+    print("{:25s} {:>12s} {:>12s} {:>8s}".format("", "old [ms]", "new [ms]", "speedup"))
+    tests = [("parse and filter", lambda: legacy_get_files(config, dir, data),
+                                  lambda: new_get_files(config, dir, data)),
+             ("links only",       lambda: bs4.BeautifulSoup(data, "html.parser").find_all("a"),
+                                  lambda: functions.get_listing_links(data))]
+    for name, fold, fnew in tests:
+        tnew = min(repeat(fnew, number = args["number"], repeat = 5)) / args["number"] * 1e3
+        if bs4 is None:
+            print("{:25s} {:>12s} {:12.3f} {:>8s}".format(name, "-", tnew, "-"))
+            continue
+        told = min(repeat(fold, number = args["number"], repeat = 5)) / args["number"] * 1e3
+        print("{:25s} {:12.3f} {:12.3f} {:7.1f}x".format(name, told, tnew, told / tnew))
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        benchmark.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: End-to-end benchmark of the downloader using the
+#                local stand-in server (standin_server.py). Reports
+#                files/s, MB/s, request counts, and per-phase timings,
+#                and checks the downloaded files byte by byte.
+# -------------------------------------------------------------------
+
+import sys
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import configparser
+from time import perf_counter
+from urllib.request import urlopen
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT  = os.path.join(TOOLS, "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, TOOLS)
+import functions
+import standin_server
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def write_config(file, url, gribdir, args, options = None):
+    """write_config(file, url, gribdir, args, options = None)
+
+    Writes a config file for the benchmark, based on config.conf.
+
+    Parameters
+    ----------
+    file : str
+        name of the config file to be written.
+    url : str
+        URL of the (stand-in) server.
+    gribdir : str
+        where to store the grib files.
+    args : dict
+        arguments (see standin_server.parse_args).
+    options : None or list
+        additional options, list of "section:key=value" strings.
+    """
+    CNF = configparser.RawConfigParser()
+    CNF.read(os.path.join(ROOT, "config.conf"))
+    CNF.set("main", "url", url)
+    CNF.set("main", "gribdir", gribdir)
+    CNF.set("main", "steps", ", ".join([str(x) for x in args["steps"]]))
+    CNF.set("main", "runhours", ", ".join([str(x) for x in args["runhours"]]))
+    # No request rate limit by default (-o download:rate=<value> to set)
+    CNF.set("download", "rate", "0")
+    for key,val in CNF.items("types"):
+        CNF.set("types", key, str(key in args["types"]))
+    for rec in ([] if options is None else options):
+        section, rec = rec.split(":", 1)
+        key, val     = rec.split("=", 1)
+        if not CNF.has_section(section): CNF.add_section(section)
+        CNF.set(section, key.strip(), val.strip())
+    with open(file, "w") as fid: CNF.write(fid)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def disc_usage(dir):
+    """disc_usage(dir)
+
+    Returns
+    -------
+    Tuple (number of files, bytes) of the grib files in 'dir'.
+    """
+    nfiles = 0
+    nbytes = 0
+    for root, dirs, files in os.walk(dir):
+        dirs[:] = [x for x in dirs if not x.startswith(".")]
+        for x in files:
+            if x.endswith(".grib2") or x.endswith(".grb2"):
+                nfiles += 1
+                nbytes += os.path.getsize(os.path.join(root, x))
+    return nfiles, nbytes
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def verify(config, archive):
+    """verify(config, archive)
+
+    Compares the downloaded files byte by byte with the messages of the
+    synthetic archive served by the stand-in server: the combined file
+    has to contain the messages selected by the parameters of the config
+    (in the order of the remote file), each parameter-based file the
+    messages of its parameter.
+
+    Parameters
+    ----------
+    config : str
+        name of the config file used for the run.
+    archive : standin_server.synthetic_archive
+        the files served (the same arguments as the server).
+
+    Returns
+    -------
+    Tuple (number of files checked, list of problems). Each problem is
+    a string (missing or corrupt file).
+    """
+    config   = functions.read_config(config)
+    matcher  = functions.param_matcher(config.params)
+    checked  = 0
+    problems = []
+    for date in archive.dates:
+        dir = "hrrr.{:s}".format(date.strftime("%Y%m%d"))
+        for name in archive.files(date, True):
+            file = functions.gribfile(config, dir, name)
+            if not file.wanted(config): continue
+            data, idx = archive.get(date, name)
+            idx = functions.parse_index_data(idx.decode("utf-8"))
+            # Selected messages (unique, in the order of the remote file)
+            messages = {}
+            for param,x in matcher.select(idx):
+                end = len(data) - 1 if x.end_byte() is None else x.end_byte()
+                messages.setdefault(x.start_byte(), (param, data[x.start_byte():(end + 1)]))
+            if len(messages) == 0: continue
+            expected = []
+            if config.download_combined:
+                expected.append((file.get("local"), b"".join([messages[x][1] for x in sorted(messages)])))
+            if config.download_split:
+                for param,local in file.param_files(sorted(set([x[0] for x in messages.values()]))).items():
+                    expected.append((local, b"".join([messages[x][1] for x in sorted(messages)
+                                                      if messages[x][0] == param])))
+            for local,content in expected:
+                checked += 1
+                if not os.path.isfile(local):
+                    problems.append("missing: {:s}".format(local))
+                    continue
+                with open(local, "rb") as fid:
+                    if not fid.read() == content:
+                        problems.append("corrupt: {:s}".format(local))
+    return checked, problems
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def run_inprocess(config):
+    """run_inprocess(config)
+
+    Runs the downloader in this process.
+
+    Returns
+    -------
+    Tuple with a dictionary with the timings of the phases (seconds),
+    the download_stats object, and the host_limiter object.
+    """
+    config   = functions.read_config(config)
+    hosts    = functions.host_limiter(config)
+    metrics  = functions.download_metrics(config) if config.metrics_enabled else None
+    engine   = functions.transfer_engine(config) if config.curl_multi else None
+    timings  = {}
+    t0       = perf_counter()
+    files    = functions.get_gribfiles_on_server(config, hosts, metrics, engine).get("files")
+    timings["listing"] = perf_counter() - t0
+    t0       = perf_counter()
+    stats    = functions.download_gribfiles(config, files, hosts, metrics, engine)
+    timings["download"] = perf_counter() - t0
+    if metrics is not None: metrics.close()
+    if engine is not None: engine.close()
+    return timings, stats, hosts
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def run_subprocess(config):
+    """run_subprocess(config)
+
+    Runs download.py in a separate process.
+
+    Returns
+    -------
+    Dictionary with the timings (seconds).
+    """
+    t0  = perf_counter()
+    res = subprocess.run([sys.executable, os.path.join(ROOT, "download.py"), "--config", config],
+                         stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    if not res.returncode == 0:
+        print(res.stderr.decode("utf-8"))
+        raise Exception("download.py returned {:d}".format(res.returncode))
+    return {"download.py": perf_counter() - t0}
+
+
+# -------------------------------------------------------------------
+# Main script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "End-to-end benchmark using the stand-in server")
+    parser.add_argument("--url", type = str, default = None,
+               help = "URL of a running stand-in server. If not set, a server is started.")
+    parser.add_argument("--subprocess", action = "store_true",
+               help = "Run download.py in a separate process instead of in-process.")
+    parser.add_argument("--option", "-o", type = str, action = "append", default = [],
+               help = "Config option \"section:key=value\" (e.g., \"download:workers=8\"). " + \
+                      "Can be used several times.")
+    parser.add_argument("--repeat", type = int, default = 1,
+               help = "Number of runs (fresh output directory each time). Default is 1.")
+    parser.add_argument("--keep", action = "store_true",
+               help = "Keep the output directory.")
+    args = standin_server.parse_args(parser)
+
+    server = None
+    url    = args["url"]
+    if url is None:
+        server  = standin_server.create_server(args).start()
+        url     = server.url
+        archive = server.archive
+    else:
+        # Same content as served by the server (same arguments)
+        archive = standin_server.create_archive(args)
+
+    results = []
+    failed  = False
+    for k in range(args["repeat"]):
+
+        tmpdir  = tempfile.mkdtemp(prefix = "HRRR_benchmark_")
+        config  = os.path.join(tmpdir, "benchmark.conf")
+        write_config(config, url, os.path.join(tmpdir, "grib"), args, args["option"])
+
+        before  = json.loads(urlopen(url + "/_stats").read())
+        stdout  = sys.stdout
+        if args["subprocess"]:
+            timings = run_subprocess(config)
+            stats   = None
+            hosts   = None
+        else:
+            # Silence the downloader
+            sys.stdout = open(os.devnull, "w")
+            try:
+                timings, stats, hosts = run_inprocess(config)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        after   = json.loads(urlopen(url + "/_stats").read())
+        nfiles, nbytes = disc_usage(os.path.join(tmpdir, "grib"))
+        checked, problems = verify(config, archive)
+        failed = failed or len(problems) > 0
+
+        total = sum(timings.values())
+        res   = {"files": nfiles, "bytes": nbytes, "seconds": total,
+                 "files/s": nfiles / total, "MB/s": nbytes / 1e6 / total,
+                 "timings": timings,
+                 "phases": {} if stats is None else dict(stats.phases),
+                 "server": dict([(x, after.get(x, 0) - before.get(x, 0)) for x in after]),
+                 "checked": checked, "problems": problems}
+        results.append(res)
+
+        print("Run {:d}/{:d}:".format(k + 1, args["repeat"]))
+        print("   Files:                     {:d}".format(nfiles))
+        print("   Bytes on disc:             {:d} ({:.1f} MB)".format(nbytes, nbytes / 1e6))
+        print("   Total time:                {:.2f} seconds".format(total))
+        print("   Throughput:                {:.2f} files/s, {:.2f} MB/s".format(res["files/s"], res["MB/s"]))
+        print("   Verified:                  {:d} files, {:d} missing or corrupt".format(checked, len(problems)))
+        for x in problems:
+            print("   [!] {:s}".format(x))
+        for key,val in timings.items():
+            print("   Time {:21s} {:.2f} seconds".format(key + ":", val))
+        for key,val in res["phases"].items():
+            print("   Phase {:20s} {:.2f} seconds (all workers)".format(key + ":", val))
+        for key in sorted(res["server"]):
+            print("   Server {:19s} {:d}".format(key + ":", res["server"][key]))
+        if hosts is not None:
+            print(str(hosts).rstrip())
+
+        if args["keep"]:
+            print("   Output kept in {:s}".format(tmpdir))
+        else:
+            shutil.rmtree(tmpdir)
+
+    if args["repeat"] > 1:
+        best = min(results, key = lambda x: x["seconds"])
+        print("Best of {:d}: {:.2f} seconds, {:.2f} files/s, {:.2f} MB/s".format(
+              args["repeat"], best["seconds"], best["files/s"], best["MB/s"]))
+
+    if server is not None: server.stop()
+
+    # Missing or corrupt files: exit with an error
+    if failed: sys.exit(1)
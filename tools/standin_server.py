@@ -0,0 +1,774 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        standin_server.py
+# -------------------------------------------------------------------
+# - DESCRIPTION: Local stand-in for the NOMADS server. Serves synthetic
+#                hrrr.YYYYMMDD/conus/ directory listings, index files,
+#                and grib2 files. Supports (multi-)range requests,
+#                conditional requests, latency, bandwidth limits,
+#                error injection, throttling (429), and files
+#                being published one after another (--publish).
+# -------------------------------------------------------------------
+
+import sys
+import os
+import re
+import json
+import time
+import random
+import struct
+import argparse
+import threading
+import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+
+
+# -------------------------------------------------------------------
+# Messages of the synthetic grib2 files:
+# (param, discipline, category, number, level type, level value, statistic)
+# -------------------------------------------------------------------
+MESSAGES = [
+    ("REFC",  0, 16, 196,  10,     0, None),
+    ("VIS",   0, 19,   0,   1,     0, None),
+    ("GUST",  0,  2,  22,   1,     0, None),
+    ("VVEL",  0,  2,   8, 105,     4, None),
+    ("PRES",  0,  3,   0,   1,     0, None),
+    ("HGT",   0,  3,   5,   1,     0, None),
+    ("TMP",   0,  0,   0,   1,     0, None),
+    ("TMP",   0,  0,   0, 103,     2, None),
+    ("DPT",   0,  0,   6, 103,     2, None),
+    ("RH",    0,  1,   1, 103,     2, None),
+    ("UGRD",  0,  2,   2, 103,    10, None),
+    ("VGRD",  0,  2,   3, 103,    10, None),
+    ("APCP",  0,  1,   8,   1,     0,    1),
+    ("WEASD", 0,  1,  13,   1,     0,    1),
+    ("TCDC",  0,  6,   1,  10,     0, None),
+    ("DSWRF", 0,  4,   7,   1,     0, None),
+    ("HGT",   0,  3,   5, 100, 50000, None),
+    ("TMP",   0,  0,   0, 100, 50000, None),
+    ("TMP",   0,  0,   0, 100, 85000, None),
+    ("CAPE",  0,  7,   6,   1,     0, None),
+]
+
+# Level names (see grib2.LEVELS)
+LEVELS = {1: "surface", 10: "entire atmosphere",
+          100: "{:d} mb", 103: "{:d} m above ground", 105: "{:d} hybrid level",
+          200: "entire atmosphere (considered as a single layer)"}
+
+# HRRR conus grid (Lambert conformal), see template 3.30
+GRID = {"nx": 1799, "ny": 1059, "la1": 21.138123, "lo1": 237.280472, "lad": 38.5,
+        "lov": 262.5, "dx": 3000., "dy": 3000., "latin1": 38.5, "latin2": 38.5}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _signed(x, size):
+    # Sign and magnitude representation used by grib2
+    return (abs(x) | (1 << (8 * size - 1))) if x < 0 else x
+
+def _section(number, body):
+    return struct.pack(">IB", 5 + len(body), number) + body
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _bits(values, widths):
+    # Big-endian bit stream of 'values' with 'widths' bits each (common
+    # or one per value), without padding between the values; the stream
+    # is padded to full octets.
+    import numpy as np
+    values = np.asarray(values, dtype = np.uint64).ravel()
+    widths = np.broadcast_to(np.asarray(widths, dtype = np.int64), values.shape)
+    if values.size == 0 or widths.max() == 0: return b""
+    nmax = int(widths.max())
+    bits = ((values[:, None] >> np.arange(nmax - 1, -1, -1, dtype = np.uint64)) & 1).astype(np.uint8)
+    keep = np.arange(nmax)[None, :] >= (nmax - widths)[:, None]
+    return np.packbits(bits[keep]).tobytes()
+
+def _width(x):
+    # Number of bits needed for the non-negative integer x
+    return int(x).bit_length()
+
+
+def _complex_packing(x, miss, order, group):
+    """_complex_packing(x, miss, order, group)
+
+    Complex packing (template 5.2, order = 0) or complex packing and
+    spatial differencing (template 5.3, order 1 or 2) of the integers 'x'.
+    Fixed group size 'group'. Missing values ('miss', boolean array, or
+    None) use the primary missing value management.
+
+    Returns
+    -------
+    Tuple (section 5 after the number of bits, number of bits of the
+    group reference values, section 7).
+    """
+    import numpy as np
+    x    = np.asarray(x, dtype = np.int64)
+    miss = np.zeros(x.size, dtype = bool) if miss is None else np.asarray(miss, dtype = bool)
+
+    # Spatial differencing of the values not missing; the first
+    # value(s) are stored as extra descriptors
+    y     = x[~miss].copy()
+    first = [int(v) for v in y[:order]]
+    if order == 1 and y.size > 1:
+        y[1:] = y[1:] - x[~miss][:-1]
+    elif order == 2 and y.size > 2:
+        v = x[~miss]
+        y[2:] = v[2:] - 2 * v[1:-1] + v[:-2]
+    dmin = int(y[order:].min()) if y.size > order else 0
+    if order > 0:
+        y[order:] -= dmin
+        y[:order]  = 0
+    z = np.zeros(x.size, dtype = np.int64)
+    z[~miss] = y
+
+    # Groups of fixed size: reference value (minimum) and width
+    starts = np.arange(0, max(x.size, 1), group)
+    refs, widths, packed, width = [], [], [], []
+    for a in starts:
+        v, m = z[a:(a + group)], miss[a:(a + group)]
+        if m.all():
+            refs.append(None); widths.append(0)
+            packed.append(np.zeros(0, dtype = np.int64)); width.append(np.zeros(0, dtype = np.int64))
+            continue
+        ref = int(v[~m].min())
+        w   = _width(int(v[~m].max()) - ref + (1 if m.any() else 0))
+        refs.append(ref); widths.append(w)
+        packed.append(np.where(m, 2**w - 1, v - ref) if w > 0 else np.zeros(0, dtype = np.int64))
+        width.append(np.full(len(packed[-1]), w, dtype = np.int64))
+    missing = 1 if miss.any() else 0
+    nbits   = max(1, _width(max([0] + [r for r in refs if r is not None]) + missing))
+    refs    = [2**nbits - 1 if r is None else r for r in refs]
+    wref    = min(widths)
+    wbits   = _width(max(widths) - wref)
+    llast   = x.size - starts[-1]
+
+    nextra = 0
+    extra  = b""
+    if order > 0:
+        nextra = max(1, (max([_width(abs(r)) for r in first + [dmin]]) + 1 + 7) // 8)
+        extra  = b"".join([_signed(r, nextra).to_bytes(nextra, "big") for r in first + [dmin]])
+    s5 = struct.pack(">BBBfIIBBIBIB", 0, 1, missing, 9.999e20, 0xffffffff, len(starts),
+                     wref, wbits, group, 1, llast, 0)
+    if order > 0:
+        s5 += struct.pack(">BB", order, nextra)
+    s7 = extra + _bits(refs, nbits) + _bits(np.array(widths) - wref, wbits) + \
+         _bits(np.concatenate(packed), np.concatenate(width))
+    return s5, nbits, s7
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def encode_message(date, step, message, values, grid, nbits = 16, template = 0,
+                   order = 2, bitmap = False, group = 16):
+    """encode_message(date, step, message, values, grid, nbits = 16, template = 0,
+                      order = 2, bitmap = False, group = 16)
+
+    Creates one grib2 message: simple packing (template 5.0), complex
+    packing (template 5.2), or complex packing and spatial differencing
+    (template 5.3) as used by HRRR.
+
+    Parameters
+    ----------
+    date : datetime.datetime
+        model initialization.
+    step : int
+        forecast step in hours.
+    message : tuple
+        message definition, one of MESSAGES.
+    values : numpy.ndarray
+        field (ny, nx) to be encoded. Missing values (NaN) are stored
+        in the bitmap (section 6) if 'bitmap' is set, else using the
+        missing value management of the complex packing.
+    grid : dict
+        grid definition (Lambert conformal, see GRID).
+    nbits : int
+        number of bits per value (precision of the values).
+    template : int
+        data representation template, 0, 2, or 3.
+    order : int
+        order of the spatial differencing (1 or 2, template 5.3 only).
+    bitmap : bool
+        see 'values'.
+    group : int
+        number of values per group (templates 5.2 and 5.3).
+
+    Returns
+    -------
+    bytes, the grib2 message.
+    """
+    import numpy as np
+
+    param, disc, cat, num, ltype, lval, stat = message
+    ny, nx = values.shape
+
+    # Section 1: identification
+    s1 = struct.pack(">HHBBBHBBBBBBB", 7, 0, 2, 1, 1, date.year, date.month, date.day,
+                     date.hour, 0, 0, 0, 1)
+    # Section 3: grid definition, Lambert conformal (template 3.30)
+    s3 = struct.pack(">BIBBH", 0, nx * ny, 0, 0, 30) + \
+         struct.pack(">BBIBIBIIIIIBIIIIBBIIII", 6, 0, 0, 0, 0, 0, 0, nx, ny,
+                     _signed(int(round(grid["la1"] * 1e6)), 4), _signed(int(round(grid["lo1"] * 1e6)), 4), 8,
+                     _signed(int(round(grid["lad"] * 1e6)), 4), _signed(int(round(grid["lov"] * 1e6)), 4),
+                     int(round(grid["dx"] * 1e3)), int(round(grid["dy"] * 1e3)), 0, 64,
+                     _signed(int(round(grid["latin1"] * 1e6)), 4), _signed(int(round(grid["latin2"] * 1e6)), 4),
+                     _signed(-90000000, 4), 0)
+    # Section 4: product definition (template 4.0 or 4.8)
+    fcst = 0 if stat is not None else step
+    s4   = struct.pack(">HHBBBBBHBBIBBIBBI", 0, 0 if stat is None else 8, cat, num, 2, 0, 83,
+                       0, 0, 1, fcst, ltype, 0, lval, 255, 255, 0xffffffff)
+    if stat is not None:
+        end = date + dt.timedelta(hours = step)
+        s4 += struct.pack(">HBBBBBBIBBBIBI", end.year, end.month, end.day, end.hour, 0, 0,
+                          1, 0, stat, 2, 1, step, 1, 0)
+
+    # Values to be packed (bitmap: the ones not missing), scaled
+    # to integers: value = ref + x * 2**scale
+    flat  = np.asarray(values, dtype = np.float64).ravel()
+    valid = ~np.isnan(flat)
+    if not valid.all() and not bitmap and template == 0:
+        raise ValueError("missing values require a bitmap for template 5.0")
+    flat  = flat[valid] if bitmap else flat
+    miss  = None if bitmap or valid.all() else ~valid
+    good  = flat[~np.isnan(flat)]
+    ref   = np.float32(good.min() if good.size > 0 else 0.)
+    if ref > good.min(): ref = np.nextafter(ref, np.float32(-np.inf))
+    rng   = float(good.max()) - float(ref) if good.size > 0 else 0.
+    scale = 0 if rng == 0 else int(np.ceil(np.log2(rng / (2**nbits - 1))))
+    x     = np.zeros(flat.size, dtype = np.int64)
+    x[~np.isnan(flat)] = np.maximum(0, np.round((good - float(ref)) / 2.**scale)).astype(np.int64)
+
+    # Section 5 and 7: data representation and packed values
+    if template == 0:
+        s5 = struct.pack(">IHfHHBB", flat.size, 0, ref, _signed(scale, 2), 0, nbits, 0)
+        s7 = _bits(x, nbits)
+    elif template in [2, 3]:
+        tail, bits, s7 = _complex_packing(x, miss, order if template == 3 else 0, group)
+        s5 = struct.pack(">IHfHHB", flat.size, template, ref, _signed(scale, 2), 0, bits) + tail
+    else:
+        raise ValueError("data representation template 5.{:d} not supported".format(template))
+    # Section 6: bitmap
+    s6 = struct.pack(">B", 255) if not bitmap else struct.pack(">B", 0) + np.packbits(valid).tobytes()
+
+    body = _section(1, s1) + _section(3, s3) + _section(4, s4) + _section(5, s5) + \
+           _section(6, s6) + _section(7, s7) + b"7777"
+    return b"GRIB" + b"\0\0" + bytes([disc, 2]) + struct.pack(">Q", 16 + len(body)) + body
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def synthetic_field(message, date, step, ny, nx):
+    """synthetic_field(message, date, step, ny, nx)
+
+    Returns a smooth synthetic field (numpy array, ny x nx) depending on
+    parameter, date, and step.
+    """
+    import numpy as np
+    seed = sum([ord(c) for c in message[0]]) + message[5] + date.hour + 24 * step
+    y, x = np.mgrid[0:ny, 0:nx].astype(np.float32)
+    return 100. + 10. * np.sin(x / nx * 6.28 + seed) * np.cos(y / ny * 3.14 + 0.1 * seed) + 0.01 * seed
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class synthetic_archive(object):
+
+    def __init__(self, dates, runhours, steps, types, nx, ny, nbits = 16, cachesize = 64,
+                 publish = 0.):
+        """synthetic_archive(dates, runhours, steps, types, nx, ny, nbits = 16, cachesize = 64,
+                             publish = 0.)
+
+        Creates (and caches) the synthetic grib2 files and index files
+        served by the stand-in server. Files are created on first access.
+
+        Parameters
+        ----------
+        dates : list
+            list of datetime.date objects.
+        runhours : list
+            list of integers, model initialization hours.
+        steps : list
+            list of integers, forecast steps.
+        types : list
+            list of file types (e.g., ["wrfsfc", "wrfprs"]).
+        nx, ny : int
+            grid size (the grid is a subset of the HRRR grid).
+        nbits : int
+            number of bits per value.
+        cachesize : int
+            number of files kept in memory.
+        publish : float
+            if > 0, the files of the last date are published one after
+            another (runhour, step, type), one every 'publish' seconds
+            after the archive has been created (see 'published').
+        """
+        self.dates     = dates
+        self.runhours  = runhours
+        self.steps     = steps
+        self.types     = types
+        self.nx        = nx
+        self.ny        = ny
+        self.nbits     = nbits
+        self.grid      = dict(GRID, nx = nx, ny = ny)
+        self._cache    = {}
+        self._order    = []
+        self._size     = cachesize
+        self._lock     = threading.Lock()
+        self.publish   = publish
+        self.modified  = time.time()
+
+    def files(self, date, published = False):
+        """files(date, published = False)
+
+        Returns
+        -------
+        List of the grib2 file names for one date. If 'published' is
+        True only the ones already published (see 'published').
+        """
+        res = ["hrrr.t{:02d}z.{:s}f{:02d}.grib2".format(rh, t, s)
+               for rh in self.runhours for s in self.steps for t in self.types]
+        if published:
+            now = time.time()
+            res = [x for x in res if self.published(date, x) <= now]
+        return res
+
+    def published(self, date, file):
+        """published(date, file)
+
+        Returns
+        -------
+        Time (seconds since epoch) when the file is/was published.
+        """
+        if self.publish <= 0 or not date == self.dates[-1]: return self.modified
+        return self.modified + (self.files(date).index(file) + 1) * self.publish
+
+    def get(self, date, file):
+        """get(date, file)
+
+        Returns
+        -------
+        Tuple (grib2 data, index file content) or None if not existing.
+        """
+        tmp = re.match(r"^hrrr\.t([0-9]{2})z\.([a-z]+)f([0-9]{2})\.grib2$", file)
+        if not tmp or not date in self.dates or not file in self.files(date, True): return None
+        key = (date, file)
+        with self._lock:
+            if key in self._cache: return self._cache[key]
+
+        init = dt.datetime.combine(date, dt.time(int(tmp.group(1))))
+        step = int(tmp.group(3))
+        data = []
+        idx  = []
+        pos  = 0
+        for k,msg in enumerate(MESSAGES):
+            values = synthetic_field(msg, init, step, self.ny, self.nx)
+            # As HRRR: complex packing and spatial differencing, some simple packing
+            data.append(encode_message(init, step, msg, values, self.grid, self.nbits,
+                                       template = 0 if k % 4 == 1 else 3))
+            level = LEVELS[msg[4]]
+            level = level.format(msg[5] // 100 if msg[4] == 100 else msg[5]) if "{" in level else level
+            if msg[6] is not None:
+                fcst = "0-{:d} hour acc fcst".format(step) if step > 0 else "0-0 day acc fcst"
+            else:
+                fcst = "anl" if step == 0 else "{:d} hour fcst".format(step)
+            idx.append("{:d}:{:d}:d={:s}:{:s}:{:s}:{:s}:".format(k + 1, pos,
+                       init.strftime("%Y%m%d%H"), msg[0], level, fcst))
+            pos += len(data[-1])
+        res = (b"".join(data), ("\n".join(idx) + "\n").encode("utf-8"))
+
+        with self._lock:
+            self._cache[key] = res
+            self._order.append(key)
+            while len(self._order) > self._size:
+                del self._cache[self._order.pop(0)]
+        return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class standin_handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without TCP_NODELAY the body
+    # of a response on a kept-alive connection waits for the delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_HEAD(self):
+        self._handle(head = True)
+
+    def do_GET(self):
+        self._handle(head = False)
+
+    # ---------------------------------------------------------------
+    def _handle(self, head):
+        server = self.server
+        path   = self.path.split("?")[0]
+
+        if path == "/_stats":
+            return self._send(200, json.dumps(server.get_stats()).encode("utf-8"),
+                              "application/json", count = False)
+
+        kind = "head" if head else "listing" if path.endswith("/") else \
+               "idx" if path.endswith(".idx") else "data"
+        server.count("requests_" + kind)
+
+        # Latency and throttling
+        if server.latency > 0: time.sleep(server.latency)
+        if not server.allow():
+            server.count("status_429")
+            return self._send(429, b"Too many requests\n", extra = {"Retry-After": "1"})
+
+        # Content
+        content = None if kind == "idx" and not server.idx else self._content(path)
+        if content is None:
+            return self._send(404, b"Not found\n")
+        body, ctype, mtime = content
+
+        # Conditional requests (ETag/Last-Modified)
+        etag     = "\"{:x}-{:x}\"".format(len(body), int(mtime))
+        modified = formatdate(mtime, usegmt = True)
+        extra    = {"ETag": etag, "Last-Modified": modified, "Accept-Ranges": "bytes"}
+        inm = self.headers.get("If-None-Match")
+        ims = self.headers.get("If-Modified-Since")
+        try:
+            ims = parsedate_to_datetime(ims).timestamp() if ims else None
+        except Exception:
+            ims = None
+        if (inm and inm == etag) or (not inm and ims and ims >= int(mtime)):
+            server.count("status_304")
+            return self._send(304, b"", extra = extra)
+
+        # Error injection (not for listings)
+        error = server.inject() if kind in ["idx", "data"] else None
+        if error == "500":
+            server.count("status_500")
+            return self._send(500, b"Internal server error\n")
+        elif error == "html":
+            server.count("errors_html")
+            return self._send(200, b"<html><body>Service temporarily unavailable</body></html>\n",
+                              "text/html", head = head)
+
+        # Range requests
+        ranges = self._ranges(len(body)) if server.ranges else None
+        if ranges == []:
+            return self._send(416, b"", extra = {"Content-Range": "bytes */{:d}".format(len(body))})
+        elif ranges is None:
+            return self._send(200, body, ctype, extra, head, error)
+        elif len(ranges) == 1:
+            a, b = ranges[0]
+            extra["Content-Range"] = "bytes {:d}-{:d}/{:d}".format(a, b, len(body))
+            return self._send(206, body[a:(b + 1)], ctype, extra, head, error)
+        else:
+            boundary = "STANDIN_BOUNDARY"
+            parts = []
+            for a,b in ranges:
+                parts.append("\r\n--{:s}\r\nContent-Type: {:s}\r\nContent-Range: bytes {:d}-{:d}/{:d}\r\n\r\n".format(
+                             boundary, ctype, a, b, len(body)).encode("ascii") + body[a:(b + 1)])
+            parts.append("\r\n--{:s}--\r\n".format(boundary).encode("ascii"))
+            return self._send(206, b"".join(parts), "multipart/byteranges; boundary=" + boundary,
+                              extra, head, error)
+
+    # ---------------------------------------------------------------
+    def _content(self, path):
+        """Returns (body, content type, modified) or None."""
+        archive = self.server.archive
+        parts   = [x for x in path.split("/") if len(x) > 0]
+
+        def listing(title, names, modified = None):
+            if modified is None: modified = [archive.modified] * len(names)
+            rows = ["<a href=\"{0:s}\">{0:s}</a> {1:s} -".format(x,
+                    time.strftime("%d-%b-%Y %H:%M", time.gmtime(m))) for x,m in zip(names, modified)]
+            html = "<html><head><title>Index of {0:s}</title></head><body><h1>Index of {0:s}</h1>" \
+                   "<pre><a href=\"../\">Parent Directory</a>\n{1:s}\n</pre></body></html>\n".format(
+                   title, "\n".join(rows))
+            return html.encode("utf-8"), "text/html", max([archive.modified] + modified)
+
+        if len(parts) == 0:
+            return listing("/", ["hrrr.{:s}/".format(x.strftime("%Y%m%d")) for x in archive.dates])
+
+        tmp = re.match(r"^hrrr\.([0-9]{8})$", parts[0])
+        if not tmp: return None
+        date = dt.datetime.strptime(tmp.group(1), "%Y%m%d").date()
+        if not date in archive.dates: return None
+        if len(parts) == 1:
+            return listing("/" + parts[0], ["conus/"])
+        if not parts[1] == "conus": return None
+        if len(parts) == 2:
+            names    = []
+            modified = []
+            for x in archive.files(date, True):
+                names    += [x, x + ".idx"]
+                modified += [archive.published(date, x)] * 2
+            return listing("/" + "/".join(parts[:2]), names, modified)
+        if len(parts) > 3: return None
+
+        file = parts[2][:-4] if parts[2].endswith(".idx") else parts[2]
+        res  = archive.get(date, file)
+        if res is None: return None
+        modified = archive.published(date, file)
+        if parts[2].endswith(".idx"):
+            return res[1], "text/plain", modified
+        return res[0], "application/octet-stream", modified
+
+    def _ranges(self, size):
+        """Returns None (no range request), [] (not satisfiable) or a list of (start, end)."""
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes="): return None
+        res = []
+        for rec in header[6:].split(","):
+            a, b = rec.strip().split("-")
+            if len(a) == 0:
+                a, b = max(0, size - int(b)), size - 1
+            else:
+                a, b = int(a), size - 1 if len(b) == 0 else min(int(b), size - 1)
+            if a < size and a <= b: res.append((a, b))
+        return res
+
+    def _send(self, status, body, ctype = "text/plain", extra = None, head = False,
+              error = None, count = True):
+        server = self.server
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for key,val in ({} if extra is None else extra).items():
+            self.send_header(key, val)
+        if error is not None:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if head or status == 304: return
+
+        # Reset: close connection without sending the body,
+        # truncate: send half of the body and close the connection.
+        if error == "reset":
+            server.count("errors_reset")
+            self.close_connection = True
+            return
+        elif error == "truncate":
+            server.count("errors_truncate")
+            body = body[:(len(body) // 2)]
+            self.close_connection = True
+
+        # Sending data (limited bandwidth if set)
+        chunk = 65536
+        for i in range(0, len(body), chunk):
+            t0 = time.time()
+            try:
+                self.wfile.write(body[i:(i + chunk)])
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                return
+            if server.bandwidth > 0:
+                wait = min(chunk, len(body) - i) / server.bandwidth - (time.time() - t0)
+                if wait > 0: time.sleep(wait)
+        if count: server.count("bytes_sent", len(body))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class standin_server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, archive, port = 0, host = "127.0.0.1", latency = 0., bandwidth = 0.,
+                 error_rate = 0., errors = ["500", "reset", "truncate"], max_rate = 0.,
+                 ranges = True, idx = True, verbose = False):
+        """standin_server(archive, port = 0, host = "127.0.0.1", latency = 0., bandwidth = 0.,
+                          error_rate = 0., errors = ["500", "reset", "truncate"], max_rate = 0.,
+                          ranges = True, idx = True, verbose = False)
+
+        Local HTTP server serving a synthetic_archive like NOMADS does.
+
+        Parameters
+        ----------
+        archive : synthetic_archive
+            the files to be served.
+        port : int
+            port, 0 uses a free port (see attribute 'url').
+        host : str
+            host/interface.
+        latency : float
+            delay in seconds before responding to a request.
+        bandwidth : float
+            maximum bandwidth in bytes per second per connection,
+            0 = unlimited.
+        error_rate : float
+            probability of an error for idx/data requests (0-1).
+        errors : list
+            errors to inject: "500" (server error), "reset" (connection
+            closed before sending the body), "truncate" (half of the body),
+            "html" (error page with status 200).
+        max_rate : float
+            maximum number of requests per second; more requests are
+            answered with "429 Too Many Requests". 0 = unlimited.
+        ranges : bool
+            if False, the Range header is ignored (whole file, status 200).
+        idx : bool
+            if False, the index files are not available (404) although
+            listed (the downloader has to read the grib2 files).
+        verbose : bool
+            log requests to stderr.
+        """
+        ThreadingHTTPServer.__init__(self, (host, port), standin_handler)
+        self.archive    = archive
+        self.latency    = latency
+        self.bandwidth  = bandwidth
+        self.error_rate = error_rate
+        self.errors     = errors
+        self.max_rate   = max_rate
+        self.ranges     = ranges
+        self.idx        = idx
+        self.verbose    = verbose
+        self.url        = "http://{:s}:{:d}".format(*self.server_address[:2])
+        self._lock      = threading.Lock()
+        self._stats     = {}
+        self._tokens    = max_rate
+        self._tokens_t  = time.time()
+        self._thread    = None
+
+    def count(self, key, n = 1):
+        with self._lock:
+            self._stats[key] = self._stats.get(key, 0) + n
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def allow(self):
+        """Token bucket, False if the request has to be throttled."""
+        if self.max_rate <= 0: return True
+        with self._lock:
+            now = time.time()
+            self._tokens   = min(self.max_rate, self._tokens + (now - self._tokens_t) * self.max_rate)
+            self._tokens_t = now
+            if self._tokens < 1: return False
+            self._tokens -= 1
+            return True
+
+    def inject(self):
+        """Returns None or the error to be injected."""
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            return random.choice(self.errors)
+        return None
+
+    def start(self):
+        """start()
+
+        Starts the server in a background thread.
+        """
+        self._thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stop()
+
+        Stops a server started with start().
+        """
+        self.shutdown()
+        self.server_close()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def parse_args(parser, args = None):
+    """parse_args(parser, args = None)
+
+    Adds the stand-in server arguments to an argparse.ArgumentParser
+    and parses the arguments. Used by this script and benchmark.py.
+
+    Returns
+    -------
+    Dictionary with the parsed arguments.
+    """
+    parser.add_argument("--date", type = str, default = None,
+               help = "Last date (YYYYMMDD) on the server. Default is today.")
+    parser.add_argument("--days", type = int, default = 2,
+               help = "Number of dates on the server. Default is 2.")
+    parser.add_argument("--runhours", type = str, default = "0,6,12,18",
+               help = "Runhours, comma separated. Default is 0,6,12,18.")
+    parser.add_argument("--steps", type = str, default = "0,1,2",
+               help = "Forecast steps, comma separated. Default is 0,1,2.")
+    parser.add_argument("--types", type = str, default = "wrfsfc",
+               help = "File types, comma separated. Default is wrfsfc.")
+    parser.add_argument("--nx", type = int, default = 180,
+               help = "Grid size (x). Default is 180.")
+    parser.add_argument("--ny", type = int, default = 106,
+               help = "Grid size (y). Default is 106.")
+    parser.add_argument("--latency", type = float, default = 0.,
+               help = "Latency in seconds per request. Default is 0.")
+    parser.add_argument("--bandwidth", type = float, default = 0.,
+               help = "Bandwidth limit per connection in MB/s. Default is 0 (unlimited).")
+    parser.add_argument("--error-rate", type = float, default = 0.,
+               help = "Probability of errors for idx/data requests. Default is 0.")
+    parser.add_argument("--errors", type = str, default = "500,reset,truncate",
+               help = "Errors to inject (500, reset, truncate, html), comma separated. " + \
+                      "Default is 500,reset,truncate.")
+    parser.add_argument("--max-rate", type = float, default = 0.,
+               help = "Maximum number of requests per second (429). Default is 0 (unlimited).")
+    parser.add_argument("--publish", type = float, default = 0.,
+               help = "Publish the files of the last date one by one, one every PUBLISH seconds. " + \
+                      "Default is 0 (all files available).")
+    parser.add_argument("--no-ranges", action = "store_true",
+               help = "Ignore the Range header (whole file, status 200) like some mirrors do.")
+    parser.add_argument("--no-idx", action = "store_true",
+               help = "Index files not available (404), although listed.")
+    args = vars(parser.parse_args(args))
+
+    if args["date"] is None:
+        args["date"] = dt.date.today().strftime("%Y%m%d")
+    last = dt.datetime.strptime(args["date"], "%Y%m%d").date()
+    args["dates"]    = [last - dt.timedelta(days = k) for k in range(args["days"] - 1, -1, -1)]
+    args["runhours"] = [int(x) for x in args["runhours"].split(",")]
+    args["steps"]    = [int(x) for x in args["steps"].split(",")]
+    args["types"]    = [x.strip() for x in args["types"].split(",")]
+    args["errors"]   = [x.strip() for x in args["errors"].split(",")]
+    return args
+
+
+def create_archive(args):
+    """create_archive(args)
+
+    Returns a synthetic_archive object given the arguments
+    returned by parse_args.
+    """
+    return synthetic_archive(args["dates"], args["runhours"], args["steps"], args["types"],
+                             args["nx"], args["ny"], publish = args["publish"])
+
+
+def create_server(args, port = 0):
+    """create_server(args, port = 0)
+
+    Returns a standin_server object given the arguments
+    returned by parse_args.
+    """
+    return standin_server(create_archive(args), port = port, latency = args["latency"],
+                          bandwidth = args["bandwidth"] * 1e6, error_rate = args["error_rate"],
+                          errors = args["errors"], max_rate = args["max_rate"],
+                          ranges = not args["no_ranges"], idx = not args["no_idx"], verbose = args.get("verbose", False))
+
+
+# -------------------------------------------------------------------
+# Main script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Local stand-in for the NOMADS server")
+    parser.add_argument("--port", "-p", type = int, default = 8080,
+               help = "Port. Default is 8080.")
+    parser.add_argument("--verbose", "-v", action = "store_true",
+               help = "Log requests.")
+    args = parse_args(parser)
+
+    server = create_server(args, args["port"])
+    print("Serving {:d} dates on {:s} (statistics: {:s}/_stats)".format(
+          len(args["dates"]), server.url, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()